@@ -35,6 +35,8 @@ def clean(request):
     if tu.db_exists():
         tu.clean_db()
     tu.clean_fs()
+    # temporary conf, manifest and plan files, even if the test failed
+    request.addfinalizer(tu.remove_tmp_files)
 
 
 @pytest.fixture(scope="function")
@@ -2,13 +2,12 @@
 
 from __future__ import print_function
 from __future__ import unicode_literals
-import pymysql
 import datetime
 import re
 import logging
-import time
-import random
-from dateutil.parser import parse
+from lycheesync.lycheeindex import LycheePhotoIndex
+from lycheesync.lycheepool import LycheeConnectionPool, RetrySSCursor, connect
+from lycheesync.utils.idallocator import TimeBasedIdAllocator
 
 logger = logging.getLogger(__name__)
 
@@ -19,10 +18,15 @@ class LycheeDAO:
     Implements linking with Lychee DB
     """
 
-    db = None
-    db2 = None
+    pool = None
     conf = None
     albumslist = {}
+    photoindex = None
+    idallocator = None
+    pendingphotos = []
+    failedphotos = []
+    # tries to find out the rows written by a failed batch insert
+    check_attempts = 3
 
     def __init__(self, conf):
         """
@@ -30,74 +34,51 @@ class LycheeDAO:
         """
         try:
             self.conf = conf
-            if 'dbSocket' in self.conf:
-                logger.debug("Connection to db in SOCKET mode")
-                logger.error("host: %s", self.conf['dbHost'])
-                logger.error("user: %s", self.conf['dbUser'])
-                logger.error("password: %s", self.conf['dbPassword'])
-                logger.error("db: %s", self.conf['db'])
-                logger.error("unix_socket: %s", self.conf['dbSocket'])
-                self.db = pymysql.connect(host=self.conf['dbHost'],
-                                          user=self.conf['dbUser'],
-                                          passwd=self.conf['dbPassword'],
-                                          db=self.conf['db'],
-                                          charset='utf8mb4',
-                                          unix_socket=self.conf['dbSocket'],
-                                          cursorclass=pymysql.cursors.DictCursor)
-            else:
-                logger.debug("Connection to db in NO SOCKET mode")
-                self.db = pymysql.connect(host=self.conf['dbHost'],
-                                          user=self.conf['dbUser'],
-                                          passwd=self.conf['dbPassword'],
-                                          db=self.conf['db'],
-                                          charset='utf8mb4',
-                                          cursorclass=pymysql.cursors.DictCursor)
-
-            cur = self.db.cursor()
-            cur.execute("set names utf8;")
-
-            if self.conf["dropdb"]:
-                self.dropAll()
+            self.pendingphotos = []
+            self.failedphotos = []
+            self.pool = LycheeConnectionPool(self.conf, int(self.conf.get('dbPingAfter', 30)))
 
             self.loadAlbumList()
+            self.loadPhotoIndex()
+            self.idallocator = TimeBasedIdAllocator(
+                self.getMaxId(), TimeBasedIdAllocator.sharedPathFor(self.conf['lycheepath']))
 
         except Exception as e:
             logger.error(e)
             raise
 
+    @staticmethod
+    def connect(conf):
+        """
+        Open a connection to lychee db, out of any pool (see lycheepool.connect)
+        """
+        return connect(conf)
+
+    @property
+    def db(self):
+        """
+        The db connection of the calling thread: each worker thread gets its own connection from the pool
+        """
+        return self.pool.get()
+
     def getUniqPhotoId(self):
-        id = self.getUniqTimeBasedId()
-        nbtry = 1
-        while (self.photoIdExists(id)):
-            id = self.getUniqTimeBasedId()
-            nbtry += 1
-            if (nbtry == 5):
-                raise Exception("didn't manage to create uniq id")
-        return id
+        return self.idallocator.next()
 
     def getUniqAlbumId(self):
-        id = self.getUniqTimeBasedId()
-        nbtry = 1
-        while (self.albumIdExists(id)):
-            id = self.getUniqTimeBasedId()
-            nbtry += 1
-            if (nbtry == 5):
-                raise Exception("didn't manage to create uniq id")
-        return id
-
-    def getUniqTimeBasedId(self):
-        # Compute Photo ID
-        id = str(int(time.time()))
-        # not precise enough
-        length = len(id)
-        if length < 14:
-            missing_char = 14 - length
-            r = random.random()
-            r = str(r)
-            # last missing_char char
-            filler = r[-missing_char:]
-            id = id + filler
-        return id
+        return self.idallocator.next()
+
+    def getMaxId(self):
+        """
+        returns the highest id used by a photo or an album
+        """
+        res = 0
+        cur = self.db.cursor()
+        for table in ["lychee_photos", "lychee_albums"]:
+            cur.execute("select max(id) as max from " + table)
+            row = cur.fetchone()
+            if row['max'] is not None:
+                res = max(res, int(row['max']))
+        return res
 
     def getAlbumNameDBWidth(self):
         res = 50  # default value
@@ -178,18 +159,53 @@ class LycheeDAO:
         finally:
             return res
 
+    def updateAlbumsDateFromPhotos(self, album_ids=None, margin=120):
+        """
+        Set album dates to the most recent takestamp of their photos, in a single statement
+        Photos without exif date have no takestamp (see _photoRow) and are ignored.
+        Older versions stored their import date as takestamp: for these rows, photos taken less than margin
+        seconds before their import are ignored (a photo id starts with its import epoch timestamp, see getUniqPhotoId)
+        Albums without any other photo are left unchanged
+        Parameters:
+        - album_ids: the ids of the albums to update (None: every album)
+        - margin: in seconds
+        Returns the number of updated albums
+        """
+        res = 0
+        if album_ids is not None and len(album_ids) == 0:
+            return res
+        photo_filter = "takestamp is not null and takestamp < id div 10000 - %s"
+        params = [int(margin)]
+        qry = ("update lychee_albums a join (select album, max(takestamp) as maxstamp from lychee_photos where " +
+               photo_filter + " group by album) p on p.album = cast(a.id as char) set a.sysstamp = p.maxstamp")
+        if album_ids is not None:
+            qry += " where a.id in (" + ','.join(['%s'] * len(album_ids)) + ")"
+            params.extend(int(i) for i in album_ids)
+        try:
+            cur = self.db.cursor()
+            res = cur.execute(qry, params)
+            self.db.commit()
+            logger.debug("%s album dates updated", res)
+        except Exception as e:
+            logger.exception(e)
+            logger.error("updateAlbumsDateFromPhotos")
+            raise
+        finally:
+            return res
+
     def changeAlbumId(self, oldid, newid):
         """
         Change albums id based on album titles (to affect display order)
         """
         res = True
-        photo_query = "update lychee_photos set album = " + str(newid) + " where album = " + str(oldid)
+        photo_query = "update lychee_photos set album = %s where album = %s"
         album_query = "update lychee_albums set id = " + str(newid) + " where id = " + str(oldid)
         try:
             cur = self.db.cursor()
-            cur.execute(photo_query)
+            cur.execute(photo_query, (str(newid), str(oldid)))
             cur.execute(album_query)
             self.db.commit()
+            self.photoindex.moveAlbum(oldid, newid)
             logger.debug("album id changed: " + str(oldid) + " to " + str(newid))
         except Exception as e:
             logger.exception(e)
@@ -198,6 +214,82 @@ class LycheeDAO:
         finally:
             return res
 
+    def moveAlbums(self, moves):
+        """
+        Change the id of several albums in a single transaction, with one statement per table
+        Parameters:
+        - moves: a list of (old id, new id), new ids must not be used by any album
+        Returns True on success, nothing is changed otherwise
+        """
+        res = True
+        cases = ' '.join(['when %s then %s'] * len(moves))
+        inlist = ','.join(['%s'] * len(moves))
+        # lychee_photos.album is a varchar, lychee_albums.id a bigint
+        photo_query = "update lychee_photos set album = case album " + cases + " end where album in (" + inlist + ")"
+        album_query = "update lychee_albums set id = case id " + cases + " end where id in (" + inlist + ")"
+        photo_params = [str(i) for move in moves for i in move] + [str(old) for old, new in moves]
+        album_params = [int(i) for move in moves for i in move] + [int(old) for old, new in moves]
+        try:
+            self.db.begin()
+            cur = self.db.cursor()
+            cur.execute(photo_query, photo_params)
+            cur.execute(album_query, album_params)
+            self.db.commit()
+            moved = dict((str(oldid), newid) for oldid, newid in moves)
+            for oldid, newid in moves:
+                self.photoindex.moveAlbum(oldid, newid)
+            for title, albumid in list(self.albumslist.items()):
+                if str(albumid) in moved:
+                    self.albumslist[title] = moved[str(albumid)]
+            logger.debug("album ids changed: %s", moves)
+        except Exception as e:
+            logger.exception(e)
+            logger.error("moveAlbums failed, rollback")
+            self.db.rollback()
+            res = False
+        finally:
+            return res
+
+    def iterRows(self, query, params=None, batchsize=None):
+        """
+        Stream the rows of a select with an unbuffered cursor: the result set is never held in memory
+        The connection can't run another query until the generator is exhausted (or closed)
+        Parameters:
+        - query, params: the select and its parameters
+        - batchsize: the number of rows fetched at once (default: fetchBatchSize conf key, 10000)
+        Returns a generator of row tuples
+        """
+        batchsize = batchsize or int(self.conf.get('fetchBatchSize', 10000))
+        cur = self.db.cursor(RetrySSCursor)
+        try:
+            cur.execute(query, params)
+            rows = cur.fetchmany(batchsize)
+            while rows:
+                for row in rows:
+                    yield row
+                rows = cur.fetchmany(batchsize)
+        finally:
+            cur.close()
+
+    def iterPhotos(self, album_id=None):
+        """
+        Stream the photos of lychee db (see iterRows)
+        Parameters:
+        - album_id: only stream the photos of this album (default: every photo)
+        Returns a generator of (id, url, thumbUrl, album) tuples
+        """
+        if album_id:
+            return self.iterRows("select id, url, thumbUrl, album from lychee_photos where album = %s",
+                                 (str(album_id),))
+        return self.iterRows("select id, url, thumbUrl, album from lychee_photos")
+
+    def iterAlbums(self):
+        """
+        Stream the albums of lychee db (see iterRows)
+        Returns a generator of (id, title) tuples
+        """
+        return self.iterRows("select id, title from lychee_albums")
+
     def loadAlbumList(self):
         """
         retrieve all albums in a dictionnary key=title value=id
@@ -205,15 +297,26 @@ class LycheeDAO:
         returns self.albumlist
         """
         # Load album list
-        cur = self.db.cursor()
-        cur.execute("SELECT title,id from lychee_albums")
-        rows = cur.fetchall()
-        for row in rows:
-            self.albumslist[row['title']] = row['id']
+        for album_id, title in self.iterAlbums():
+            self.albumslist[title] = album_id
 
-        logger.debug("album list in db:" + str(self.albumslist))
+        logger.debug("%s albums in db", len(self.albumslist))
         return self.albumslist
 
+    def loadPhotoIndex(self):
+        """
+        retrieve all photos (id, album, title, checksum) in a LycheePhotoIndex
+        and put it in self.photoindex
+        Rows are streamed from the db with an unbuffered cursor
+        returns self.photoindex
+        """
+        self.photoindex = LycheePhotoIndex()
+        for row in self.iterRows("SELECT id, album, title, checksum from lychee_photos"):
+            self.photoindex.add(row[0], row[1], row[2], row[3])
+
+        logger.debug("%s photos in db", len(self.photoindex))
+        return self.photoindex
+
     def albumIdExists(self, album_id):
         res = False
         try:
@@ -240,90 +343,55 @@ class LycheeDAO:
             return None
 
     def getAlbumNameFromIdsList(self, list_id):
-        album_names = ''
-        try:
-            albumids = ','.join(list_id)
-            query = ("select title from lychee_albums where id in(" + albumids + ")")
-            cur = self.db.cursor()
-            cur.execute(query)
-            rows = cur.fetchall()
-            album_names = [column['title'] for column in rows]
-        except Exception as e:
-            album_names = ''
-            logger.error('impossible to execute ' + query)
-            logger.exception(e)
-        finally:
-            return album_names
+        """
+        Returns the album names of a list of album ids, based on self.albumslist
+        """
+        list_id = set(str(i) for i in list_id)
+        return [title for title, id in self.albumslist.items() if str(id) in list_id]
 
     def photoIdExists(self, photoid):
         res = None
-        try:
-            cur = self.db.cursor()
-            cur.execute("select id from lychee_photos where id=%s", (photoid))
-            row = cur.fetchall()
-            if len(row) != 0:
-                logger.debug("photoExistsById %s", row)
-                res = row[0]['id']
-        except Exception as e:
-            logger.exception(e)
-        finally:
-            return res
+        if photoid in self.photoindex:
+            logger.debug("photoExistsById %s", photoid)
+            res = photoid
+        return res
 
     def photoExistsByName(self, photo_name):
-        res = None
-        try:
-            cur = self.db.cursor()
-            cur.execute("select id from lychee_photos where title=%s", (photo_name))
-            row = cur.fetchall()
-            if len(row) != 0:
-                logger.debug("photoExistsByName %s", row)
-                res = row[0]['id']
-        except Exception as e:
-            logger.exception(e)
-        finally:
-            return res
+        res = self.photoindex.idByTitle(photo_name)
+        if res is not None:
+            logger.debug("photoExistsByName %s", res)
+        return res
 
     def photoExists(self, photo):
         """
         Check if a photo already exists in its album based on its original name or checksum
+        Lookups are done in self.photoindex, no db round trip
         Parameter:
         - photo: a valid LycheePhoto object
         Returns a boolean
         """
-        res = False
-        try:
-            cur = self.db.cursor()
-            cur.execute(
-                "select * from lychee_photos where album=%s AND (title=%s OR checksum=%s)",
-                (photo.albumid,
-                 photo.originalname,
-                 photo.checksum))
-            row = cur.fetchall()
-            if len(row) != 0:
-                res = True
+        return self.findPhoto(photo) is not None
 
-            # Add Warning if photo exists in another album
+    def findPhoto(self, photo):
+        """
+        Find a photo of the album of photo with the same original name or checksum
+        Lookups are done in self.photoindex, no db round trip
+        Parameter:
+        - photo: a valid LycheePhoto object
+        Returns the id of the existing photo or None
+        """
+        ids = self.photoindex.find(photo.originalname, photo.checksum)
+        res = self.photoindex.firstInAlbum(photo.albumid, ids)
 
-            cur = self.db.cursor()
-            cur.execute(
-                "select album from lychee_photos where (title=%s OR checksum=%s)",
-                (photo.originalname,
-                 photo.checksum))
-            rows = cur.fetchall()
-            album_ids = [r['album'] for r in rows]
-            if len(album_ids) > 0:
-                logger.warn(
-                    "a photo with this name: %s or checksum: %s already exists in at least another album: %s",
-                    photo.originalname,
-                    photo.checksum,
-                    self.getAlbumNameFromIdsList(album_ids))
+        # Add Warning if photo exists in another album
+        if len(ids) > 0:
+            logger.warn(
+                "a photo with this name: %s or checksum: %s already exists in at least another album: %s",
+                photo.originalname,
+                photo.checksum,
+                self.getAlbumNameFromIdsList(self.photoindex.albumsOf(ids)))
 
-        except Exception as e:
-            logger.exception(e)
-            logger.error("photoExists:", photo.srcfullpath, "won't be added to lychee")
-            res = True
-        finally:
-            return res
+        return res
 
     def createAlbum(self, album):
         """
@@ -351,7 +419,7 @@ class LycheeDAO:
 
             cur.execute("select id from lychee_albums where title=%s", (album['name']))
             row = cur.fetchone()
-            self.albumslist['name'] = row['id']
+            self.albumslist[album['name']] = row['id']
             album['id'] = row['id']
 
         except Exception as e:
@@ -369,15 +437,17 @@ class LycheeDAO:
         Return list of the erased photo url
         """
         res = []
-        query = "delete from lychee_photos where album = " + str(album_id) + ''
-        selquery = "select url from lychee_photos where album = " + str(album_id) + ''
+        # album is a varchar column: compare it with a string, a number would prevent the use of its index
+        query = "delete from lychee_photos where album = %s"
+        selquery = "select id, url from lychee_photos where album = %s"
         try:
             cur = self.db.cursor()
-            cur.execute(selquery)
+            cur.execute(selquery, (str(album_id),))
             rows = cur.fetchall()
             for row in rows:
                 res.append(row['url'])
-            cur.execute(query)
+                self.photoindex.discard(row['id'])
+            cur.execute(query, (str(album_id),))
             self.db.commit()
             logger.debug("album photos erased: ", album_id)
         except Exception as e:
@@ -408,6 +478,7 @@ class LycheeDAO:
             cur = self.db.cursor()
             cur.execute(query)
             self.db.commit()
+            self.photoindex.discard(photo_id)
             logger.debug("photo dropped: %s", photo_id)
             res = True
         except Exception as e:
@@ -415,29 +486,75 @@ class LycheeDAO:
         finally:
             return res
 
+    def _deleteIds(self, table, ids):
+        """
+        Delete rows by id, by chunks of 1000 ids, with a single commit
+        """
+        self.db.begin()
+        cur = self.db.cursor()
+        for i in range(0, len(ids), 1000):
+            chunk = ids[i:i + 1000]
+            cur.execute("delete from " + table + " where id in (" + ','.join(['%s'] * len(chunk)) + ")", chunk)
+        self.db.commit()
+
+    def dropPhotos(self, photo_ids):
+        """
+        Delete several photos at once
+        Parameters:
+        - photo_ids: a list of photo ids
+        Returns True on success
+        """
+        res = True
+        if not(photo_ids):
+            return res
+        try:
+            self._deleteIds("lychee_photos", list(photo_ids))
+            for photo_id in photo_ids:
+                self.photoindex.discard(photo_id)
+            logger.debug("%s photos dropped", len(photo_ids))
+        except Exception as e:
+            logger.exception(e)
+            self.db.rollback()
+            res = False
+        finally:
+            return res
+
+    def dropAlbums(self, album_ids):
+        """
+        Delete several albums at once (their photos are not deleted)
+        Parameters:
+        - album_ids: a list of album ids
+        Returns True on success
+        """
+        res = True
+        if not(album_ids):
+            return res
+        try:
+            self._deleteIds("lychee_albums", list(album_ids))
+            dropped = set(str(a) for a in album_ids)
+            for title, album_id in list(self.albumslist.items()):
+                if str(album_id) in dropped:
+                    del self.albumslist[title]
+            logger.debug("%s albums dropped", len(album_ids))
+        except Exception as e:
+            logger.exception(e)
+            self.db.rollback()
+            res = False
+        finally:
+            return res
+
     def get_all_photos(self, album_id=None):
         """
-        Lists all photos in leeche db (used to delete all files)
-        Return a photo url list
+        Lists all photos in leeche db, whole library passes should stream them with iterPhotos instead
+        Return a list of photo dictionnaries (id, url, thumbUrl, album), None if the db could not be read
         """
         res = []
-        if not(album_id):
-            selquery = "select id, url, album  from lychee_photos"
-        else:
-            selquery = "select id, url, album  from lychee_photos where album={}".format(album_id)
-
         try:
-            cur = self.db.cursor()
-            cur.execute(selquery)
-            rows = cur.fetchall()
-            for row in rows:
-                p = {}
-                p['url'] = row['url']
-                p['id'] = row['id']
-                p['album'] = row['album']
-                res.append(p)
+            for row in self.iterPhotos(album_id):
+                res.append({'id': row[0], 'url': row[1], 'thumbUrl': row[2], 'album': row[3]})
         except Exception as e:
             logger.exception(e)
+            res = None
         finally:
             return res
 
@@ -445,7 +562,8 @@ class LycheeDAO:
         res = []
         try:
             # check if exists in db
-            sql = "select id from lychee_albums where id not in(select distinct album from lychee_photos)"
+            sql = ("select a.id from lychee_albums a left join lychee_photos p on p.album = cast(a.id as char) "
+                   "where p.id is null")
             with self.db.cursor() as cursor:
                 cursor.execute(sql)
                 rows = cursor.fetchall()
@@ -474,52 +592,129 @@ class LycheeDAO:
         finally:
             return res
 
+    def reservePhoto(self, photo):
+        """
+        Make a photo visible to photoExists before it is added with addFileToAlbum
+        """
+        self.photoindex.add(photo.id, photo.albumid, photo.originalname, photo.checksum)
+
+    def releasePhoto(self, photo):
+        """
+        Cancel a reservePhoto, the photo won't be added
+        """
+        self.photoindex.discard(photo.id)
+
+    insert_photo_query = ("insert into lychee_photos " +
+                          "(id, url, public, type, width, height, " +
+                          "size, star, " +
+                          "thumbUrl, album, iso, aperture, make, " +
+                          "model, shutter, focal, takestamp, " +
+                          "description, title, checksum) " +
+                          "values " +
+                          "(%s, %s, %s, %s, %s, %s, " +
+                          "%s, %s, " +
+                          "%s, %s, %s, %s, %s, " +
+                          "%s, %s, %s, %s, " +
+                          "%s, %s, %s)")
+
+    def _photoRow(self, photo):
+        """
+        Build the insert_photo_query parameters of a photo
+        """
+        row = (photo.id, photo.url, self.conf["publicAlbum"], photo.type, photo.width, photo.height,
+               photo.size, photo.star,
+               photo.thumbUrl, photo.albumid,
+               photo.exif.iso,
+               photo.exif.aperture,
+               photo.exif.make,
+               photo.exif.model, photo.exif.shutter, photo.exif.focal)
+        # lychee columns are not nullable, except takestamp: null when the photo has no exif date
+        row = tuple('' if v is None else v for v in row)
+        stamp = str(photo.takestamp) if photo.takestamp is not None else None
+        return row + (stamp, photo.description or '', photo.originalname or '', photo.checksum or '')
+
     def addFileToAlbum(self, photo):
         """
         Add a photo to an album
+        The insertion is buffered, rows are written to the db by flushPhotos (called
+        every insertBatchSize photos, and by the caller at the end of each album)
         Parameter:
         - photo: a valid LycheePhoto object
         Returns a boolean
         """
         res = True
         try:
-            stamp = parse(photo.exif.takedate + ' ' + photo.exif.taketime).strftime('%s')
-        except Exception as e:
-            stamp = datetime.datetime.now().strftime('%s')
-
-        query = ("insert into lychee_photos " +
-                 "(id, url, public, type, width, height, " +
-                 "size, star, " +
-                 "thumbUrl, album,iso, aperture, make, " +
-                 "model, shutter, focal, takestamp, " +
-                 "description, title, checksum) " +
-                 "values " +
-                 "({}, '{}', {}, '{}', {}, {}, " +
-                 "'{}', {}, " +
-                 "'{}', '{}', '{}', '{}'," +
-                 " '{}', " +
-                 "'{}', '{}', '{}', '{}', " +
-                 "'{}', %s, '{}')"
-                 ).format(photo.id, photo.url, self.conf["publicAlbum"], photo.type, photo.width, photo.height,
-                          photo.size, photo.star,
-                          photo.thumbUrl, photo.albumid,
-                          photo.exif.iso,
-                          photo.exif.aperture,
-                          photo.exif.make,
-                          photo.exif.model, photo.exif.shutter, photo.exif.focal, stamp,
-                          photo.description, photo.checksum)
-        try:
-            logger.debug(query)
-            cur = self.db.cursor()
-            res = cur.execute(query, (photo.originalname))
-            self.db.commit()
+            self.pendingphotos.append((photo, self._photoRow(photo)))
+            # make the photo visible to photoExists right now
+            self.photoindex.add(photo.id, photo.albumid, photo.originalname, photo.checksum)
         except Exception as e:
             logger.exception(e)
             logger.error("addFileToAlbum : %s", photo)
-            logger.error("addFileToAlbum while executing: %s", cur._last_executed)
             res = False
-        finally:
-            return res
+        # not caught: the rows written by a failed batch may be unknown, see _writePhotos
+        if res and len(self.pendingphotos) >= int(self.conf.get("insertBatchSize", 500)):
+            self.failedphotos.extend(self._writePhotos())
+        return res
+
+    def _writePhotos(self):
+        """
+        Insert the pending photos in one multi-row insert and one commit
+        If it fails, the photos are inserted one by one to find out the faulty ones
+        If the rows already written can't be checked either, the exception is raised: the photos
+        are neither kept nor reported as failed (their files are left for the next sanity check)
+        Returns the list of photos which could not be inserted
+        """
+        pending = self.pendingphotos
+        self.pendingphotos = []
+        failed = []
+        if len(pending) == 0:
+            return failed
+
+        cur = self.db.cursor()
+        try:
+            self.db.begin()
+            cur.executemany(self.insert_photo_query, [row for photo, row in pending])
+            self.db.commit()
+            logger.debug("%s photos inserted", len(pending))
+        except Exception as e:
+            logger.warn("batch insert of %s photos failed, retry one by one: %s", len(pending), e)
+            self.db.rollback()
+            # MyISAM tables are not transactional, some rows may have been written anyway
+            for attempt in range(self.check_attempts):
+                try:
+                    cur.execute(
+                        "select id from lychee_photos where id in (" + ','.join(['%s'] * len(pending)) + ")",
+                        [photo.id for photo, row in pending])
+                    written = set(str(r['id']) for r in cur.fetchall())
+                    break
+                except Exception as e:
+                    if attempt + 1 == self.check_attempts:
+                        logger.error("could not check which of %s photos were inserted", len(pending))
+                        raise
+                    logger.warn("check of the inserted photos failed, retry: %s", e)
+            for photo, row in pending:
+                if str(photo.id) in written:
+                    continue
+                try:
+                    cur.execute(self.insert_photo_query, row)
+                except Exception as e:
+                    logger.exception(e)
+                    logger.error("addFileToAlbum : %s", photo)
+                    logger.error("addFileToAlbum while executing: %s", cur._last_executed)
+                    self.photoindex.discard(photo.id)
+                    failed.append(photo)
+            self.db.commit()
+        return failed
+
+    def flushPhotos(self):
+        """
+        Write every pending photo to the db
+        Returns the list of photos which could not be inserted since the previous flushPhotos call
+        """
+        failed = self.failedphotos
+        self.failedphotos = []
+        failed.extend(self._writePhotos())
+        return failed
 
     def reinitAlbumAutoIncrement(self):
 
@@ -536,11 +731,15 @@ class LycheeDAO:
 
     def close(self):
         """
-        Close DB Connection
+        Write pending photos and close the DB connections
         Returns nothing
         """
-        if self.db:
-            self.db.close()
+        if self.pool:
+            try:
+                for photo in self.flushPhotos():
+                    logger.error("photo not added to lychee: %s", photo.srcfullpath)
+            finally:
+                self.pool.closeAll()
 
     def dropAll(self):
         """
@@ -552,5 +751,7 @@ class LycheeDAO:
             cur.execute("delete from lychee_albums")
             cur.execute("delete from lychee_photos")
             self.db.commit()
+            self.albumslist.clear()
+            self.photoindex.clear()
         except Exception as e:
             logger.exception(e)
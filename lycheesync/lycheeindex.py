@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import binascii
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class LycheePhotoIndex:
+
+    """
+    In memory index of the photos stored in lychee db
+    Loaded once per run and kept up to date by LycheeDAO, it answers the
+    existence and duplicate questions without any db round trip
+    Entries are kept compact:
+    - photo ids are stored as int
+    - checksums are stored as binary sha1 (20 bytes)
+    - titles and album ids are interned (one shared string per distinct value)
+    Titles are compared lower cased to mimic lychee db default collation (utf8_general_ci)
+    """
+
+    def __init__(self):
+        # photo id -> (album, title, checksum)
+        self.photos = {}
+        # title -> set of photo ids
+        self.titles = {}
+        # checksum -> set of photo ids
+        self.checksums = {}
+        # album -> set of photo ids
+        self.albums = {}
+        # interned strings (sys.intern does not accept unicode in python 2)
+        self.strings = {}
+
+    def __len__(self):
+        return len(self.photos)
+
+    def __contains__(self, photoid):
+        try:
+            return int(photoid) in self.photos
+        except (TypeError, ValueError):
+            return False
+
+    def _intern(self, value):
+        return self.strings.setdefault(value, value)
+
+    def _album(self, album):
+        return self._intern(str(album))
+
+    def _title(self, title):
+        if title is None:
+            return None
+        return self._intern(title.lower())
+
+    @staticmethod
+    def _checksum(checksum):
+        if not checksum:
+            return None
+        try:
+            return binascii.unhexlify(checksum)
+        except (TypeError, ValueError, binascii.Error):
+            # not a sha1 hex digest, keep it as is
+            return checksum
+
+    def add(self, photoid, album, title, checksum):
+        """
+        Add a photo to the index
+        """
+        photoid = int(photoid)
+        entry = (self._album(album), self._title(title), self._checksum(checksum))
+        self.photos[photoid] = entry
+        self.albums.setdefault(entry[0], set()).add(photoid)
+        if entry[1] is not None:
+            self.titles.setdefault(entry[1], set()).add(photoid)
+        if entry[2] is not None:
+            self.checksums.setdefault(entry[2], set()).add(photoid)
+
+    def discard(self, photoid):
+        """
+        Remove a photo from the index, does nothing if the photo is unknown
+        """
+        try:
+            photoid = int(photoid)
+        except (TypeError, ValueError):
+            return
+        entry = self.photos.pop(photoid, None)
+        if entry is None:
+            return
+        for key, mapping in ((entry[0], self.albums), (entry[1], self.titles), (entry[2], self.checksums)):
+            ids = mapping.get(key)
+            if ids is not None:
+                ids.discard(photoid)
+                if not ids:
+                    del mapping[key]
+
+    def discardAlbum(self, album):
+        """
+        Remove every photo of an album from the index
+        """
+        for photoid in list(self.albums.get(self._album(album), ())):
+            self.discard(photoid)
+
+    def moveAlbum(self, oldalbum, newalbum):
+        """
+        Move every photo of an album to another album id
+        """
+        oldalbum = self._album(oldalbum)
+        newalbum = self._album(newalbum)
+        ids = self.albums.pop(oldalbum, set())
+        for photoid in ids:
+            entry = self.photos[photoid]
+            self.photos[photoid] = (newalbum, entry[1], entry[2])
+        self.albums.setdefault(newalbum, set()).update(ids)
+
+    def clear(self):
+        self.photos.clear()
+        self.titles.clear()
+        self.checksums.clear()
+        self.albums.clear()
+        self.strings.clear()
+
+    def find(self, title, checksum):
+        """
+        Returns the set of photo ids with the given title OR the given checksum
+        """
+        res = set()
+        if title is not None:
+            res.update(self.titles.get(title.lower(), ()))
+        res.update(self.checksums.get(self._checksum(checksum), ()))
+        return res
+
+    def inAlbum(self, album, photoids):
+        """
+        Returns True if one of the given photo ids belongs to album
+        """
+        return self.firstInAlbum(album, photoids) is not None
+
+    def firstInAlbum(self, album, photoids):
+        """
+        Returns one of the given photo ids belonging to album, or None
+        """
+        ids = self.albums.get(str(album), ())
+        for pid in sorted(photoids):
+            if pid in ids:
+                return pid
+        return None
+
+    def albumsOf(self, photoids):
+        """
+        Returns the album ids (as string) containing the given photo ids
+        """
+        return [self.photos[pid][0] for pid in photoids if pid in self.photos]
+
+    def idByTitle(self, title):
+        """
+        Returns the id of a photo with the given title or None
+        """
+        ids = self.titles.get(title.lower())
+        if ids:
+            return next(iter(ids))
+        return None
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import hashlib
+import json
+import os
+import sqlite3
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class LycheeManifest:
+
+    """
+    Persistent local record of the source files already imported in Lychee
+    Each entry is keyed by the source file full path and stores the file
+    size, mtime (ns), inode, checksum and the resulting lychee photo id
+    A source file whose size, mtime and inode are unchanged since the last run
+    can be skipped without being read (no hash, no exif parsing)
+    Each source directory is recorded too: its mtime (ns), its subdirectories and photo names,
+    and a digest of its subtree (see digest)
+    """
+
+    # number of recorded entries before an intermediate commit
+    commit_every = 500
+
+    def __init__(self, path):
+        """
+        Takes the manifest file path as input, the file is created if needed
+        """
+        self.path = path
+        self.pending = 0
+        dirname = os.path.dirname(self.path)
+        if dirname and not(os.path.isdir(dirname)):
+            os.makedirs(dirname)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute(
+            "create table if not exists manifest (" +
+            "path text primary key, size integer, mtime_ns integer, inode integer, " +
+            "checksum text, photoid text)")
+        self.db.execute(
+            "create table if not exists directory (" +
+            "path text primary key, mtime_ns integer, digest text, subdirs text, photos text)")
+        self.db.commit()
+        logger.debug("manifest loaded from: %s", self.path)
+
+    @staticmethod
+    def fingerprint(fullpath):
+        """
+        Returns the (size, mtime_ns, inode) tuple used to detect a file change
+        """
+        st = os.stat(fullpath)
+        mtime_ns = getattr(st, 'st_mtime_ns', None)
+        if mtime_ns is None:
+            mtime_ns = int(st.st_mtime * 1000000000)
+        return (st.st_size, mtime_ns, st.st_ino)
+
+    def lookup(self, fullpath, fingerprint):
+        """
+        Check if a source file is unchanged since it was recorded
+        Parameters:
+        - fullpath: the source file full path
+        - fingerprint: the current (size, mtime_ns, inode) of the file
+        Returns a dictionnary with keys checksum, photoid or None if the file is unknown or changed
+        """
+        cur = self.db.execute(
+            "select size, mtime_ns, inode, checksum, photoid from manifest where path=?",
+            (fullpath,))
+        row = cur.fetchone()
+        if row is None or tuple(row[0:3]) != tuple(fingerprint):
+            return None
+        return {'checksum': row[3], 'photoid': row[4]}
+
+    def record(self, fullpath, fingerprint, checksum, photoid):
+        """
+        Record (or refresh) a successfully imported source file
+        """
+        size, mtime_ns, inode = fingerprint
+        self.db.execute(
+            "insert or replace into manifest (path, size, mtime_ns, inode, checksum, photoid) " +
+            "values (?, ?, ?, ?, ?, ?)",
+            (fullpath, size, mtime_ns, inode, checksum, str(photoid)))
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def forget(self, fullpath):
+        """
+        Remove a source file from the manifest, it will be re-examined on next run
+        """
+        self.db.execute("delete from manifest where path=?", (fullpath,))
+
+    @staticmethod
+    def digest(mtime_ns, photos, children):
+        """
+        Merkle digest of a directory subtree
+        Parameters:
+        - mtime_ns: the directory mtime, it changes when an entry is added, removed or renamed in the directory
+        - photos: the sorted photo names of the directory
+        - children: the sorted (name, digest) of the subdirectories
+        Returns a hex string, unchanged as long as no directory of the subtree has changed
+        """
+        m = hashlib.sha1()
+        m.update(json.dumps([mtime_ns, photos, children]).encode('utf-8'))
+        return m.hexdigest()
+
+    def lookupDirectory(self, fullpath):
+        """
+        Returns a dictionnary with keys mtime_ns, digest, subdirs, photos or None if the directory is unknown
+        """
+        row = self.db.execute(
+            "select mtime_ns, digest, subdirs, photos from directory where path=?", (fullpath,)).fetchone()
+        if row is None:
+            return None
+        return {'mtime_ns': row[0], 'digest': row[1], 'subdirs': json.loads(row[2]), 'photos': json.loads(row[3])}
+
+    def recordDirectory(self, fullpath, mtime_ns, digest, subdirs, photos):
+        """
+        Record (or refresh) a source directory
+        mtime_ns may be None: the directory will be listed again on next run
+        """
+        self.db.execute(
+            "insert or replace into directory (path, mtime_ns, digest, subdirs, photos) values (?, ?, ?, ?, ?)",
+            (fullpath, mtime_ns, digest, json.dumps(subdirs), json.dumps(photos)))
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def forgetDirectories(self, root, seen):
+        """
+        Remove the directories under root (included) which are not in seen (removed from the source)
+        Returns the number of removed directories
+        """
+        prefix = os.path.join(root, '')
+        stale = [(path,) for (path,) in self.db.execute("select path from directory")
+                 if (path == root or path.startswith(prefix)) and path not in seen]
+        self.db.executemany("delete from directory where path=?", stale)
+        return len(stale)
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        """
+        Commit pending entries and close the manifest
+        Returns nothing
+        """
+        if self.db:
+            self.commit()
+            self.db.close()
+            self.db = None
@@ -10,21 +10,36 @@ import decimal
 from fractions import Fraction
 import os
 import mimetypes
-from PIL import Image
-from PIL.ExifTags import TAGS
 import datetime
 import logging
-from dateutil.parser import parse
+from lycheesync.utils.filehash import sha1_file, sha1_copy
+from lycheesync.utils.imagemeta import read_metadata
+from lycheesync.utils.dates import parse_date, to_timestamp
 
 logger = logging.getLogger(__name__)
 
 
-class ExifData:
+class ExifData(object):
 
     """
     Use to store ExifData
     """
 
+    __slots__ = ('iso', 'make', 'model', 'shutter', 'aperture', 'exposure', 'focal', '_takedate', 'taketime',
+                 'orientation')
+
+    def __init__(self):
+        self.iso = ""
+        self.make = ""
+        self.model = ""
+        self.shutter = None
+        self.aperture = None
+        self.exposure = None
+        self.focal = None
+        self._takedate = None
+        self.taketime = None
+        self.orientation = 1
+
     @property
     def takedate(self):
         return self._takedate
@@ -33,17 +48,6 @@ class ExifData:
     def takedate(self, value):
         self._takedate = value.replace(':', '-')
 
-    iso = ""
-    make = ""
-    model = ""
-    shutter = None
-    aperture = None
-    exposure = None
-    focal = None
-    _takedate = None
-    taketime = None
-    orientation = 1
-
     def __str__(self):
         res = ""
         res += "iso: " + str(self.iso) + "\n"
@@ -59,34 +63,17 @@ class ExifData:
         return res
 
 
-class LycheePhoto:
+class LycheePhoto(object):
 
     """
     Use to store photo data
+    Photos are kept until their album is committed: no per instance __dict__ (see __slots__)
     """
 
-    originalname = ""  # import_name
-    originalpath = ""
-    id = ""
-    albumname = ""
-    albumid = ""
-    thumbnailfullpath = ""
-    thumbnailx2fullpath = ""
-    title = ""
-    description = ""
-    url = ""
-    public = 0  # private by default
-    type = ""
-    width = 0
-    height = 0
-    size = ""
-    star = 0  # no star by default
-    thumbUrl = ""
-    srcfullpath = ""
-    destfullpath = ""
-    exif = None
-    _str_datetime = None
-    checksum = ""
+    __slots__ = ('originalname', 'originalpath', 'id', 'albumname', 'albumid', 'thumbnailfullpath',
+                 'thumbnailx2fullpath', 'title', 'description', 'url', 'public', 'type', 'width', 'height',
+                 'size', 'star', 'thumbUrl', 'srcfullpath', 'destfullpath', 'exif', '_str_datetime', 'checksum',
+                 'placed', '_epoch_sysdate', '_takestamp')
 
     def convert_strdate_to_timestamp(self, value):
         # check parameter type
@@ -107,10 +94,7 @@ class LycheePhoto:
             value = str(value)
 
             try:
-                the_date = parse(value)
-                # works for python 3
-                # timestamp = the_date.timestamp()
-                timestamp = time.mktime(the_date.timetuple())
+                timestamp = to_timestamp(parse_date(value))
 
             except Exception:
                 logger.warn('model date impossible to parse: ' + str(value))
@@ -123,24 +107,65 @@ class LycheePhoto:
 
     @property
     def epoch_sysdate(self):
-        return self.convert_strdate_to_timestamp(self._str_datetime)
+        # parsed once per photo
+        if self._epoch_sysdate is None:
+            self._epoch_sysdate = self.convert_strdate_to_timestamp(self._str_datetime)
+        return self._epoch_sysdate
 
-    # Compute checksum
-    def __generateHash(self):
-        sha1 = hashlib.sha1()
-        with open(self.srcfullpath, 'rb') as f:
-            sha1.update(f.read())
-            self.checksum = sha1.hexdigest()
+    @property
+    def takestamp(self):
+        """
+        Epoch timestamp of the exif take date and time (parsed once per photo), None if unknown
+        """
+        if self._takestamp is None and self.exif and self.exif.takedate and self.exif.taketime:
+            try:
+                self._takestamp = int(to_timestamp(parse_date(self.exif.takedate + ' ' + self.exif.taketime)))
+            except Exception:
+                pass
+        return self._takestamp
 
-    def __init__(self, id, conf, photoname, album):
+    # Compute checksum
+    def __generateHash(self, place=False):
+        if place:
+            # single read of the source: hash while copying it to lychee
+            self.checksum = sha1_copy(self.srcfullpath, self.destfullpath)
+            self.placed = True
+        else:
+            self.checksum = sha1_file(self.srcfullpath)
+
+    def __init__(self, id, conf, photoname, album, place=False):
+        """
+        Parameters:
+        - id: the photo id (14 characters)
+        - conf: the configuration dictionnary
+        - photoname: the source file name
+        - album: the album properties list (path, id and name)
+        - place: if True the source file is copied to destfullpath while being hashed,
+        size and exif data are then read from the copy
+        """
         # Parameters storage
-        self.conf = conf
         self.id = id
-        self.originalname = photoname
+        self.originalname = photoname  # import_name
         self.originalpath = album['path']
         self.albumid = album['id']
         self.albumname = album['name']
 
+        # Defaults
+        self.thumbnailfullpath = ""
+        self.thumbnailx2fullpath = ""
+        self.title = ""
+        self.description = ""
+        self.public = 0  # private by default
+        self.width = 0
+        self.height = 0
+        self.star = 0  # no star by default
+        self.exif = None
+        self._str_datetime = None
+        self._epoch_sysdate = None
+        self._takestamp = None
+        self.checksum = ""
+        self.placed = False  # file already copied to destfullpath
+
         # if star in file name, photo is starred
         if ('star' in self.originalname) or ('cover' in self.originalname):
             self.star = 1
@@ -158,10 +183,10 @@ class LycheePhoto:
 
         # src and dest fullpath
         self.srcfullpath = os.path.join(self.originalpath, self.originalname)
-        self.destfullpath = os.path.join(self.conf["lycheepath"], "uploads", "big", self.url)
+        self.destfullpath = os.path.join(conf["lycheepath"], "uploads", "big", self.url)
 
         # Generate file checksum
-        self.__generateHash()
+        self.__generateHash(place)
 
         # thumbnails already in place (see makeThumbnail)
 
@@ -178,130 +203,126 @@ class LycheePhoto:
         self.exif = ExifData()
         try:
 
-            img = Image.open(self.srcfullpath)
-            w, h = img.size
-            self.width = float(w)
-            self.height = float(h)
-
-            if hasattr(img, '_getexif'):
-                try:
-                    exifinfo = img._getexif()
-                except Exception as e:
-                    exifinfo = None
-                    logger.warn('Could not obtain exif info for image: %s', e)
-                # exifinfo = img.info['exif']
-                # logger.debug(exifinfo)
-                if exifinfo is not None:
-                    for tag, value in exifinfo.items():
-                        decode = TAGS.get(tag, tag)
-                        if decode == "Orientation":
-                            self.exif.orientation = value
-                        if decode == "Make":
-                            self.exif.make = value
-                        if decode == "MaxApertureValue":
-                            aperture = math.sqrt(2) ** value[0]
-                            try:
-                                aperture = decimal.Decimal(aperture).quantize(
-                                    decimal.Decimal('.1'),
-                                    rounding=decimal.ROUND_05UP)
-                            except Exception as e:
-                                logger.debug("aperture only a few digit after comma: {}".format(aperture))
-                                logger.debug(e)
-                            self.exif.aperture = aperture
-                        if decode == "FocalLength":
-                            self.exif.focal = value[0]
-                        if decode == "ISOSpeedRatings":
-                            self.exif.iso = value[0]
-                        if decode == "Model":
-                            self.exif.model = value
-                        if decode == "ExposureTime":
-                            self.exif.exposure = value[0]
-                        if decode == "ShutterSpeedValue":
-                            s = value[0]
-                            s = 2 ** s
-                            s = decimal.Decimal(s).quantize(decimal.Decimal('1'), rounding=decimal.ROUND_05UP)
-                            if s <= 1:
-                                s = decimal.Decimal(
-                                    1 /
-                                    float(s)).quantize(
-                                    decimal.Decimal('0.1'),
-                                    rounding=decimal.ROUND_05UP)
-                            else:
-                                s = "1/" + str(s)
-                            self.exif.shutter = str(s) + " s"
-
-                        if decode == "DateTimeOriginal":
-                            try:
-                                self.exif.takedate = value[0].split(" ")[0]
-                            except Exception as e:
-                                logger.warn('invalid takedate: ' + str(value) + ' for ' + self.srcfullpath)
-
-                        if decode == "DateTimeOriginal":
-                            try:
-                                self.exif.taketime = value[0].split(" ")[1]
-                            except Exception as e:
-                                logger.warn('invalid taketime: ' + str(value) + ' for ' + self.srcfullpath)
-
-                        if decode == "DateTime" and self.exif.takedate is None:
-                            try:
-                                self.exif.takedate = value.split(" ")[0]
-                            except Exception as e:
-                                logger.warn('DT invalid takedate: ' + str(value) + ' for ' + self.srcfullpath)
-
-                        if decode == "DateTime" and self.exif.taketime is None:
-                            try:
-                                self.exif.taketime = value.split(" ")[1]
-                            except Exception as e:
-                                logger.warn('DT invalid taketime: ' + str(value) + ' for ' + self.srcfullpath)
-
-                    # compute shutter speed
-
-                    if not(self.exif.shutter) and self.exif.exposure:
-                        if self.exif.exposure < 1:
-                            e = str(Fraction(self.exif.exposure).limit_denominator())
-                        else:
-                            e = decimal.Decimal(
-                                self.exif.exposure).quantize(
-                                decimal.Decimal('0.01'),
+            # header only read for JPEG / PNG, PIL for other formats
+            meta = read_metadata(self.destfullpath if self.placed else self.srcfullpath)
+            self.width = float(meta['width'])
+            self.height = float(meta['height'])
+
+            exifinfo = meta['exif']
+            if exifinfo is not None:
+                # values are already decoded: rationals as float, strings stripped
+                for decode, value in exifinfo.items():
+                    if decode == "Orientation":
+                        self.exif.orientation = value
+                    if decode == "Make":
+                        self.exif.make = value
+                    if decode == "MaxApertureValue":
+                        aperture = math.sqrt(2) ** value
+                        try:
+                            aperture = decimal.Decimal(aperture).quantize(
+                                decimal.Decimal('.1'),
                                 rounding=decimal.ROUND_05UP)
-                        self.exif.shutter = e
-
-                    if self.exif.shutter:
-                        self.exif.shutter = str(self.exif.shutter) + " s"
+                        except Exception as e:
+                            logger.debug("aperture only a few digit after comma: {}".format(aperture))
+                            logger.debug(e)
+                        self.exif.aperture = aperture
+                    if decode == "FocalLength":
+                        self.exif.focal = value
+                    if decode == "ISOSpeedRatings":
+                        self.exif.iso = value
+                    if decode == "Model":
+                        self.exif.model = value
+                    if decode == "ExposureTime":
+                        self.exif.exposure = value
+                    if decode == "ShutterSpeedValue":
+                        s = value
+                        s = 2 ** s
+                        s = decimal.Decimal(s).quantize(decimal.Decimal('1'), rounding=decimal.ROUND_05UP)
+                        if s <= 1:
+                            s = decimal.Decimal(
+                                1 /
+                                float(s)).quantize(
+                                decimal.Decimal('0.1'),
+                                rounding=decimal.ROUND_05UP)
+                        else:
+                            s = "1/" + str(s)
+                        # unit added below
+                        self.exif.shutter = str(s)
+
+                    if decode == "DateTimeOriginal":
+                        try:
+                            self.exif.takedate = value.split(" ")[0]
+                        except Exception as e:
+                            logger.warn('invalid takedate: ' + str(value) + ' for ' + self.srcfullpath)
+
+                    if decode == "DateTimeOriginal":
+                        try:
+                            self.exif.taketime = value.split(" ")[1]
+                        except Exception as e:
+                            logger.warn('invalid taketime: ' + str(value) + ' for ' + self.srcfullpath)
+
+                    if decode == "DateTime" and self.exif.takedate is None:
+                        try:
+                            self.exif.takedate = value.split(" ")[0]
+                        except Exception as e:
+                            logger.warn('DT invalid takedate: ' + str(value) + ' for ' + self.srcfullpath)
+
+                    if decode == "DateTime" and self.exif.taketime is None:
+                        try:
+                            self.exif.taketime = value.split(" ")[1]
+                        except Exception as e:
+                            logger.warn('DT invalid taketime: ' + str(value) + ' for ' + self.srcfullpath)
+
+                # compute shutter speed
+
+                if not(self.exif.shutter) and self.exif.exposure:
+                    if self.exif.exposure < 1:
+                        e = str(Fraction(self.exif.exposure).limit_denominator())
                     else:
-                        self.exif.shutter = ""
+                        e = decimal.Decimal(
+                            self.exif.exposure).quantize(
+                            decimal.Decimal('0.01'),
+                            rounding=decimal.ROUND_05UP)
+                    self.exif.shutter = e
 
-                    if self.exif.exposure:
-                        self.exif.exposure = str(self.exif.exposure) + " s"
-                    else:
-                        self.exif.exposure = ""
+                if self.exif.shutter:
+                    self.exif.shutter = str(self.exif.shutter) + " s"
+                else:
+                    self.exif.shutter = ""
 
-                    if self.exif.focal:
-                        self.exif.focal = str(self.exif.focal) + " mm"
-                    else:
-                        self.exif.focal = ""
+                if self.exif.exposure:
+                    self.exif.exposure = str(self.exif.exposure) + " s"
+                else:
+                    self.exif.exposure = ""
 
-                    if self.exif.aperture:
-                        self.exif.aperture = 'F' + str(self.exif.aperture)
-                    else:
-                        self.exif.aperture = ""
+                if self.exif.focal:
+                    self.exif.focal = str(self.exif.focal) + " mm"
+                else:
+                    self.exif.focal = ""
+
+                if self.exif.aperture:
+                    self.exif.aperture = 'F' + str(self.exif.aperture)
+                else:
+                    self.exif.aperture = ""
 
-                    # compute takedate / taketime
-                    if self.exif.takedate:
-                        takedate = self.exif.takedate.replace(':', '-')
-                        taketime = '00:00:00'
+                # compute takedate / taketime
+                if self.exif.takedate:
+                    takedate = self.exif.takedate.replace(':', '-')
+                    taketime = '00:00:00'
 
-                    if self.exif.taketime:
-                        taketime = self.exif.taketime
+                if self.exif.taketime:
+                    taketime = self.exif.taketime
 
-                    # add mesurement units
+                # add mesurement units
 
-                    self._str_datetime = takedate + " " + taketime
+                self._str_datetime = takedate + " " + taketime
 
-                    self.description = self._str_datetime
+                self.description = self._str_datetime
 
         except IOError as e:
             logger.debug('ioerror (corrupted ?): ' + self.srcfullpath)
+            if self.placed:
+                os.remove(self.destfullpath)
             raise e
 
     def __str__(self):
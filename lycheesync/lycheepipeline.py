@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import logging
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    # python 2
+    import Queue as queue
+
+logger = logging.getLogger(__name__)
+
+# end of stream marker
+_END = object()
+
+
+class LycheeStage:
+
+    """
+    A pipeline stage: worker threads taking items from a bounded input queue,
+    applying func and putting the result in the next stage queue
+    - func takes an item and returns the item to pass on, or None to drop it
+    - items are numbered by the pipeline, a dropped item is still passed on as a
+      tombstone so that ordered stages never wait for it
+    - an ordered stage (single worker) processes the items in their original order
+    Busy time, processed items and queue depth are recorded to spot the bottleneck
+    """
+
+    def __init__(self, name, func, workers=1, ordered=False, maxsize=16):
+        if ordered and workers != 1:
+            raise ValueError("an ordered stage has exactly one worker")
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.ordered = ordered
+        self.inqueue = queue.Queue(maxsize)
+        self.nextstage = None
+        # stats
+        self.busy = 0.0
+        self.processed = 0
+        self.dropped = 0
+        self.depthsum = 0
+        self.depthcount = 0
+        self.maxdepth = 0
+        self._lock = threading.Lock()
+        self._running = 0
+        self._threads = []
+
+    def put(self, item):
+        """
+        Put a (seq, payload) item in the stage input queue, records the queue depth
+        """
+        depth = self.inqueue.qsize()
+        with self._lock:
+            self.depthsum += depth
+            self.depthcount += 1
+            self.maxdepth = max(self.maxdepth, depth)
+        self.inqueue.put(item)
+
+    def _forward(self, item):
+        if self.nextstage is None:
+            return
+        if item is _END:
+            self.nextstage.inqueue.put(_END)
+        else:
+            self.nextstage.put(item)
+
+    def _process(self, seq, payload):
+        if payload is not None:
+            start = time.time()
+            try:
+                payload = self.func(payload)
+            except Exception as e:
+                logger.exception(e)
+                logger.error("pipeline stage %s failed on item %s", self.name, seq)
+                payload = None
+            with self._lock:
+                self.busy += time.time() - start
+                self.processed += 1
+                if payload is None:
+                    self.dropped += 1
+        self._forward((seq, payload))
+
+    def _work(self):
+        pending = {}
+        nextseq = 0
+        while True:
+            item = self.inqueue.get()
+            if item is _END:
+                # let the sibling workers see the end of stream too
+                self.inqueue.put(_END)
+                break
+            if not(self.ordered):
+                self._process(item[0], item[1])
+                continue
+            # ordered: hold early items until the missing ones arrive
+            pending[item[0]] = item[1]
+            while nextseq in pending:
+                self._process(nextseq, pending.pop(nextseq))
+                nextseq += 1
+
+        with self._lock:
+            self._running -= 1
+            last = (self._running == 0)
+        if last:
+            self._forward(_END)
+
+    def start(self):
+        self._running = self.workers
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, name="{}-{}".format(self.name, i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def join(self):
+        for t in self._threads:
+            t.join()
+
+    @property
+    def meandepth(self):
+        if self.depthcount == 0:
+            return 0.0
+        return float(self.depthsum) / self.depthcount
+
+    def report(self):
+        """
+        Log the stage stats
+        """
+        logger.info(
+            "stage %-12s workers: %s processed: %s dropped: %s busy: %.1fs queue depth: mean %.1f max %s / %s",
+            self.name, self.workers, self.processed, self.dropped, self.busy,
+            self.meandepth, self.maxdepth, self.inqueue.maxsize)
+
+
+class LycheePipeline:
+
+    """
+    Chain of LycheeStage connected by bounded queues
+    Items produced by a source iterable flow through every stage, each stage
+    working concurrently with the others: memory is capped by the queue sizes
+    whatever the number of items
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+        # the last stage output is discarded
+        for stage, nextstage in zip(stages, stages[1:]):
+            stage.nextstage = nextstage
+
+    def run(self, source):
+        """
+        Feed the pipeline with the items of source (in the calling thread) and wait for every stage to finish
+        An exception raised by the source is propagated once the pipeline is drained
+        Returns nothing
+        """
+        for stage in self.stages:
+            stage.start()
+
+        first = self.stages[0]
+        seq = 0
+        try:
+            for item in source:
+                first.put((seq, item))
+                seq += 1
+        finally:
+            # drain the pipeline, even if the source failed
+            first.inqueue.put(_END)
+            for stage in self.stages:
+                stage.join()
+
+    def report(self):
+        for stage in self.stages:
+            stage.report()
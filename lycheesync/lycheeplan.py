@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# plan operations, in the order they are applied
+# - drop_all: every album, photo and file of lychee is deleted (-d)
+# - delete_photo (id, url, album): a photo of an album replaced by -r
+# - drop_album (id, album): an album replaced by -r
+# - create_album / use_album (album, path[, id]): the album receiving the next photos
+# - add_photo (album, path): a source photo to import
+# - skip_photo (album, path): a source photo not imported
+# - skip_album (path[, album]): a source directory not imported, album is set for an unchanged album still sorted by -s
+# every entry has a reason
+OPS = ['drop_all', 'delete_photo', 'drop_album', 'create_album', 'use_album', 'add_photo', 'skip_photo', 'skip_album']
+
+
+class LycheePlan:
+
+    """
+    A sync plan: the operations of a sync run, stored as a JSON lines file (one operation per line)
+    so that it can be reviewed, edited, then applied by another run
+    Entries are written and read one at a time: a plan of any size uses constant memory
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.counts = dict((op, 0) for op in OPS)
+
+    def __enter__(self):
+        self.file = open(self.path, 'w')
+        return self
+
+    def __exit__(self, *args):
+        self.file.close()
+        self.file = None
+
+    def write(self, op, reason, **values):
+        """
+        Append an operation to the plan (the plan must be opened with a with statement)
+        Parameters:
+        - op: one of OPS
+        - reason: why this operation is planned
+        - values: the operation parameters
+        Returns nothing
+        """
+        values['op'] = op
+        values['reason'] = reason
+        self.file.write(json.dumps(values, sort_keys=True) + "\n")
+        self.counts[op] += 1
+
+    def entries(self, ops=None):
+        """
+        Read the plan operations
+        Parameters:
+        - ops: only return the operations of these types (default: every operation)
+        Returns a generator of dictionnaries (op, reason and the operation parameters)
+        """
+        with open(self.path) as f:
+            for n, line in enumerate(f):
+                line = line.strip()
+                if not(line):
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError as e:
+                    logger.error("plan %s line %s ignored: %s", self.path, n + 1, e)
+                    continue
+                if entry.get('op') not in OPS:
+                    logger.error("plan %s line %s ignored: unknown operation %s", self.path, n + 1, entry.get('op'))
+                    continue
+                if ops is None or entry['op'] in ops:
+                    yield entry
+
+    def summary(self):
+        """
+        Returns a one line description of the plan operations count
+        """
+        return ", ".join("{}: {}".format(op, self.counts[op]) for op in OPS if self.counts[op])
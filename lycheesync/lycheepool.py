@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import threading
+import time
+import pymysql
+
+logger = logging.getLogger(__name__)
+
+# client errors meaning the connection is gone: server has gone away, lost connection...
+CONNECTION_LOST = set([2006, 2013, 2014, 2045, 2055])
+
+# statements which can be replayed on a new connection without changing their result
+IDEMPOTENT = ('select', 'show', 'explain', 'set', 'update', 'delete')
+
+
+def _lost(e):
+    return isinstance(e, (pymysql.err.OperationalError, pymysql.err.InterfaceError)) and \
+        (not(e.args) or e.args[0] in CONNECTION_LOST)
+
+
+class RetryCursorMixin(object):
+
+    """
+    Cursor reconnecting and running a statement again when the connection was lost
+    Only idempotent statements out of an explicit transaction are retried
+    (the uncommitted statements of a transaction are lost with the connection)
+    """
+
+    def execute(self, query, args=None):
+        try:
+            return super(RetryCursorMixin, self).execute(query, args)
+        except Exception as e:
+            conn = self.connection
+            if not(_lost(e)) or getattr(conn, 'intransaction', False) or \
+                    not(query.lstrip().lower().startswith(IDEMPOTENT)):
+                raise
+            logger.warn("lost db connection (%s), reconnecting", e)
+            conn.ping(reconnect=True)
+            return super(RetryCursorMixin, self).execute(query, args)
+
+
+class RetryDictCursor(RetryCursorMixin, pymysql.cursors.DictCursor):
+    pass
+
+
+class RetrySSCursor(RetryCursorMixin, pymysql.cursors.SSCursor):
+    pass
+
+
+class LycheeConnection(pymysql.connections.Connection):
+
+    """
+    Autocommit connection keeping track of the explicit transactions (begin / commit / rollback)
+    """
+
+    intransaction = False
+    lastused = 0
+
+    def begin(self):
+        super(LycheeConnection, self).begin()
+        self.intransaction = True
+
+    def commit(self):
+        self.intransaction = False
+        super(LycheeConnection, self).commit()
+
+    def rollback(self):
+        self.intransaction = False
+        try:
+            super(LycheeConnection, self).rollback()
+        except Exception as e:
+            if not(_lost(e)):
+                raise
+            # the server rolls back the transaction of a lost connection
+            logger.warn("lost db connection during rollback (%s)", e)
+
+
+def connect(conf):
+    """
+    Open a connection to lychee db
+    Statements are autocommitted unless a transaction is started with begin()
+    Parameters:
+    - conf: the configuration dictionnary (db* keys)
+    Returns a LycheeConnection using dictionnary cursors
+    """
+    params = dict(host=conf['dbHost'],
+                  user=conf['dbUser'],
+                  passwd=conf['dbPassword'],
+                  db=conf['db'],
+                  charset='utf8mb4',
+                  autocommit=True,
+                  # replayed by each reconnection
+                  init_command="set names utf8",
+                  cursorclass=RetryDictCursor)
+    if 'dbSocket' in conf:
+        logger.debug("Connection to db in SOCKET mode")
+        params['unix_socket'] = conf['dbSocket']
+    else:
+        logger.debug("Connection to db in NO SOCKET mode")
+    return LycheeConnection(**params)
+
+
+class LycheeConnectionPool:
+
+    """
+    Lychee db connections, one per thread: each worker uses its own connection,
+    opened on its first use and kept until closeAll
+    A connection idle for more than pingafter seconds is checked (and reopened if needed) before reuse,
+    so a long run survives the server wait_timeout
+    """
+
+    def __init__(self, conf, pingafter=30):
+        """
+        Parameters:
+        - conf: the configuration dictionnary (db* keys)
+        - pingafter: idle time in seconds after which a connection is checked before reuse
+        """
+        self.conf = conf
+        self.pingafter = pingafter
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def get(self):
+        """
+        Returns the connection of the calling thread
+        """
+        conn = getattr(self.local, 'connection', None)
+        now = time.time()
+        if conn is None or not(conn.open):
+            conn = connect(self.conf)
+            self.local.connection = conn
+            with self.lock:
+                self.connections.append(conn)
+            logger.debug("db connection opened for thread %s (%s open)",
+                         threading.current_thread().name, len(self.connections))
+        elif now - conn.lastused > self.pingafter and not(conn.intransaction):
+            conn.ping(reconnect=True)
+        conn.lastused = now
+        return conn
+
+    def closeAll(self):
+        """
+        Close every connection of the pool
+        Returns nothing
+        """
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+        for conn in connections:
+            try:
+                if conn.open:
+                    conn.close()
+            except Exception as e:
+                logger.debug(e)
+        self.local = threading.local()
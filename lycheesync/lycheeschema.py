@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import logging
+
+logger = logging.getLogger(__name__)
+
+# indexes needed by the lookups lycheesync runs: name -> (table, columns)
+# they are covering: every column read by the lookup is in the index, the table rows are not read
+INDEXES = [
+    ('lycheesync_album', 'lychee_photos', ['album', 'id', 'url']),
+    ('lycheesync_checksum', 'lychee_photos', ['checksum', 'id', 'album']),
+    ('lycheesync_title', 'lychee_photos', ['title', 'id', 'album']),
+    ('lycheesync_title', 'lychee_albums', ['title', 'id']),
+]
+
+# lookups run by lycheesync ({album} is replaced by an existing album id, {title} and {checksum} by sample values)
+QUERIES = [
+    ('photos of an album', "select id, url from lychee_photos where album = '{album}'"),
+    ('photo by checksum', "select id, album from lychee_photos where checksum = '{checksum}'"),
+    ('photo by title', "select id, album from lychee_photos where title = '{title}'"),
+    ('empty albums', "select a.id from lychee_albums a left join lychee_photos p "
+                     "on p.album = cast(a.id as char) where p.id is null"),
+    ('album by title', "select id from lychee_albums where title = '{title}'"),
+]
+
+# expected column types, the album column of lychee_photos holds lychee_albums ids
+COLUMNS = [
+    ('lychee_photos', 'album', 'lychee_albums', 'id'),
+]
+
+
+class LycheeSchemaOptimizer:
+
+    """
+    Checks lychee db schema and adds the indexes used by lycheesync lookups
+    Lychee schema only has primary keys: without these indexes every lookup
+    by album, checksum or title is a full table scan
+    """
+
+    def __init__(self, db):
+        """
+        Parameters:
+        - db: a pymysql connection using dictionnary cursors
+        """
+        self.db = db
+
+    def getIndexes(self, table):
+        """
+        Returns the indexes of a table as a {index name: [columns]} dictionnary
+        """
+        res = {}
+        cur = self.db.cursor()
+        cur.execute("show index from " + table)
+        for row in cur.fetchall():
+            res.setdefault(row['Key_name'], []).append((row['Seq_in_index'], row['Column_name']))
+        return dict((name, [c for i, c in sorted(cols)]) for name, cols in res.items())
+
+    def getColumnType(self, table, column):
+        cur = self.db.cursor()
+        cur.execute("show columns from " + table + " where Field=%s", (column,))
+        row = cur.fetchone()
+        return row['Type'] if row else None
+
+    def checkColumns(self):
+        """
+        Log a warning for each pair of joined columns not sharing the same type
+        (the db converts one of them for each compared row and can't use its index)
+        Returns the list of mismatching (table, column, type, other table, other column, other type)
+        """
+        res = []
+        for table, column, other, othercolumn in COLUMNS:
+            kind = self.getColumnType(table, column)
+            otherkind = self.getColumnType(other, othercolumn)
+            if kind and otherkind and kind.split('(')[0] != otherkind.split('(')[0]:
+                logger.warn("%s.%s is a %s while %s.%s is a %s: lycheesync compares them as strings",
+                            table, column, kind, other, othercolumn, otherkind)
+                res.append((table, column, kind, other, othercolumn, otherkind))
+        return res
+
+    def missingIndexes(self):
+        """
+        Returns the INDEXES entries not covered by an existing index (same leading columns)
+        """
+        res = []
+        existing = {}
+        for name, table, columns in INDEXES:
+            if table not in existing:
+                existing[table] = self.getIndexes(table)
+            covered = [n for n, cols in existing[table].items() if cols[:len(columns)] == columns]
+            if covered:
+                logger.info("%s(%s) already indexed by %s", table, ', '.join(columns), covered[0])
+            else:
+                res.append((name, table, columns))
+        return res
+
+    def sampleValues(self):
+        cur = self.db.cursor()
+        cur.execute("select album, title, checksum from lychee_photos limit 1")
+        row = cur.fetchone() or {}
+        return {'album': row.get('album') or '0', 'title': row.get('title') or '', 'checksum': row.get('checksum') or ''}
+
+    def explain(self, values):
+        """
+        Run EXPLAIN on each lycheesync lookup
+        Returns a {lookup name: [explain rows]} dictionnary
+        """
+        res = {}
+        cur = self.db.cursor()
+        for name, query in QUERIES:
+            cur.execute("explain " + query.format(**dict((k, self.db.escape_string(v)) for k, v in values.items())))
+            res[name] = cur.fetchall()
+        return res
+
+    @staticmethod
+    def logExplain(title, plans):
+        logger.info("---- %s", title)
+        for name, query in QUERIES:
+            for row in plans[name]:
+                logger.info("%-20s table: %-8s type: %-6s key: %-20s rows: %-8s extra: %s",
+                            name, row.get('table'), row.get('type'), row.get('key'), row.get('rows'), row.get('Extra'))
+
+    def optimize(self):
+        """
+        Check the schema, add the missing indexes and log the EXPLAIN of each lookup before and after
+        Returns the list of created index names
+        """
+        self.checkColumns()
+        values = self.sampleValues()
+        before = self.explain(values)
+        self.logExplain("before", before)
+
+        created = []
+        cur = self.db.cursor()
+        for name, table, columns in self.missingIndexes():
+            logger.info("adding index %s on %s(%s)", name, table, ', '.join(columns))
+            cur.execute("alter table " + table + " add index " + name + " (" + ', '.join(columns) + ")")
+            created.append(name)
+        self.db.commit()
+
+        if created:
+            after = self.explain(values)
+            self.logExplain("after", after)
+            for name, query in QUERIES:
+                old = sum(int(r.get('rows') or 0) for r in before[name])
+                new = sum(int(r.get('rows') or 0) for r in after[name])
+                logger.info("%-20s examined rows: %s -> %s", name, old, new)
+        else:
+            logger.info("schema already optimized, nothing to do")
+        return created
@@ -2,19 +2,29 @@
 
 from __future__ import unicode_literals
 from __future__ import print_function
+import bisect
 import os
-import shutil
 import stat
 from lycheesync.lycheedao import LycheeDAO
 from lycheesync.lycheemodel import LycheePhoto
+from lycheesync.lycheemanifest import LycheeManifest
+from lycheesync.lycheepipeline import LycheePipeline, LycheeStage
+from lycheesync.lycheeplan import LycheePlan
 from lycheesync.utils.configuration import ConfBorg
+from lycheesync.utils.placement import FilePlacer, MODES as PLACEMENT_MODES
+from lycheesync.utils.blobstore import BlobStore
+from lycheesync.utils.orientation import TRANSPOSE, transpose_image, jpegtran_rotate
 from PIL import Image
+from PIL import JpegImagePlugin
 import datetime
 import time
 import sys
+import tempfile
 import logging
 import piexif
 import fnmatch
+import math
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +37,27 @@ def remove_file(path):
         logger.debug(e)
 
 
+def list_files(path):
+    """
+    List a directory with a single scandir call (no stat for regular files)
+    Returns a {file name: True if it is a file or a link to a file, False for a broken link} dictionnary
+    """
+    res = {}
+    if not(os.path.isdir(path)):
+        return res
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(path):
+            # is_file follows symlinks: False for a broken link
+            if entry.is_file() or entry.is_symlink():
+                res[entry.name] = entry.is_file()
+    else:
+        for name in os.listdir(path):
+            fullpath = os.path.join(path, name)
+            if os.path.isfile(fullpath) or os.path.islink(fullpath):
+                res[name] = os.path.isfile(fullpath)
+    return res
+
+
 class LycheeSyncer:
 
     """
@@ -38,6 +69,8 @@ class LycheeSyncer:
     """
 
     conf = {}
+    manifest = None
+    store = None
 
     def __init__(self):
         """
@@ -45,6 +78,24 @@ class LycheeSyncer:
         """
         borg = ConfBorg()
         self.conf = borg.conf
+        self.placer = FilePlacer(self.placementModes())
+
+    def placementModes(self):
+        """
+        Returns the file placement modes to try, from the placement conf key ("auto" or a list of modes)
+        Hardlinks are used only with losslessRotation: the default rotation rewrites the big file,
+        which would modify the source photo through the link
+        """
+        modes = self.conf.get('placement', 'auto')
+        if modes == 'auto':
+            modes = list(PLACEMENT_MODES)
+        elif not(isinstance(modes, list)):
+            modes = [modes]
+        if 'hardlink' in modes and not(self.conf.get('losslessRotation')):
+            if self.conf.get('placement', 'auto') != 'auto':
+                logger.warn("hardlink placement ignored: without losslessRotation it would modify the source photos")
+            modes = [m for m in modes if m != 'hardlink']
+        return modes
 
     def getAlbumNameFromPath(self, album):
         """
@@ -80,6 +131,20 @@ class LycheeSyncer:
         Returns an albumid or None if album does not exists
         """
 
+    def isUnchanged(self, srcfullpath, fingerprint):
+        """
+        Check in the manifest if a source file has already been imported and is unchanged since
+        Parameters:
+        - srcfullpath: the source file full path
+        - fingerprint: the (size, mtime_ns, inode) tuple of the source file
+        Returns a boolean
+        """
+        if not(self.manifest):
+            return False
+        entry = self.manifest.lookup(srcfullpath, fingerprint)
+        # the photo may have been removed from lychee since, check it's still in db
+        return entry is not None and entry['photoid'] in self.dao.photoindex
+
     def createAlbum(self, album):
         """
         Creates an album
@@ -92,7 +157,54 @@ class LycheeSyncer:
             album['id'] = self.dao.createAlbum(album)
         return album['id']
 
-    def thumbIt(self, res, photo, destinationpath, destfile):
+    def squareThumbnail(self, res, img):
+        """
+        Crop the centered square of an image and downsample it to res
+        An image already square and small enough is returned as is
+        Parameters:
+        - res: should be a set of h and v res (200, 200)
+        - img: a PIL image
+        Returns a PIL image
+        """
+        width, height = img.size
+        if width != height:
+            side = min(width, height)
+            left = int((width - side) / 2)
+            upper = int((height - side) / 2)
+            img = img.crop((left, upper, left + side, upper + side))
+        if img.size[0] > res[0]:
+            img = img.resize(res, Image.ANTIALIAS)
+        return img
+
+    def reduceForThumbnail(self, res, img):
+        """
+        Decode an image at a reduced resolution, still big enough to make a res thumbnail of its centered square
+        - JPEG not decoded yet: DCT scaling (Image.draft), decoding at 1/2, 1/4 or 1/8 of the size
+        - other images: Image.reduce by an integer factor
+        Parameters:
+        - res: the biggest thumbnail resolution (400, 400)
+        - img: a PIL image
+        Returns a PIL image
+        """
+        width, height = img.size
+        side = min(width, height)
+        if side < 2 * res[0]:
+            # no reduction possible
+            return img
+
+        if isinstance(img, JpegImagePlugin.JpegImageFile) and img.tile:
+            # smallest DCT scale whose centered square still covers res
+            img.draft(img.mode, (int(math.ceil(width * res[0] / float(side))),
+                                 int(math.ceil(height * res[1] / float(side)))))
+        elif hasattr(img, 'reduce'):
+            try:
+                img = img.reduce(int(side / res[0]))
+            except ValueError:
+                # mode not supported by reduce (palette...)
+                pass
+        return img
+
+    def thumbIt(self, res, photo, destinationpath, destfile, img=None):
         """
         Create the thumbnail of a given photo
         Parameters:
@@ -100,43 +212,42 @@ class LycheeSyncer:
         - photo: a valid LycheePhoto object
         - destinationpath: a string the destination full path of the thumbnail (without filename)
         - destfile: the thumbnail filename
+        - img: the already opened PIL image of the photo (opened from photo.destfullpath if None)
         Returns the fullpath of the thuumbnail
         """
+        destimage = os.path.join(destinationpath, destfile)
+        if img is None:
+            img = self.openImage(photo)
 
-        if photo.width > photo.height:
-            delta = photo.width - photo.height
-            left = int(delta / 2)
-            upper = 0
-            right = int(photo.height + left)
-            lower = int(photo.height)
-        else:
-            delta = photo.height - photo.width
-            left = 0
-            upper = int(delta / 2)
-            right = int(photo.width)
-            lower = int(photo.width + upper)
+        img = self.squareThumbnail(res, img)
+        img.save(destimage, quality=int(self.conf.get('thumbQuality', 99)))
+        return destimage
 
-        destimage = os.path.join(destinationpath, destfile)
+    def openImage(self, photo):
+        """
+        Open the lychee copy of a photo
+        Parameters:
+        - photo: a valid LycheePhoto object
+        Returns a PIL image
+        """
         try:
-            img = Image.open(photo.destfullpath)
+            return Image.open(photo.destfullpath)
         except Exception as e:
             logger.exception(e)
             logger.error("ioerror (corrupted file?): " + photo.srcfullpath)
             raise
 
-        img = img.crop((left, upper, right, lower))
-        img.thumbnail(res, Image.ANTIALIAS)
-        img.save(destimage, quality=99)
-        return destimage
-
-    def makeThumbnail(self, photo):
+    def makeThumbnail(self, photo, img=None):
         """
         Make the 2 thumbnails needed by Lychee for a given photo
         and store their path in the LycheePhoto object
         Parameters:
         - photo: a valid LycheePhoto object
+        - img: the already opened PIL image of the photo, decoded only once for both thumbnails
         returns nothing
         """
+        if img is None:
+            img = self.openImage(photo)
         # set  thumbnail size
         sizes = [(200, 200), (400, 400)]
         # insert @2x in big thumbnail file name
@@ -144,13 +255,21 @@ class LycheeSyncer:
         destfiles = [photo.url, ''.join([filesplit[0], "@2x", filesplit[1]]).lower()]
         # compute destination path
         destpath = os.path.join(self.conf["lycheepath"], "uploads", "thumb")
-        # make thumbnails
-        photo.thumbnailfullpath = self.thumbIt(sizes[0], photo, destpath, destfiles[0])
-        photo.thumbnailx2fullpath = self.thumbIt(sizes[1], photo, destpath, destfiles[1])
+        # decode and crop once: make the @2x thumbnail, then derive the 1x one from it
+        img = self.reduceForThumbnail(sizes[1], img)
+        if self.conf.get('losslessRotation'):
+            # the big file has not been rotated, rotate the reduced image only
+            img = transpose_image(img, photo.exif.orientation)
+        img = self.squareThumbnail(sizes[1], img)
+        photo.thumbnailx2fullpath = self.thumbIt(sizes[1], photo, destpath, destfiles[1], img)
+        photo.thumbnailfullpath = self.thumbIt(sizes[0], photo, destpath, destfiles[0], img)
 
     def copyFileToLychee(self, photo):
         """
         add a file to an album, the albumid must be previously stored in the LycheePhoto parameter
+        The copy is skipped if the file has already been placed while being hashed,
+        otherwise it is done with the fastest mode supported by the filesystems (see FilePlacer)
+        Permissions are fixed later, see fixPermissions
         Parameters:
         - photo: a valid LycheePhoto object
         Returns True if everything went ok
@@ -161,10 +280,32 @@ class LycheeSyncer:
             # copy photo
             if self.conf['link']:
                 os.symlink(photo.srcfullpath, photo.destfullpath)
-            else:
-                shutil.copy(photo.srcfullpath, photo.destfullpath)
-            # adjust right (chmod/chown)
+            elif not(photo.placed):
+                mode = self.placer.place(photo.srcfullpath, photo.destfullpath)
+                logger.debug("%s placed with mode: %s", photo.destfullpath, mode)
+            res = True
+
+        except Exception as e:
+            logger.exception(e)
+            res = False
+
+        return res
+
+    def fixPermissions(self, photos):
+        """
+        Adjust rights (chgrp / chmod) of placed photos in a single pass
+        In link mode the source photos are made readable by others instead
+        Hardlinked photos are left as is: their rights are the ones of the source photo
+        Parameters:
+        - photos: a list of valid LycheePhoto objects
+        Returns nothing
+        """
+        failed = []
+        for photo in photos:
             try:
+                if not(self.conf['link']) and os.path.samefile(photo.srcfullpath, photo.destfullpath):
+                    logger.debug("hardlinked, permissions left unchanged: %s", photo.destfullpath)
+                    continue
                 os.lchown(photo.destfullpath, -1, self.conf['gid'])
 
                 if not(self.conf['link']):
@@ -175,17 +316,11 @@ class LycheeSyncer:
                     os.chmod(photo.srcfullpath, st.st_mode | stat.S_IROTH)
 
             except Exception as e:
-                if self.conf["verbose"]:
-                    logger.warn(
-                        "chgrp error,  check file permission for %s fix: eventually adjust source file permissions",
-                        photo.destfullpath)
-            res = True
-
-        except Exception as e:
-            logger.exception(e)
-            res = False
-
-        return res
+                failed.append(photo.destfullpath)
+        if failed and self.conf["verbose"]:
+            logger.warn(
+                "chgrp error,  check file permission for %s fix: eventually adjust source file permissions",
+                ", ".join(failed))
 
     def deleteFiles(self, filelist):
         """
@@ -206,16 +341,26 @@ class LycheeSyncer:
                 remove_file(thumbpath)
                 remove_file(thumb2path)
                 remove_file(bigpath)
+        if self.store:
+            # some blobs may be unused now, see BlobStore.collect
+            self.store.dirty = True
 
-    def adjustRotation(self, photo):
+    def adjustRotation(self, photo, img=None):
         """
         Rotates photos according to the exif orientaion tag
-        Returns nothing DOIT BEFORE THUMBNAILS !!!
+        Parameters:
+        - photo: a valid LycheePhoto object
+        - img: the already opened PIL image of the photo (opened from photo.destfullpath if None)
+        Returns the rotated image, to be reused for thumbnails DOIT BEFORE THUMBNAILS !!!
         """
+        if img is None:
+            img = self.openImage(photo)
+
+        if self.conf.get('losslessRotation'):
+            return self.adjustRotationLossless(photo, img)
 
         if photo.exif.orientation != 1:
 
-            img = Image.open(photo.destfullpath)
             if "exif" in img.info:
                 exif_dict = piexif.load(img.info["exif"])
 
@@ -249,54 +394,180 @@ class LycheeSyncer:
                     exif_dict["0th"][piexif.ImageIFD.Orientation] = 1
                     exif_bytes = piexif.dump(exif_dict)
                     img.save(photo.destfullpath, exif=exif_bytes, quality=99)
-            img.close()
+        return img
+
+    def adjustRotationLossless(self, photo, img):
+        """
+        adjustRotation without decoding nor re-encoding the big file:
+        - in link mode the big file (the source photo itself) is never modified
+        - otherwise its JPEG blocks are losslessly transposed by jpegtran if it is installed,
+          if not the file is left untouched with its orientation tag (honoured by browsers)
+        The rotation is applied to the thumbnails only, see makeThumbnail
+        Parameters:
+        - photo: a valid LycheePhoto object
+        - img: the opened PIL image of the photo
+        Returns img, not rotated
+        """
+        orientation = photo.exif.orientation
+        if orientation in [5, 6, 7, 8]:
+            # invert width and height
+            photo.width, photo.height = photo.height, photo.width
+        elif orientation != 1 and orientation not in TRANSPOSE:
+            logger.warn("Orientation not defined {} for photo {}".format(orientation, photo.title))
+
+        if orientation != 1 and not(self.conf['link']) and isinstance(img, JpegImagePlugin.JpegImageFile):
+            if jpegtran_rotate(photo.destfullpath, orientation):
+                logger.debug("losslessly rotated: %s", photo.destfullpath)
+        return img
+
+    @staticmethod
+    def sortedAlbumIds(ids):
+        """
+        Find the albums which can keep their id when album ids must follow a given order
+        Parameters:
+        - ids: the album ids, in the wanted order
+        Returns the set of the positions in ids forming the longest increasing sequence of ids
+        """
+        # patience sorting: tails[k] is the position ending the best increasing sequence of length k + 1
+        tails = []
+        tailids = []
+        previous = [None] * len(ids)
+        for i, albumid in enumerate(ids):
+            k = bisect.bisect_left(tailids, albumid)
+            previous[i] = tails[k - 1] if k > 0 else None
+            if k == len(tails):
+                tails.append(i)
+                tailids.append(albumid)
+            else:
+                tails[k] = i
+                tailids[k] = albumid
+        res = set()
+        i = tails[-1] if tails else None
+        while i is not None:
+            res.add(i)
+            i = previous[i]
+        return res
+
+    @staticmethod
+    def spreadIds(low, high, count, used):
+        """
+        Choose evenly spaced ids between two album ids, leaving gaps for the albums inserted later
+        Parameters:
+        - low, high: the ids around the new ones (excluded)
+        - count: the number of ids to choose
+        - used: the ids that can't be given
+        Returns the sorted list of ids, None if there is not enough room between low and high
+        """
+        step = (high - low) // (count + 1)
+        if step < 1:
+            return None
+        res = []
+        for k in range(1, count + 1):
+            newid = low + step * k
+            # a used id is replaced by the next free one in its slot
+            while newid in used:
+                newid += 1
+            if newid >= low + step * (k + 1) or newid >= high:
+                return None
+            res.append(newid)
+        return res
 
     def reorderalbumids(self, albums):
+        """
+        Change album ids so that they follow the album names order (lychee displays albums by id)
+        Only the albums out of order get a new id, spread between the ids of their sorted neighbours
+        so that an album inserted later finds a free id too: the neighbours move only when there is
+        no room left between them. All the moves are written at once.
+        Nothing is written if the albums are already sorted
+        Parameters:
+        - albums: a list of album dictionnaries with id and name keys
+        Returns the list of (old id, new id) moves
+        """
 
         # sort albums by title
         def getName(album):
             return album['name']
 
         sortedalbums = sorted(albums, key=getName)
-
-        # count albums
-        nbalbum = len(albums)
-        # get higher album id + 1 as a first new album id
-        min, max = self.dao.getAlbumMinMaxIds()
-
-        if min and max:
-
-            if nbalbum + 1 < min:
-                newid = 1
-            else:
-                newid = max + 1
-
-            for a in sortedalbums:
-                self.dao.changeAlbumId(a['id'], newid)
-                newid = newid + 1
+        ids = [int(a['id']) for a in sortedalbums]
+        kept = self.sortedAlbumIds(ids)
+
+        # ids that can't be given: every album id in db
+        used = set(int(i) for i in self.dao.albumslist.values()) | set(ids)
+        # upper bound of the albums after the last kept one, allocated only if needed
+        ceiling = None
+
+        moves = []
+        previous = 0
+        i = 0
+        while i < len(sortedalbums):
+            if i in kept:
+                previous = ids[i]
+                i += 1
+                continue
+            # the albums to move go up to the next kept album
+            j = i
+            while j < len(sortedalbums) and j not in kept:
+                j += 1
+            while True:
+                if j < len(sortedalbums):
+                    high = ids[j]
+                else:
+                    if ceiling is None:
+                        ceiling = int(self.dao.getUniqAlbumId())
+                    high = ceiling
+                newids = self.spreadIds(previous, high, j - i, used)
+                if newids is not None or j == len(sortedalbums):
+                    break
+                # no room left: the next kept album moves too, with the albums up to the following one
+                j += 1
+                while j < len(sortedalbums) and j not in kept:
+                    j += 1
+            if newids is None:
+                newids = [int(self.dao.getUniqAlbumId()) for a in sortedalbums[i:j]]
+            for a, newid in zip(sortedalbums[i:j], newids):
+                used.add(newid)
+                moves.append((a['id'], newid))
+            previous = newids[-1]
+            i = j
+
+        if moves:
+            logger.info("%s albums out of order over %s, changing their ids", len(moves), len(sortedalbums))
+            if self.dao.moveAlbums(moves):
+                self.dao.reinitAlbumAutoIncrement()
+        else:
+            logger.debug("albums already sorted by name")
+        return moves
 
     def updateAlbumsDate(self, albums):
-        now = datetime.datetime.now()
-        last2min = now - datetime.timedelta(minutes=2)
-        last2min_epoch = int((last2min - datetime.datetime(1970, 1, 1)).total_seconds())
+        """
+        Set the album dates to the most recent date of their photos
+        The albumDateMode conf key chooses the photos taken into account:
+        - "imported" (default): the photos imported by this run (see commitAlbum)
+        - "touched": every photo in db of the albums of this run
+        - "all": every photo in db, for every album
+        In the last two modes the dates are computed by the db from the photos takestamp in a single statement.
+        Photos dated less than 2 minutes before their import are ignored (their date is probably the import date)
+        Parameters:
+        - albums: a list of album dictionnaries with id, name and maxdate keys
+        Returns nothing
+        """
+        mode = self.conf.get('albumDateMode', 'imported')
+        if mode in ('touched', 'all'):
+            album_ids = None if mode == 'all' else [a['id'] for a in albums]
+            updated = self.dao.updateAlbumsDateFromPhotos(album_ids, 120)
+            logger.debug("%s albums sysstamp changed", updated)
+            return
 
         for a in albums:
             try:
-                # get photos with a real date (not just now)
-                datelist = None
-
-                if len(a['photos']) > 0:
-
-                    datelist = [
-                        photo.epoch_sysdate for photo in a['photos'] if photo.epoch_sysdate < last2min_epoch]
-
-                    if datelist is not None and len(datelist) > 0:
-                        newdate = max(datelist)
-                        self.dao.updateAlbumDate(a['id'], newdate)
-                        logger.debug(
-                            "album %s sysstamp changed to: %s ", a['name'], str(
-                                time.strftime(
-                                    '%Y-%m-%d %H:%M:%S', time.localtime(newdate))))
+                newdate = a['maxdate']
+                if newdate is not None:
+                    self.dao.updateAlbumDate(a['id'], newdate)
+                    logger.debug(
+                        "album %s sysstamp changed to: %s ", a['name'], str(
+                            time.strftime(
+                                '%Y-%m-%d %H:%M:%S', time.localtime(newdate))))
             except Exception as e:
                 logger.exception(e)
                 logger.error("updating album date for album:" + a['name'], e)
@@ -316,241 +587,708 @@ class LycheeSyncer:
         if len(photo_list) > 0:
             url_list = [p['url'] for p in photo_list]
             self.deleteFiles(url_list)
-            for p in photo_list:
-                self.dao.dropPhoto(p['id'])
+            self.dao.dropPhotos([p['id'] for p in photo_list])
 
-    def sync(self):
+    def sanityCheck(self):
         """
-        Program main loop
-        Scans files to add in the sourcedirectory and add them to Lychee
-        according to the conf file and given parameters
+        Reconcile lychee db with lychee files, db and file tree are each read once:
+        - photos of a missing album are removed
+        - photos with a missing (or broken link) big file or thumbnail are removed
+          (they will be imported again by the next run), a missing @2x thumbnail is only reported
+        - files (and links) in uploads/big and uploads/thumb not used by a photo are removed
+        - empty albums are removed
         Returns nothing
         """
+        logger.info("************ SANITY CHECK *************")
+        bigdir = os.path.join(self.conf["lycheepath"], "uploads", "big")
+        thumbdir = os.path.join(self.conf["lycheepath"], "uploads", "thumb")
+
+        bigfiles = list_files(bigdir)
+        thumbfiles = list_files(thumbdir)
+
+        # photos are streamed: only the ids to drop and the used file names are kept
+        to_drop = []
+        usedbig = set()
+        usedthumb = set()
+        used_albums = set()
+        try:
+            albumids = set(str(album_id) for album_id, title in self.dao.iterAlbums())
+            for photo_id, url, thumburl, album in self.dao.iterPhotos():
+                thumbs = self.thumbnailNames(thumburl or url)
+                if str(album) not in albumids:
+                    logger.error("Album %s does not exist: photo %s will be deleted in db", album, url)
+                elif not(bigfiles.get(url)):
+                    if url in bigfiles:
+                        logger.error("Link is broken: %s will be delete in db", os.path.join(bigdir, url))
+                    else:
+                        logger.error("File does not exists %s: will be delete in db", os.path.join(bigdir, url))
+                elif not(thumbfiles.get(thumbs[0])):
+                    logger.error("Thumbnail does not exists for %s: will be delete in db", os.path.join(bigdir, url))
+                else:
+                    # older lychee versions (or thumbnail settings) do not make the @2x thumbnail
+                    if not(thumbfiles.get(thumbs[1])):
+                        logger.warn("@2x thumbnail does not exists for %s", os.path.join(bigdir, url))
+                    usedbig.add(url)
+                    usedthumb.update(thumbs)
+                    used_albums.add(str(album))
+                    continue
+                to_drop.append(photo_id)
+        except Exception as e:
+            # every file would look like an orphan
+            logger.exception(e)
+            logger.error("sanity check skipped: could not read lychee db")
+            return
+        self.dao.dropPhotos(to_drop)
+
+        # every file not used by a remaining photo is an orphan, including the files of the dropped photos
+        orphans = [os.path.join(bigdir, f) for f in bigfiles if f not in usedbig and self.isAPhoto(f)]
+        orphans += [os.path.join(thumbdir, f) for f in thumbfiles if f not in usedthumb and self.isAPhoto(f)]
+        for path in orphans:
+            remove_file(path)
+            logger.info("%s deleted. Wasn't used by any photo in DB", path)
+        if orphans and self.store:
+            # some blobs may be unused now, see BlobStore.collect
+            self.store.dirty = True
+
+        # drop empty albums
+        self.dao.dropAlbums([a for a in albumids if a not in used_albums])
+        logger.info("sanity check: %s photos, %s files and %s albums removed",
+                    len(to_drop), len(orphans), len(albumids - used_albums))
+
+    @staticmethod
+    def thumbnailNames(thumburl):
+        """
+        Returns the names of the 2 thumbnails of a photo: thumburl and its @2x version
+        """
+        filesplit = os.path.splitext(thumburl)
+        return [thumburl, ''.join([filesplit[0], "@2x", filesplit[1]]).lower()]
 
-        # Connect db
-        # and drop it if dropdb activated
-        self.dao = LycheeDAO(self.conf)
+    def listDirectory(self, path):
+        """
+        List a source directory with a single scandir call
+        Links to directories are not followed (as os.walk does)
+        Returns the sorted subdirectory names and the sorted photo names
+        """
+        subdirs = []
+        photos = []
+        if hasattr(os, 'scandir'):
+            for entry in os.scandir(path):
+                if entry.is_dir():
+                    if not(entry.is_symlink()):
+                        subdirs.append(entry.name)
+                elif self.isAPhoto(entry.name):
+                    photos.append(entry.name)
+        else:
+            for name in os.listdir(path):
+                fullpath = os.path.join(path, name)
+                if os.path.isdir(fullpath):
+                    if not(os.path.islink(fullpath)):
+                        subdirs.append(name)
+                elif self.isAPhoto(name):
+                    photos.append(name)
+        return sorted(subdirs), sorted(photos)
+
+    def scanSource(self):
+        """
+        Walk the srcdir and compute the digest of each directory subtree (see LycheeManifest.digest)
+        With a manifest, a directory whose mtime is unchanged since last run is not listed again:
+        its subdirectories and photo names are read from the manifest, it only costs a stat
+        Returns a list of directories (dictionnaries with keys path, mtime_ns, subdirs, photos,
+        digest and the previous run digest olddigest), parents before their subdirectories
+        """
+        tree = {}
+        order = []
+        stack = [self.conf['srcdir']]
+        while stack:
+            path = stack.pop()
+            try:
+                mtime_ns = LycheeManifest.fingerprint(path)[1]
+                known = self.manifest.lookupDirectory(path) if self.manifest else None
+                if known is not None and known['mtime_ns'] == mtime_ns:
+                    subdirs, photos = known['subdirs'], known['photos']
+                else:
+                    subdirs, photos = self.listDirectory(path)
+            except Exception as e:
+                logger.error("could not list %s: %s", path, e)
+                continue
+            tree[path] = {'path': path, 'mtime_ns': mtime_ns, 'subdirs': subdirs, 'photos': photos,
+                          'olddigest': known['digest'] if known else None}
+            order.append(path)
+            stack.extend(os.path.join(path, d) for d in reversed(subdirs))
+
+        # subdirectories before their parent
+        for path in reversed(order):
+            d = tree[path]
+            children = [(name, tree[os.path.join(path, name)]['digest'])
+                        for name in d['subdirs'] if os.path.join(path, name) in tree]
+            d['digest'] = LycheeManifest.digest(d['mtime_ns'], d['photos'], children)
+        return [tree[path] for path in order]
+
+    def recordSource(self, directories, scanstart):
+        """
+        Save the scanned directories in the manifest, forget the removed ones
+        Parameters:
+        - directories: the scanSource result
+        - scanstart: the scan start time
+        Returns nothing
+        """
+        # a directory changed in the same mtime tick as its listing would look unchanged: list it again next run
+        racy = int((scanstart - 2) * 1000000000)
+        for d in directories:
+            mtime_ns = d['mtime_ns'] if d['mtime_ns'] < racy else None
+            self.manifest.recordDirectory(d['path'], mtime_ns, d['digest'], d['subdirs'], d['photos'])
+        removed = self.manifest.forgetDirectories(self.conf['srcdir'], set(d['path'] for d in directories))
+        if removed:
+            logger.debug("%s removed directories forgotten", removed)
+        self.manifest.commit()
+
+    def albumFromPath(self, root, album_name_max_width):
+        """
+        Build the album of a source directory (see getAlbumNameFromPath)
+        Returns an album properties list with keys path, relpath and name (truncated to the db column width)
+        """
+        # albumnames start at srcdir (to avoid absolute path albumname)
+        album = {'path': root, 'relpath': os.path.relpath(root, self.conf['srcdir'])}
+        album['name'] = self.getAlbumNameFromPath(album)
+        if len(album['name']) > album_name_max_width:
+            logger.warn("album name too long, will be truncated " + album['name'])
+            album['name'] = album['name'][0:album_name_max_width]
+            logger.warn("album name is now " + album['name'])
+        return album
+
+    def isExcluded(self, root):
+        return any([True for pattern in self.conf['excludeAlbums'] if fnmatch.fnmatch(root, pattern)])
+
+    def isSynced(self, directory, album_name_max_width):
+        """
+        Check that the photos of a source directory are all in its lychee album (same name)
+        Directories not imported (root, excluded, without photos) are synced
+        Returns a boolean
+        """
+        root = directory['path']
+        if not(directory['photos']) or root == self.conf['srcdir'] or self.isExcluded(root):
+            return True
+        album_id = self.dao.albumExists(self.albumFromPath(root, album_name_max_width))
+        return bool(album_id) and all(self.photoInAlbum(album_id, f) for f in directory['photos'])
 
+    def planSync(self, plan):
+        """
+        Planning phase: walk the srcdir and write in plan what the sync will do, nothing is changed
+        Albums replaced (-r) are listed with their photos, photos already in their existing album
+        (same name, or unchanged since last sync with a manifest) are skipped.
+        With a manifest, a subtree whose digest is unchanged since last run and whose photos are all
+        in lychee is skipped as a whole (except in -d and -r modes).
+        The scanned directories are kept in self.scanned, to be recorded once the plan is applied
+        Duplicates by checksum are found when the plan is applied (it would need to read every file)
+        Parameters:
+        - plan: an opened LycheePlan
+        Returns nothing
+        """
+        album_name_max_width = self.dao.getAlbumNameDBWidth()
         if self.conf['dropdb']:
-            self.deleteAllFiles()
+            plan.write('drop_all', "drop mode (-d)")
+
+        scanstart = time.time()
+        directories = self.scanSource()
+        prune = self.manifest and not(self.conf['dropdb'] or self.conf['replace'])
+        synced = {}
+        if prune:
+            # an unchanged subtree is skipped if every directory in it is synced
+            # (the subtrees of a changed directory are checked on their own)
+            for d in reversed(directories):
+                path = d['path']
+                synced[path] = d['digest'] == d['olddigest'] and self.isSynced(d, album_name_max_width) and \
+                    all(synced.get(os.path.join(path, name), True) for name in d['subdirs'])
+        pruned = set()
+        prunedphotos = 0
+
+        def prunedAlbum(root, files):
+            # with -s an unchanged album is sorted with the others: its name is kept in the plan
+            if self.conf['sort'] and files and root != self.conf['srcdir'] and not(self.isExcluded(root)):
+                return {'album': self.albumFromPath(root, album_name_max_width)['name']}
+            return {}
+
+        for d in directories:
+            root = d['path']
+            files = d['photos']
+
+            if os.path.dirname(root) in pruned:
+                pruned.add(root)
+                prunedphotos += len(files)
+                values = prunedAlbum(root, files)
+                if values:
+                    plan.write('skip_album', "unchanged since last sync (directory digest)", path=root, **values)
+                continue
+            if synced.get(root):
+                pruned.add(root)
+                prunedphotos += len(files)
+                plan.write('skip_album', "unchanged since last sync (directory digest)", path=root,
+                           **prunedAlbum(root, files))
+                continue
 
-        # Load db
+            # if a there is at least one photo in the files
+            if not(files):
+                continue
+
+            # Skip any albums that matches one of the exluded patterns
+            if self.isExcluded(root):
+                logger.info("Skipping excluded album {}".format(root))
+                plan.write('skip_album', "excluded (excludeAlbums)", path=root)
+                continue
+
+            # don't know what to do with theses photo
+            # and don't wan't to create a default album
+            if root == self.conf['srcdir']:
+                msg = "file at srcdir root won't be added to lychee, please move them in a subfolder: {}".format(
+                    root)
+                logger.warn(msg)
+                plan.write('skip_album', "photos at srcdir root", path=root)
+                continue
+
+            album = self.albumFromPath(root, album_name_max_width)
+
+            album_id = None if self.conf['dropdb'] else self.dao.albumExists(album)
+            reason = "drop mode (-d)" if self.conf['dropdb'] else "not in lychee"
+            if self.conf['replace'] and album_id:
+                for photo_id, url, thumburl, a in self.dao.iterPhotos(album_id):
+                    plan.write('delete_photo', "album replaced (-r)", id=photo_id, url=url, album=album['name'])
+                plan.write('drop_album', "album replaced (-r)", id=album_id, album=album['name'])
+                album_id = None
+                reason = "album replaced (-r)"
+
+            if album_id:
+                plan.write('use_album', "exists in lychee", album=album['name'], path=root, id=album_id)
+            else:
+                plan.write('create_album', reason, album=album['name'], path=root)
+
+            for f in files:
+                srcfullpath = os.path.join(root, f)
+                reason = None
+                if album_id:
+                    if self.photoInAlbum(album_id, f):
+                        reason = "already in album (same name)"
+                    elif self.manifest:
+                        try:
+                            if self.isUnchanged(srcfullpath, self.manifest.fingerprint(srcfullpath)):
+                                reason = "unchanged since last sync"
+                        except Exception as e:
+                            logger.exception(e)
+                if reason:
+                    plan.write('skip_photo', reason, album=album['name'], path=srcfullpath)
+                else:
+                    plan.write('add_photo', "new photo", album=album['name'], path=srcfullpath)
 
-        createdalbums = 0
-        discoveredphotos = 0
-        importedphotos = 0
-        album = {}
-        albums = []
+        if pruned:
+            logger.info("%s unchanged directories (%s photos) skipped", len(pruned), prunedphotos)
+        # recorded once the plan is applied (see sync)
+        self.scanned = (directories, scanstart)
 
-        album_name_max_width = self.dao.getAlbumNameDBWidth()
+    def photoInAlbum(self, album_id, name):
+        """
+        Returns True if a photo with this name is in the album (see LycheeDAO.photoExists)
+        """
+        return self.dao.photoindex.inAlbum(album_id, self.dao.photoindex.find(name, None))
 
-        # walkthroug each file / dir of the srcdir
-        for root, dirs, files in os.walk(self.conf['srcdir']):
+    def applyDeletions(self, plan):
+        """
+        Apply phase, first pass: run the plan deletions in bulk (drop all, photos and albums of replaced albums)
+        Parameters:
+        - plan: a LycheePlan
+        Returns nothing
+        """
+        photo_ids = []
+        urls = []
+        album_ids = []
+        for entry in plan.entries(['drop_all', 'delete_photo', 'drop_album']):
+            if entry['op'] == 'drop_all':
+                self.deleteAllFiles()
+                self.dao.dropAll()
+            elif entry['op'] == 'delete_photo':
+                photo_ids.append(entry['id'])
+                urls.append(entry['url'])
+            else:
+                album_ids.append(entry['id'])
+        if urls:
+            self.deleteFiles(urls)
+        self.dao.dropPhotos(photo_ids)
+        self.dao.dropAlbums(album_ids)
 
-            if sys.version_info.major == 2:
+    def planPhotos(self, plan):
+        """
+        Pipeline source (apply phase, second pass): create the albums of the plan and list the photos to import
+        Runs in the calling thread, db access is protected by dblock
+        Parameters:
+        - plan: a LycheePlan
+        Returns a generator of tasks (dictionaries): one per photo to import,
+        then one with an 'end' key once every photo of the album has been listed
+        The unchanged albums skipped with their name (-s) are kept in self.unchangedalbums
+        """
+        album = None
+        for entry in plan.entries(['create_album', 'use_album', 'add_photo', 'skip_photo', 'skip_album']):
+            if entry['op'] == 'skip_album':
+                if entry.get('album'):
+                    with self.dblock:
+                        album_id = self.dao.albumExists({'name': entry['album']})
+                    if album_id:
+                        self.unchangedalbums.append({'id': album_id, 'name': entry['album']})
+                continue
+            if entry['op'] in ('create_album', 'use_album'):
+                if album is not None:
+                    yield {'album': album, 'end': True}
+                # tasks of the previous album may still be in the pipeline
+                album = {}
+                album['name'] = entry['album']
+                album['path'] = entry['path']
+                album['relpath'] = os.path.relpath(entry['path'], self.conf['srcdir'])  # path relative to srcdir
+                album['photocount'] = 0  # photos imported
+                album['maxdate'] = None  # most recent photo date
+                album['queued'] = []  # photos inserted, waiting for their commit (see commitPhotos)
+                album['new'] = False  # created by this run
+
+                with self.dblock:
+                    album['id'] = self.dao.albumExists(album)
+                    if not(album['id']):
+                        # create album
+                        album['id'] = self.createAlbum(album)
+
+                        if not(album['id']):
+                            logger.error("didn't manage to create album for: " + album['relpath'])
+                            album = None
+                            continue
+                        else:
+                            logger.info("############ Album created: %s", album['name'])
+                            # empty: its photos can only be duplicates of each other
+                            album['new'] = True
+
+                        self.createdalbums += 1
+                continue
+
+            self.discoveredphotos += 1
+            if entry['op'] == 'skip_photo':
+                logger.debug("%s, skipped: %s", entry['reason'], entry['path'])
+                continue
+            if album is None or entry['album'] != album['name']:
+                logger.error("could not add %s: album %s not created", entry['path'], entry['album'])
+                continue
+            fingerprint = None
+            if self.manifest:
                 try:
-                    root = root.decode('UTF-8')
+                    fingerprint = self.manifest.fingerprint(entry['path'])
                 except Exception as e:
-                    logger.error(e)
-            # Init album data
-            album['id'] = None
-            album['name'] = None
-            album['path'] = None
-            album['relpath'] = None  # path relative to srcdir
-            album['photos'] = []  # path relative to srcdir
-
-            # if a there is at least one photo in the files
-            if any([self.isAPhoto(f) for f in files]):
-                album['path'] = root
-
-                # Skip any albums that matches one of the exluded patterns
-                if any([True for pattern in self.conf['excludeAlbums'] if fnmatch.fnmatch(root, pattern)]):
-                    logger.info("Skipping excluded album {}".format(root))
-                    continue
-
-                # don't know what to do with theses photo
-                # and don't wan't to create a default album
-                if album['path'] == self.conf['srcdir']:
-                    msg = "file at srcdir root won't be added to lychee, please move them in a subfolder: {}".format(
-                        root)
-                    logger.warn(msg)
+                    logger.exception(e)
+                    logger.error("could not add %s to album %s", entry['path'], album['name'])
                     continue
+            yield {'album': album, 'name': os.path.basename(entry['path']), 'fingerprint': fingerprint,
+                   'photo': None, 'error': None}
 
-                # Fill in other album properties
-                # albumnames start at srcdir (to avoid absolute path albumname)
-                album['relpath'] = os.path.relpath(album['path'], self.conf['srcdir'])
-                album['name'] = self.getAlbumNameFromPath(album)
+        if album is not None:
+            yield {'album': album, 'end': True}
 
-                if len(album['name']) > album_name_max_width:
-                    logger.warn("album name too long, will be truncated " + album['name'])
-                    album['name'] = album['name'][0:album_name_max_width]
-                    logger.warn("album name is now " + album['name'])
-
-                album['id'] = self.dao.albumExists(album)
-
-                if self.conf['replace'] and album['id']:
-                    # drop album photos
-                    filelist = self.dao.eraseAlbum(album['id'])
-                    self.deleteFiles(filelist)
-                    assert self.dao.dropAlbum(album['id'])
-                    # Album should be recreated
-                    album['id'] = False
+    def fingerprintStage(self, task):
+        """
+        Pipeline stage (worker): hash the source photo (copying it to lychee unless in link mode) and read its exif
+        Errors are stored in the task and logged by the ordered stages, in discovery order
+        """
+        if task.get('end'):
+            return task
+        try:
+            pid = self.dao.getUniqPhotoId()
+            # corruption detected here by launching exception
+            # single read of the source: photos of a new album are copied while hashed,
+            # unless linked or cheaply placed later (reflink, hardlink...)
+            # the other ones are placed after dedup, so that duplicates are never copied
+            srcfullpath = os.path.join(task['album']['path'], task['name'])
+            destfullpath = os.path.join(self.conf['lycheepath'], "uploads", "big", task['name'])
+            place = task['album']['new'] and not(self.conf['link'] or self.store) and \
+                self.placer.modeFor(srcfullpath, destfullpath) == 'copy'
+            task['photo'] = LycheePhoto(pid, self.conf, task['name'], task['album'], place=place)
+        except Exception:
+            task['error'] = sys.exc_info()
+        return task
+
+    def dedupStage(self, task):
+        """
+        Pipeline stage (ordered): drop the photos already in lychee
+        Accepted photos are reserved in the index, so that a duplicate following in the same run is dropped too
+        """
+        if task.get('end'):
+            return task
+        album = task['album']
+        logger.debug("**** Trying to add to lychee album %s: %s", album['name'], os.path.join(album['path'], task['name']))
+        if task['error']:
+            exc_info = task['error']
+            logger.error(exc_info[1], exc_info=exc_info)
+            logger.error("could not add %s to album %s", task['name'], album['name'])
+            return None
+
+        photo = task['photo']
+        with self.dblock:
+            existing = self.dao.findPhoto(photo)
+            if existing is None:
+                # visible to the next photoExists calls while being transformed
+                self.dao.reservePhoto(photo)
+            elif self.manifest and task['fingerprint']:
+                # already in lychee (imported before the manifest existed, or a duplicate):
+                # recorded so that it is not hashed again by the next runs
+                self.manifest.record(photo.srcfullpath, task['fingerprint'], photo.checksum, existing)
+        if existing is not None:
+            logger.error(
+                "photo already exists in this album with same name or same checksum: %s it won't be added to lychee",
+                photo.srcfullpath)
+            if photo.placed:
+                remove_file(photo.destfullpath)
+            return None
+
+        if self.store:
+            # the first photo of a content makes its files, the next ones are linked to them
+            task['blobkey'] = (photo.checksum, os.path.splitext(photo.url)[1])
+            task['shared'] = task['blobkey'] in self.blobkeys or self.store.has(*task['blobkey'])
+        return task
+
+    def placementStage(self, task):
+        """
+        Pipeline stage (worker): place the photo in lychee (link, or copy if not done while hashing) and fix its rights
+        """
+        if task.get('end') or task['error']:
+            return task
+        if task.get('shared'):
+            if self.store.has(*task['blobkey']):
+                return task
+            # the photo making the blobs failed: this one is imported on its own
+            task['shared'] = False
+        try:
+            if not(self.copyFileToLychee(task['photo'])):
+                raise IOError("could not place " + task['photo'].destfullpath)
+        except Exception:
+            task['error'] = sys.exc_info()
+        return task
 
-                if not(album['id']):
-                    # create album
-                    album['id'] = self.createAlbum(album)
+    def transformStage(self, task):
+        """
+        Pipeline stage (worker): rotate the photo and make its thumbnails
+        """
+        if task.get('end') or task['error']:
+            return task
+        photo = task['photo']
+        if task.get('shared'):
+            # files already rotated and thumbnailed, only the db row dimensions must be rotated
+            if photo.exif.orientation in [5, 6, 7, 8]:
+                photo.width, photo.height = photo.height, photo.width
+            return task
+        try:
+            # decode once for rotation and thumbnails
+            img = self.openImage(photo)
+            try:
+                img = self.adjustRotation(photo, img)
+                self.makeThumbnail(photo, img)
+            finally:
+                img.close()
+        except Exception:
+            task['error'] = sys.exc_info()
+        return task
+
+    def commitStage(self, task):
+        """
+        Pipeline stage (ordered): insert the photos in db, the album is committed at once on its end task
+        """
+        album = task['album']
+        if task.get('end'):
+            with self.dblock:
+                self.commitAlbum(album)
+            return task
+
+        photo = task['photo']
+        if self.store and not(task['error']):
+            try:
+                self.storeFiles(photo, task.get('shared'))
+                # the next photos of this content are linked to its blobs
+                self.blobkeys.add(task['blobkey'])
+            except Exception:
+                task['error'] = sys.exc_info()
+        with self.dblock:
+            if task['error']:
+                self.dao.releasePhoto(photo)
+                exc_info = task['error']
+                logger.error(exc_info[1], exc_info=exc_info)
+                logger.error("could not add %s to album %s", photo.originalname, album['name'])
+                # the image may be found corrupted only once decoded, after placement
+                if not(task.get('shared')) and os.path.lexists(photo.destfullpath):
+                    self.deleteFiles([photo.url])
+                return None
+            elif self.dao.addFileToAlbum(photo):
+                # increment counter
+                self.importedphotos += 1
+                album['queued'].append((photo, task['fingerprint']))
+                # memory is bounded by the batch size, not by the album size
+                if len(album['queued']) >= int(self.conf.get("insertBatchSize", 500)):
+                    self.commitPhotos(album)
+            else:
+                self.dao.releasePhoto(photo)
+                logger.error(
+                    "while adding to album: %s photo: %s",
+                    album['name'],
+                    photo.srcfullpath)
+                return None
+        return task
+
+    def storeFiles(self, photo, shared):
+        """
+        Content addressed mode: link the lychee files of a photo to the blobs of its content
+        Parameters:
+        - photo: a valid LycheePhoto object
+        - shared: if True the blobs already exist and the lychee files are created from them,
+          otherwise the lychee files just made become the blobs
+        Returns nothing
+        """
+        ext = os.path.splitext(photo.url)[1]
+        if shared:
+            self.store.link(photo.checksum, ext, photo.url)
+        else:
+            self.store.adopt(photo.checksum, ext, photo.url)
 
-                    if not(album['id']):
-                        logger.error("didn't manage to create album for: " + album['relpath'])
-                        continue
-                    else:
-                        logger.info("############ Album created: %s", album['name'])
+    def commitPhotos(self, album):
+        """
+        Write the queued photos of an album in db, then record them in the manifest
+        Called every insertBatchSize photos and at the end of the album
+        Photos which could not be written are removed from lychee
+        Only the album aggregates (photo count, max date) are kept once the photos are committed
+        Returns nothing
+        """
+        # get photos with a real date (not just now)
+        now = datetime.datetime.now()
+        last2min = now - datetime.timedelta(minutes=2)
+        last2min_epoch = int((last2min - datetime.datetime(1970, 1, 1)).total_seconds())
 
-                    createdalbums += 1
+        # if the flush fails, the state of the queued photos is unknown: they are not retried
+        queued = album['queued']
+        album['queued'] = []
+        failed = self.dao.flushPhotos()
+        self.fixPermissions([photo for photo, fingerprint in queued if photo not in failed])
+        for photo, fingerprint in queued:
+            if photo in failed:
+                self.importedphotos -= 1
+                logger.error(
+                    "while adding to album: %s photo: %s",
+                    album['name'],
+                    photo.srcfullpath)
+                self.deleteFiles([photo.url])
+            else:
+                album['photocount'] += 1
+                sysdate = photo.epoch_sysdate
+                if sysdate < last2min_epoch and (album['maxdate'] is None or sysdate > album['maxdate']):
+                    album['maxdate'] = sysdate
+                if self.manifest:
+                    self.manifest.record(photo.srcfullpath, fingerprint, photo.checksum, photo.id)
+                logger.info(
+                    "**** Successfully added %s to lychee album %s",
+                    photo.srcfullpath,
+                    album['name'])
+
+    def commitAlbum(self, album):
+        """
+        Commit the last photos of an album, then keep only its aggregates for the end of the run
+        Returns nothing
+        """
+        self.commitPhotos(album)
+        del album['queued']
+        self.albums.append(dict((k, album[k]) for k in ['id', 'name', 'photocount', 'maxdate']))
 
-                # Albums are created or emptied, now take care of photos
-                for f in sorted(files):
+    def sync(self):
+        """
+        Program main loop
+        Scans files to add in the sourcedirectory and add them to Lychee
+        according to the conf file and given parameters, in two phases:
+        - plan: what to do is written in a plan (see LycheePlan), nothing is changed.
+          With the plan conf key (--plan) the plan is kept and the run stops there (dry run)
+        - apply: the plan is applied, a given plan (apply conf key, --apply) replaces the planning phase
+        Returns nothing
+        """
 
-                    if self.isAPhoto(f):
-                        try:
-                            discoveredphotos += 1
-                            error = False
-                            logger.debug(
-                                "**** Trying to add to lychee album %s: %s",
-                                album['name'],
-                                os.path.join(
-                                    root,
-                                    f))
-                            # corruption detected here by launching exception
-                            pid = self.dao.getUniqPhotoId()
-                            photo = LycheePhoto(pid, self.conf, f, album)
-                            if not(self.dao.photoExists(photo)):
-                                res = self.copyFileToLychee(photo)
-                                self.adjustRotation(photo)
-                                self.makeThumbnail(photo)
-                                res = self.dao.addFileToAlbum(photo)
-                                # increment counter
-                                if res:
-                                    importedphotos += 1
-                                    album['photos'].append(photo)
-                                else:
-                                    error = True
-                                    logger.error(
-                                        "while adding to album: %s photo: %s",
-                                        album['name'],
-                                        photo.srcfullpath)
-                            else:
-                                logger.error(
-                                    "photo already exists in this album with same name or same checksum: %s it won't be added to lychee",
-                                    photo.srcfullpath)
-                                error = True
-                        except Exception as e:
+        # Connect db
+        self.dao = LycheeDAO(self.conf)
 
-                            logger.exception(e)
-                            logger.error("could not add %s to album %s", f, album['name'])
-                            error = True
-                        finally:
-                            if not(error):
-                                logger.info(
-                                    "**** Successfully added %s to lychee album %s",
-                                    os.path.join(
-                                        root,
-                                        f),
-                                    album['name'])
-
-                a = album.copy()
-                albums.append(a)
+        if self.conf.get('manifestPath'):
+            self.manifest = LycheeManifest(self.conf['manifestPath'])
 
+        if self.conf.get('contentAddressed'):
+            if self.conf['link']:
+                logger.warn("content addressed storage is not available in link mode")
+            else:
+                self.store = BlobStore(self.conf['lycheepath'])
+
+        self.createdalbums = 0
+        self.discoveredphotos = 0
+        self.importedphotos = 0
+        self.albums = []
+        # albums skipped as a whole, still sorted by -s
+        self.unchangedalbums = []
+        self.dblock = threading.Lock()
+        # contents stored during this run
+        self.blobkeys = set()
+        # source directories scanned by the planning phase
+        self.scanned = None
+
+        tmpplan = None
+        if not(self.conf.get('apply') or self.conf.get('plan')):
+            fd, tmpplan = tempfile.mkstemp(prefix="lycheesync-", suffix=".plan")
+            os.close(fd)
+        try:
+            # planning phase, unless a (reviewed) plan is given
+            planpath = self.conf.get('apply')
+            if not(planpath):
+                planpath = self.conf.get('plan') or tmpplan
+                plan = LycheePlan(planpath)
+                with plan:
+                    self.planSync(plan)
+                logger.info("plan: %s", plan.summary())
+                if self.conf.get('plan'):
+                    # dry run
+                    logger.info("plan written to %s, nothing applied", planpath)
+                    self.dao.close()
+                    if self.manifest:
+                        self.manifest.close()
+                    return
+            plan = LycheePlan(planpath)
+
+            # apply phase: bulk deletions, then photos flow through stages connected by bounded queues
+            self.applyDeletions(plan)
+            workers = int(self.conf.get('workers') or 1)
+            queuesize = int(self.conf.get('pipelineQueueSize', 16))
+            pipeline = LycheePipeline([
+                LycheeStage('fingerprint', self.fingerprintStage, workers, maxsize=queuesize),
+                LycheeStage('dedup', self.dedupStage, ordered=True, maxsize=queuesize),
+                LycheeStage('placement', self.placementStage, workers, maxsize=queuesize),
+                LycheeStage('transform', self.transformStage, workers, maxsize=queuesize),
+                LycheeStage('commit', self.commitStage, ordered=True, maxsize=queuesize)])
+            pipeline.run(self.planPhotos(plan))
+            if self.manifest and self.scanned:
+                self.recordSource(*self.scanned)
+        finally:
+            if tmpplan:
+                os.remove(tmpplan)
+
+        albums = self.albums
         self.updateAlbumsDate(albums)
         if self.conf['sort']:
-            self.reorderalbumids(albums)
-            self.dao.reinitAlbumAutoIncrement()
+            self.reorderalbumids(albums + self.unchangedalbums)
 
         if self.conf['sanity']:
+            self.sanityCheck()
 
-            logger.info("************ SANITY CHECK *************")
-            # get All Photos albums
-            photos = self.dao.get_all_photos()
-            albums = [p['album'] for p in photos]
-            albums = set(albums)
-
-            # for each album
-            for a_id in albums:
-                # check if it exists, if not remove photos
-                if not(self.dao.albumIdExists(a_id)):
-                    to_delete = self.dao.get_all_photos(a_id)
-                    self.dao.eraseAlbum(a_id)
-                    file_list = [p['url'] for p in to_delete]
-                    self.deleteFiles(file_list)
-
-            # get All Photos
-            photos = self.dao.get_all_photos()
-
-            to_delete = []
-            # for each photo
-            for p in photos:
-                delete_photo = False
-                # check if big exists
-                bigpath = os.path.join(self.conf["lycheepath"], "uploads", "big", p['url'])
-
-                # if big is a link check if it's an orphan
-                # file does not exists
-                if not(os.path.lexists(bigpath)):
-                    logger.error("File does not exists %s: will be delete in db", bigpath)
-                    delete_photo = True
-                # broken link
-                elif not(os.path.exists(bigpath)):
-                    logger.error("Link is broken: %s will be delete in db", bigpath)
-                    delete_photo = True
-
-                if not(delete_photo):
-                    # TODO: check if thumbnail exists
-                    pass
-                else:
-                    # if any of it is False remove and log
-                    to_delete.append(p)
-
-            self.deletePhotos(to_delete)
-
-            # Detect broken symlinks / orphan files
-            for root, dirs, files in os.walk(os.path.join(self.conf['lycheepath'], 'uploads', 'big')):
-
-                for f in files:
-                    logger.debug("check orphan: %s", f)
-                    file_name = os.path.basename(f)
-                    # check if DB photo exists
-                    if not self.dao.photoExistsByName(file_name):
-                        # if not delete photo (or link)
-                        self.deleteFiles([file_name])
-                        logger.info("%s deleted. Wasn't existing in DB", f)
-
-                    # if broken link
-                    if os.path.lexists(f) and not(os.path.exists(f)):
-                        id = self.dao.photoExistsByName(file_name)
-                        # if exists in db
-                        if id:
-                            ps = {}
-                            ps['id'] = id
-                            ps['url'] = file_name
-                            self.deletePhotos([ps])
-                        else:
-                            self.deleteFiles([file_name])
-                        logger.info("%s deleted. Was a broken link", f)
-
-            # drop empty albums
-            empty = self.dao.get_empty_albums()
-            if empty:
-                for e in empty:
-                    self.dao.dropAlbum(e)
+        if self.store and self.store.dirty:
+            logger.info("%s unused blobs removed", self.store.collect())
 
         self.dao.close()
+        if self.manifest:
+            self.manifest.close()
 
         # Final report
         logger.info("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
         logger.info("Directory scanned:" + self.conf['srcdir'])
-        logger.info("Created albums: " + str(createdalbums))
-        if (importedphotos == discoveredphotos):
-            logger.info(str(importedphotos) + " photos imported on " + str(discoveredphotos) + " discovered")
+        logger.info("Created albums: " + str(self.createdalbums))
+        if (self.importedphotos == self.discoveredphotos):
+            logger.info(str(self.importedphotos) + " photos imported on " + str(self.discoveredphotos) + " discovered")
         else:
-            logger.error(str(importedphotos) + " photos imported on " + str(discoveredphotos) + " discovered")
+            logger.error(str(self.importedphotos) + " photos imported on " + str(self.discoveredphotos) + " discovered")
+        pipeline.report()
         logger.info("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
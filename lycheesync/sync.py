@@ -4,6 +4,8 @@
 from __future__ import print_function
 # from __future__ import unicode_literals
 from lycheesync.lycheesyncer import LycheeSyncer
+from lycheesync.lycheedao import LycheeDAO
+from lycheesync.lycheeschema import LycheeSchemaOptimizer
 from lycheesync.update_scripts import inf_to_lychee_2_6_2
 import logging.config
 import click
@@ -13,6 +15,7 @@ import pwd
 import grp
 
 from lycheesync.utils.boilerplatecode import script_init
+from lycheesync.utils.configuration import ConfBorg
 
 logger = logging.getLogger(__name__)
 
@@ -28,8 +31,16 @@ logger = logging.getLogger(__name__)
 @click.option('-s', '--sort_album_by_name', is_flag=True, help='Sort album by name')
 @click.option('-c', '--sanitycheck', is_flag=True, help='Sort album by name')
 @click.option('-l', '--link', is_flag=True, help="Don't copy files create link instead")
+@click.option('-w', '--workers', default=1, type=click.IntRange(1, None),
+              help='Number of photos hashed, rotated and thumbnailed in parallel')
 @click.option('-u26', '--updatedb26', is_flag=True,
               help="Update lycheesync added data in lychee db to the lychee 2.6.2 required values")
+@click.option('--optimize-schema', is_flag=True,
+              help="Add the indexes used by lycheesync lookups to lychee db, report their effect and exit")
+@click.option('--plan', 'planpath', type=click.Path(dir_okay=False, resolve_path=True),
+              help="Write what the sync would do to this plan file and exit, nothing is changed (dry run)")
+@click.option('--apply', 'applypath', type=click.Path(exists=True, dir_okay=False, resolve_path=True),
+              help="Apply a plan file written by --plan instead of scanning the photo directory")
 @click.argument('imagedirpath', metavar='PHOTO_DIRECTORY_ROOT',
                 type=click.Path(exists=True, resolve_path=True))
 @click.argument('lycheepath', metavar='PATH_TO_LYCHEE_INSTALL',
@@ -38,7 +49,8 @@ logger = logging.getLogger(__name__)
                 type=click.Path(exists=True, resolve_path=True))
 # checks file existence and attributes
 # @click.argument('file2', type=click.Path(exists=True, file_okay=True, dir_okay=False, writable=False, readable=True, resolve_path=True))
-def main(verbose, exclusive_mode, sort_album_by_name, sanitycheck, link, updatedb26, imagedirpath, lycheepath, confpath):
+def main(verbose, exclusive_mode, sort_album_by_name, sanitycheck, link, workers, updatedb26,
+         optimize_schema, planpath, applypath, imagedirpath, lycheepath, confpath):
     """Lycheesync
 
     A script to synchronize any directory containing photos with Lychee.
@@ -49,6 +61,11 @@ def main(verbose, exclusive_mode, sort_album_by_name, sanitycheck, link, updated
         imagedirpath = imagedirpath.decode('UTF-8')
         lycheepath = lycheepath.decode('UTF-8')
         confpath = confpath.decode('UTF-8')
+        planpath = planpath.decode('UTF-8') if planpath else None
+        applypath = applypath.decode('UTF-8') if applypath else None
+
+    if planpath and applypath:
+        raise click.UsageError("--plan and --apply can't be used together")
 
     conf_data = {}
     conf_data['verbose'] = verbose
@@ -74,6 +91,9 @@ def main(verbose, exclusive_mode, sort_album_by_name, sanitycheck, link, updated
         logger.info("!!!!!!!!!!!!!!!! SANITY OFF")
     conf_data["sanity"] = sanitycheck
     conf_data["link"] = link
+    conf_data["workers"] = workers
+    conf_data["plan"] = planpath
+    conf_data["apply"] = applypath
     # if conf_data["dropdb"]:
     #    conf_data["sort"] = True
 
@@ -97,6 +117,15 @@ def main(verbose, exclusive_mode, sort_album_by_name, sanitycheck, link, updated
     if updatedb26:
         inf_to_lychee_2_6_2.updatedb(conf_data)
 
+    if optimize_schema:
+        logger.info("=================== optimize lychee db schema ==================")
+        db = LycheeDAO.connect(ConfBorg().conf)
+        try:
+            LycheeSchemaOptimizer(db).optimize()
+        finally:
+            db.close()
+        return
+
     logger.info("=================== start adding to lychee ==================")
     try:
 
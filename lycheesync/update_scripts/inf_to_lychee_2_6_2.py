@@ -1,89 +1,240 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 from __future__ import unicode_literals
-import os
-import pwd
-import grp
-from lycheesync.lycheesyncer import LycheeSyncer
-import pymysql
 import hashlib
+import logging
+import os
 import stat
-import traceback
+import tempfile
+import threading
+from lycheesync.lycheesyncer import LycheeSyncer
+from lycheesync.lycheepipeline import LycheePipeline, LycheeStage
+from lycheesync.lycheepool import connect, RetrySSCursor
+from lycheesync.utils.configuration import ConfBorg
+from lycheesync.utils.filehash import sha1_file
 
+logger = logging.getLogger(__name__)
 
-# Compute checksum
-def __generateHash(filepath):
-    checksum = None
-    sha1 = hashlib.sha1()
-    with open(filepath, 'rb') as f:
-        sha1.update(f.read())
-        checksum = sha1.hexdigest()
-    return checksum
 
+def checkpoint_path_for(conf):
+    """
+    Returns the checkpoint file path used for a given lychee installation
+    It is kept next to the configuration file (or in the lychee directory): unlike the temp directory,
+    it survives a reboot. The temp directory is used only if this directory is not writable
+    """
+    m = hashlib.md5()
+    m.update(os.path.abspath(conf["lycheepath"]).encode('utf-8'))
+    directory = os.path.dirname(conf["confpath"]) if conf.get("confpath") else conf["lycheepath"]
+    if not(os.access(directory or '.', os.W_OK)):
+        logger.warn("%s is not writable, the -u26 checkpoint is kept in the temp directory", directory)
+        directory = tempfile.gettempdir()
+    return os.path.join(directory, "lycheesync-" + m.hexdigest() + ".u26")
 
-def updatedb(conf_data):
-    print("updatedb")
 
-    # read permission of the lycheepath directory to apply it to the uploade photos
-    upload_dir = os.path.join(conf_data["lycheepath"], "uploads")
-    stat_info = os.stat(upload_dir)
-    uid = stat_info.st_uid
-    gid = stat_info.st_gid
+class ChecksumMigration:
+
+    """
+    Recompute the checksum of every photo in lychee db (lychee 2.6.2 expects a sha1 of the file)
+    - photos are streamed from the db by increasing id, hashed in parallel (streaming reads)
+    - checksums are written by batches, one statement per batch, unchanged ones are skipped
+    - the highest id written is saved in a checkpoint file after each batch, with the ids of the photos
+      whose file could not be hashed: an interrupted migration resumes after it and retries these photos,
+      the file is removed once every photo is migrated
+    """
+
+    def __init__(self, conf, checkpointpath=None):
+        """
+        Parameters:
+        - conf: the configuration dictionnary (db* keys, lycheepath, workers, insertBatchSize, fetchBatchSize)
+        - checkpointpath: the checkpoint file (default: one per lychee installation, see checkpoint_path_for)
+        """
+        self.conf = conf
+        self.upload_dir = os.path.join(conf["lycheepath"], "uploads")
+        self.checkpointpath = checkpointpath or checkpoint_path_for(conf)
+        self.batchsize = int(conf.get("insertBatchSize", 500))
+        self.batch = []
+        # highest id seen by the (ordered) write stage, and highest id saved
+        self.lastid, self.failedids = self.readCheckpoint()
+        self.savedid = self.lastid
+        # photos to hash again: the ones which failed in previous runs, and the ones seen again by this run
+        self.retryids = sorted(self.failedids)
+        self.retried = set()
+        # a failed batch freezes the checkpoint: its photos will be hashed again by the next run
+        self.frozen = False
+        self.updated = self.unchanged = self.failed = 0
+        self.lock = threading.Lock()
+        self.db = None
+
+    def readCheckpoint(self):
+        """
+        Returns the last saved id and the set of the ids whose hashing failed
+        """
+        try:
+            with open(self.checkpointpath) as f:
+                ids = [int(i) for i in f.read().split()]
+        except (IOError, OSError, ValueError):
+            return 0, set()
+        return (ids[0] if ids else 0), set(ids[1:])
+
+    def writeCheckpoint(self, lastid):
+        tmp = self.checkpointpath + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(str(i) for i in [lastid] + sorted(self.failedids)))
+        os.rename(tmp, self.checkpointpath)
+        self.savedid = lastid
+
+    def photos(self, readdb):
+        """
+        Pipeline source: the photos which failed in previous runs and the photos after the checkpoint,
+        streamed by increasing id
+        """
+        fetchsize = int(self.conf.get("fetchBatchSize", 10000))
+        cur = readdb.cursor(RetrySSCursor)
+        query = "select id, url, checksum from lychee_photos where id > %s"
+        if self.retryids:
+            query += " or id in (" + ','.join(['%s'] * len(self.retryids)) + ")"
+        try:
+            cur.execute(query + " order by id", [self.savedid] + self.retryids)
+            rows = cur.fetchmany(fetchsize)
+            while rows:
+                for row in rows:
+                    yield {'id': int(row[0]), 'url': row[1], 'checksum': row[2]}
+                rows = cur.fetchmany(fetchsize)
+        finally:
+            cur.close()
+
+    def hashStage(self, task):
+        """
+        Pipeline stage (worker): compute the checksum of a photo file
+        A photo whose file can't be read goes on without checksum, to be recorded in the checkpoint
+        """
+        try:
+            task['newchecksum'] = sha1_file(os.path.join(self.upload_dir, "big", task['url']))
+        except Exception as e:
+            logger.error("checksum computation failed for photo %s (%s): %s", task['id'], task['url'], e)
+            with self.lock:
+                self.failed += 1
+            task['newchecksum'] = None
+        return task
 
-    user = pwd.getpwuid(uid)[0]
-    group = grp.getgrgid(gid)[0]
+    def writeStage(self, task):
+        """
+        Pipeline stage (ordered): queue the new checksum, write the batch once full
+        """
+        # the retried photos come first: they are before the checkpoint
+        self.lastid = max(self.lastid, task['id'])
+        if task['id'] in self.failedids:
+            self.retried.add(task['id'])
+        if task['newchecksum'] is None:
+            self.failedids.add(task['id'])
+        elif task['newchecksum'] == task['checksum']:
+            self.failedids.discard(task['id'])
+            self.unchanged += 1
+        else:
+            self.failedids.discard(task['id'])
+            self.batch.append((task['id'], task['newchecksum']))
+        if len(self.batch) >= self.batchsize:
+            self.flush()
+        return task
 
-    conf_data["user"] = user
-    conf_data["group"] = group
-    conf_data["uid"] = uid
-    conf_data["gid"] = gid
+    def flush(self):
+        """
+        Write the queued checksums in one statement, then save the checkpoint
+        """
+        batch = self.batch
+        self.batch = []
+        if batch:
+            try:
+                cur = self.db.cursor()
+                cur.execute("update lychee_photos set checksum = case id " +
+                            ' '.join(['when %s then %s'] * len(batch)) +
+                            " end where id in (" + ','.join(['%s'] * len(batch)) + ")",
+                            [v for row in batch for v in row] + [row[0] for row in batch])
+                self.updated += len(batch)
+                logger.info("%s photo checksums updated (up to id %s)", self.updated, self.lastid)
+            except Exception as e:
+                logger.exception(e)
+                logger.error("checksum update failed for %s photos, they will be updated by the next run", len(batch))
+                self.frozen = True
+        if not(self.frozen):
+            self.writeCheckpoint(self.lastid)
+
+    def run(self):
+        """
+        Run (or resume) the migration
+        Returns True if every photo has been migrated, False if the migration has to be run again
+        (a batch could not be written, or some files could not be read)
+        """
+        if self.savedid:
+            logger.info("resuming checksum migration after photo id %s", self.savedid)
+        readdb = connect(self.conf)
+        self.db = connect(self.conf)
+        try:
+            workers = int(self.conf.get('workers') or 1)
+            pipeline = LycheePipeline([
+                LycheeStage('hash', self.hashStage, workers),
+                LycheeStage('write', self.writeStage, ordered=True)])
+            pipeline.run(self.photos(readdb))
+            # failed photos deleted from lychee since the previous run
+            self.failedids.difference_update(set(self.retryids) - self.retried)
+            self.flush()
+            pipeline.report()
+        finally:
+            readdb.close()
+            self.db.close()
+        logger.info("checksums: %s updated, %s unchanged, %s failed", self.updated, self.unchanged, self.failed)
+        complete = not(self.frozen) and not(self.failedids)
+        if complete and os.path.exists(self.checkpointpath):
+            os.remove(self.checkpointpath)
+        return complete
 
-    syncer = LycheeSyncer(conf_data)
 
-    # for each file in upload fix the permissions
+def fix_permissions(upload_dir, uid, gid, isaphoto):
+    """
+    Give the photos in upload_dir to uid / gid with rwx rights for user and group
+    Files already right are only stat'ed (a resumed migration does not change them again)
+    Returns the number of changed files
+    """
+    changed = 0
     for root, dirs, files in os.walk(upload_dir):
         for f in files:
-            if syncer.isAPhoto(f):
-                # adjust permissions
-                filepath = os.path.join(root, f)
-                os.chown(filepath, int(uid), int(gid))
-                st = os.stat(filepath)
-                os.chmod(filepath, st.st_mode | stat.S_IRWXU | stat.S_IRWXG)
-                print("Changed permission for " + str(f))
-
-    # connect to db
-    try:
-        db = pymysql.connect(host=conf_data["dbHost"],
-                             user=conf_data["dbUser"],
-                             passwd=conf_data["dbPassword"],
-                             db=conf_data["db"])
-
-        # get photo list
-        cur = db.cursor()
-        cur.execute("SELECT id, url from lychee_photos")
-        rows = cur.fetchall()
-        for row in rows:
-
-            pid = row[0]
-            url = row[1]
-
-            photo_path = os.path.join(upload_dir, "big", url)
-            chksum = __generateHash(photo_path)
-            # for each photo in db recalculate checksum
-            qry = "update lychee_photos set checksum= '" + chksum + "' where id=" + str(pid)
+            if not(isaphoto(f)):
+                continue
+            filepath = os.path.join(root, f)
             try:
-                cur = db.cursor()
-                cur.execute(qry)
-                db.commit()
-                print("INFO photo checksum changed to: ", chksum)
-            except Exception:
-                print("checksum modification failed for photo:" + id, Exception)
-                traceback.print_exc()
+                st = os.stat(filepath)
+                if st.st_uid != uid or st.st_gid != gid:
+                    os.chown(filepath, int(uid), int(gid))
+                mode = st.st_mode | stat.S_IRWXU | stat.S_IRWXG
+                if mode != st.st_mode:
+                    os.chmod(filepath, mode)
+                if st.st_uid != uid or st.st_gid != gid or mode != st.st_mode:
+                    changed += 1
+                    logger.debug("Changed permission for %s", f)
+            except OSError as e:
+                logger.warn("permission change failed for %s: %s", filepath, e)
+    return changed
+
+
+def updatedb(conf_data):
+    print("updatedb")
+    # cli arguments and configuration file (db settings...)
+    conf = ConfBorg().conf
 
+    # read permission of the lycheepath directory to apply it to the uploade photos
+    upload_dir = os.path.join(conf["lycheepath"], "uploads")
+    stat_info = os.stat(upload_dir)
+    uid = stat_info.st_uid
+    gid = stat_info.st_gid
+
+    syncer = LycheeSyncer()
+    print("permission changed for", fix_permissions(upload_dir, uid, gid, syncer.isAPhoto), "photos")
+
+    if ChecksumMigration(conf).run():
         print("******************************")
         print("SUCCESS")
         print("******************************")
-    except Exception:
-        traceback.print_exc()
-    finally:
-        db.close()
+    else:
+        print("******************************")
+        print("INCOMPLETE: run again to resume")
+        print("******************************")
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class BlobStore:
+
+    """
+    Content addressed storage of the lychee files (big photo and its 2 thumbnails)
+    Blobs are keyed by the photo checksum, each lychee file (uploads/big/<url>, uploads/thumb/<url>...)
+    is a hardlink to its blob: the same photo imported in several albums is stored and thumbnailed once
+    The link count of a blob is its reference count: a blob only linked by the store is garbage (see collect)
+    """
+
+    def __init__(self, lycheepath):
+        self.lycheepath = lycheepath
+        self.root = os.path.join(lycheepath, "uploads", "blobs")
+        # set when lychee files are deleted: some blobs may be garbage
+        self.dirty = False
+
+    def blobPaths(self, checksum, ext):
+        """
+        Returns the blob paths of a photo content: (big, thumbnail, @2x thumbnail)
+        """
+        base = os.path.join(self.root, checksum[:2], checksum)
+        return (base + ext, base + ".thumb" + ext, base + ".thumb@2x" + ext)
+
+    @staticmethod
+    def lycheePaths(lycheepath, url):
+        """
+        Returns the lychee paths of a photo url: (big, thumbnail, @2x thumbnail)
+        """
+        filesplit = os.path.splitext(url)
+        thumb2 = ''.join([filesplit[0], "@2x", filesplit[1]]).lower()
+        return (os.path.join(lycheepath, "uploads", "big", url),
+                os.path.join(lycheepath, "uploads", "thumb", url),
+                os.path.join(lycheepath, "uploads", "thumb", thumb2))
+
+    def has(self, checksum, ext):
+        """
+        Returns True if the blobs of a photo content are all stored
+        """
+        return all(os.path.exists(p) for p in self.blobPaths(checksum, ext))
+
+    def adopt(self, checksum, ext, url):
+        """
+        Store the lychee files of a freshly imported photo as the blobs of its content
+        If the content has been stored meanwhile (a duplicate imported at the same time),
+        the lychee files are replaced by links to the existing blobs
+        Parameters:
+        - checksum, ext: the photo content key
+        - url: the lychee url of the photo
+        Returns nothing
+        """
+        blobs = self.blobPaths(checksum, ext)
+        if not(os.path.isdir(os.path.dirname(blobs[0]))):
+            try:
+                os.makedirs(os.path.dirname(blobs[0]))
+            except OSError:
+                # created meanwhile
+                pass
+        for path, blob in zip(self.lycheePaths(self.lycheepath, url), blobs):
+            if not(os.path.lexists(blob)):
+                os.link(path, blob)
+            elif not(os.path.samefile(path, blob)):
+                tmp = path + ".blob"
+                os.link(blob, tmp)
+                os.rename(tmp, path)
+
+    def link(self, checksum, ext, url):
+        """
+        Create the lychee files of a photo from the stored blobs of its content
+        The created files are removed if one of them can't be linked
+        Returns nothing
+        """
+        created = []
+        try:
+            for path, blob in zip(self.lycheePaths(self.lycheepath, url), self.blobPaths(checksum, ext)):
+                os.link(blob, path)
+                created.append(path)
+        except Exception:
+            for path in created:
+                os.remove(path)
+            raise
+
+    def collect(self):
+        """
+        Remove the blobs no more linked by any lychee file
+        Returns the number of removed blobs
+        """
+        removed = 0
+        for root, dirs, files in os.walk(self.root):
+            for f in files:
+                path = os.path.join(root, f)
+                try:
+                    if os.lstat(path).st_nlink == 1:
+                        os.remove(path)
+                        removed += 1
+                except OSError as e:
+                    logger.warn("problem collecting blob: %s", path)
+                    logger.debug(e)
+        self.dirty = False
+        return removed
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import datetime
+import time
+from dateutil.parser import parse
+
+# separators of the fixed layouts: exif 'YYYY:MM:DD HH:MM:SS' and 'YYYY-MM-DD HH:MM:SS'
+_DATE_SEPARATORS = (':', '-')
+
+
+def _parse_fixed(value):
+    """
+    Fast path: parse a 'YYYY:MM:DD HH:MM:SS' (or 'YYYY-MM-DD HH:MM:SS') string by slicing
+    Returns a datetime or None if value is not in this layout
+    """
+    if len(value) != 19 or value[10] != ' ' or value[13] != ':' or value[16] != ':':
+        return None
+    sep = value[4]
+    if sep not in _DATE_SEPARATORS or value[7] != sep:
+        return None
+    try:
+        return datetime.datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                                 int(value[11:13]), int(value[14:16]), int(value[17:19]))
+    except ValueError:
+        # out of range values (4545:45:45 ...) or not digits
+        return None
+
+
+def parse_date(value):
+    """
+    Parse a date string, exif layout first, any layout dateutil understands otherwise
+    Parameters:
+    - value: the date string
+    Returns a naive datetime, raises ValueError (or OverflowError) if value is not a date
+    """
+    res = _parse_fixed(value)
+    if res is None:
+        res = parse(value)
+    return res
+
+
+def to_timestamp(value):
+    """
+    Returns the epoch timestamp of a local naive datetime
+    """
+    return time.mktime(value.timetuple())
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import hashlib
+import mmap
+import os
+import shutil
+import sys
+
+# hashing buffer size: hashlib releases the GIL while digesting such a chunk
+CHUNK_SIZE = 1024 * 1024
+# files bigger than this are hashed through a read only mmap (no read copy)
+MMAP_THRESHOLD = 64 * 1024 * 1024
+# python 2 mmap objects can't be viewed by a memoryview: files are always read by chunks
+MMAP_VIEW = sys.version_info.major > 2
+
+
+def sha1_file(path, chunk_size=CHUNK_SIZE, mmap_threshold=MMAP_THRESHOLD):
+    """
+    Compute the sha1 hex digest of a file, reading it by chunks
+    Memory usage is bounded by chunk_size whatever the file size
+    Parameters:
+    - path: the file full path
+    - chunk_size: the read buffer size
+    - mmap_threshold: files bigger than this are mapped instead of read (None to disable)
+    Returns the hex digest as a string
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if MMAP_VIEW and mmap_threshold is not None and size >= mmap_threshold:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                # slicing the map itself would copy each chunk
+                view = memoryview(m)
+                try:
+                    for offset in range(0, size, chunk_size):
+                        sha1.update(view[offset:offset + chunk_size])
+                finally:
+                    # the map can't be closed while it is exported
+                    view.release()
+            finally:
+                m.close()
+        else:
+            buf = bytearray(chunk_size)
+            view = memoryview(buf)
+            n = f.readinto(buf)
+            while n:
+                sha1.update(view[:n])
+                n = f.readinto(buf)
+    return sha1.hexdigest()
+
+
+def sha1_copy(src, dest, chunk_size=CHUNK_SIZE):
+    """
+    Copy a file and compute its sha1 hex digest in a single read of the source
+    The destination gets the permission bits of the source (as shutil.copy)
+    Parameters:
+    - src: the source file full path
+    - dest: the destination file full path, removed if the copy fails
+    - chunk_size: the read buffer size
+    Returns the hex digest as a string
+    """
+    sha1 = hashlib.sha1()
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    try:
+        with open(src, 'rb') as fsrc:
+            with open(dest, 'wb') as fdest:
+                n = fsrc.readinto(buf)
+                while n:
+                    chunk = view[:n]
+                    sha1.update(chunk)
+                    fdest.write(chunk)
+                    n = fsrc.readinto(buf)
+        shutil.copymode(src, dest)
+    except Exception:
+        if os.path.lexists(dest):
+            os.remove(dest)
+        raise
+    return sha1.hexdigest()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import fcntl
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TimeBasedIdAllocator:
+
+    """
+    Hands out the 14 digits ids expected by Lychee: an epoch timestamp (10 digits)
+    followed by a 4 digits sequence
+    Ids are strictly increasing and never collide, no db lookup is needed:
+    - the allocator starts above the highest id already in db (floor)
+    - a lock protects the sequence between threads of a process
+    - ids are reserved by blocks in a shared high-water mark file protected by flock,
+      so several lycheesync processes allocating at once never get the same id
+    """
+
+    def __init__(self, floor=0, sharedpath=None, blocksize=100):
+        """
+        Parameters:
+        - floor: the highest id already in use
+        - sharedpath: the high-water mark file shared between processes (None: no inter process reservation)
+        - blocksize: the number of ids reserved at once in the shared file
+        """
+        self.last = int(floor or 0)
+        self.blockend = self.last
+        self.sharedpath = sharedpath
+        self.blocksize = blocksize
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def sharedPathFor(lycheepath):
+        """
+        Returns the high-water mark file path used for a given lychee installation
+        """
+        m = hashlib.md5()
+        m.update(os.path.abspath(lycheepath).encode('utf-8'))
+        return os.path.join(tempfile.gettempdir(), "lycheesync-" + m.hexdigest() + ".ids")
+
+    def _reserve(self, start):
+        """
+        Reserve a block of ids starting at least at start in the shared file
+        Returns the first id of the block
+        """
+        with open(self.sharedpath, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read().strip()
+                if content:
+                    start = max(start, int(content) + 1)
+                f.seek(0)
+                f.truncate()
+                f.write(str(start + self.blocksize - 1))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return start
+
+    def next(self):
+        """
+        Returns a new uniq id as a 14 characters string
+        """
+        with self.lock:
+            candidate = max(self.last + 1, int(time.time()) * 10000)
+            if self.sharedpath and candidate > self.blockend:
+                candidate = self._reserve(candidate)
+                self.blockend = candidate + self.blocksize - 1
+            self.last = candidate
+        return str(candidate)
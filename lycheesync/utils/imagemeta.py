@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import struct
+from PIL import Image
+from PIL.ExifTags import TAGS
+
+logger = logging.getLogger(__name__)
+
+# exif tags used by lycheesync, by ifd
+IFD0_TAGS = {
+    0x010F: 'Make',
+    0x0110: 'Model',
+    0x0112: 'Orientation',
+    0x0132: 'DateTime',
+}
+EXIF_TAGS = {
+    0x829A: 'ExposureTime',
+    0x8827: 'ISOSpeedRatings',
+    0x9003: 'DateTimeOriginal',
+    0x9201: 'ShutterSpeedValue',
+    0x9205: 'MaxApertureValue',
+    0x920A: 'FocalLength',
+}
+EXIF_IFD_POINTER = 0x8769
+RATIONAL_TAGS = ['ExposureTime', 'ShutterSpeedValue', 'MaxApertureValue', 'FocalLength']
+
+# tiff type -> (struct format, size)
+TIFF_TYPES = {
+    1: ('B', 1),
+    2: ('s', 1),
+    3: ('H', 2),
+    4: ('I', 4),
+    5: ('II', 8),
+    7: ('B', 1),
+    9: ('i', 4),
+    10: ('ii', 8),
+}
+
+# JPEG start of frame markers (they hold the dimensions)
+SOF_MARKERS = set([0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF])
+
+
+def _tiff_value(data, endian, kind, count, raw):
+    fmt, size = TIFF_TYPES[kind]
+    total = size * count
+    if total > 4:
+        offset = struct.unpack(endian + 'I', raw)[0]
+        raw = data[offset:offset + total]
+    if count == 0 or len(raw) < min(total, 4) or (total > 4 and len(raw) < total):
+        # truncated
+        return None
+    if kind == 2:
+        return raw[:total].split(b'\x00')[0].decode('utf-8', 'replace').strip()
+    # only the first value is used
+    value = struct.unpack(endian + fmt, raw[:size])
+    if kind in (5, 10):
+        return float(value[0]) / value[1] if value[1] else None
+    return value[0]
+
+
+def _tiff_ifd(data, endian, offset, tags, res):
+    """
+    Read the wanted tags of a tiff ifd into res
+    Returns the ifd entries as a {tag: (type, count, raw value)} dictionary
+    """
+    entries = {}
+    count = struct.unpack(endian + 'H', data[offset:offset + 2])[0]
+    for i in range(count):
+        entry = data[offset + 2 + i * 12:offset + 14 + i * 12]
+        if len(entry) != 12:
+            break
+        tag, kind, n = struct.unpack(endian + 'HHI', entry[:8])
+        entries[tag] = (kind, n, entry[8:])
+        if tag in tags and kind in TIFF_TYPES:
+            value = _tiff_value(data, endian, kind, n, entry[8:])
+            if value is not None:
+                res[tags[tag]] = value
+    return entries
+
+
+def parse_exif(data):
+    """
+    Parse the tiff structure of an exif block (without the 'Exif' header)
+    Only the tags used by lycheesync are decoded (no maker notes, no thumbnail)
+    Returns a {tag name: value} dictionary, rationals as float
+    """
+    res = {}
+    endian = {b'II': '<', b'MM': '>'}.get(data[:2])
+    if endian is None or len(data) < 8:
+        return res
+    ifd0 = struct.unpack(endian + 'I', data[4:8])[0]
+    entries = _tiff_ifd(data, endian, ifd0, IFD0_TAGS, res)
+    if EXIF_IFD_POINTER in entries:
+        kind, n, raw = entries[EXIF_IFD_POINTER]
+        _tiff_ifd(data, endian, struct.unpack(endian + 'I', raw)[0], EXIF_TAGS, res)
+    return res
+
+
+def _read_jpeg(f):
+    width = height = exif = None
+    while True:
+        marker = f.read(2)
+        if len(marker) != 2 or marker[0:1] != b'\xff':
+            return None
+        code = ord(marker[1:2])
+        if code in (0xD9, 0xDA):
+            # end of image or start of scan without frame header
+            return None
+        length = struct.unpack('>H', f.read(2))[0]
+        if code == 0xE1 and exif is None:
+            segment = f.read(length - 2)
+            if segment[:6] == b'Exif\x00\x00':
+                exif = parse_exif(segment[6:])
+        elif code in SOF_MARKERS:
+            height, width = struct.unpack('>HH', f.read(5)[1:5])
+            # exif comes before the frame header: everything is known
+            return {'width': width, 'height': height, 'exif': exif}
+        else:
+            f.seek(length - 2, 1)
+
+
+def _read_png(f):
+    width = height = None
+    while True:
+        header = f.read(8)
+        if len(header) != 8:
+            return None
+        length, kind = struct.unpack('>I4s', header)
+        if kind == b'IHDR':
+            width, height = struct.unpack('>II', f.read(8))
+            f.seek(length - 8 + 4, 1)
+        elif kind == b'eXIf':
+            exif = parse_exif(f.read(length))
+            return {'width': width, 'height': height, 'exif': exif}
+        elif kind in (b'IDAT', b'IEND'):
+            # exif, if any, is before the image data
+            return {'width': width, 'height': height, 'exif': None}
+        else:
+            f.seek(length + 4, 1)
+
+
+def read_header_metadata(path):
+    """
+    Read the dimensions and exif tags of a JPEG or PNG file from its header only,
+    nothing is decoded and the read stops at the image data
+    Returns a dictionary with width, height and exif (None if the file has no exif) keys,
+    or None if the file is not a well formed JPEG / PNG
+    """
+    with open(path, 'rb') as f:
+        signature = f.read(8)
+        try:
+            if signature[:2] == b'\xff\xd8':
+                f.seek(2)
+                res = _read_jpeg(f)
+            elif signature == b'\x89PNG\r\n\x1a\n':
+                res = _read_png(f)
+            else:
+                return None
+        except struct.error:
+            # truncated header
+            return None
+    if res is None or not(res['width']) or not(res['height']):
+        return None
+    return res
+
+
+def _pil_value(name, value):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    if hasattr(value, 'numerator') and hasattr(value, 'denominator'):
+        return float(value.numerator) / value.denominator if value.denominator else None
+    if isinstance(value, tuple):
+        if name in RATIONAL_TAGS and len(value) == 2 and not(isinstance(value[0], tuple)):
+            # old PIL rational: (numerator, denominator)
+            return float(value[0]) / value[1] if value[1] else None
+        return _pil_value(name, value[0]) if value else None
+    if isinstance(value, str):
+        return value.split('\x00')[0].strip()
+    return value
+
+
+def read_pil_metadata(path):
+    """
+    Same as read_header_metadata, for any image format PIL can open
+    Raises IOError if PIL can't open the file
+    """
+    img = Image.open(path)
+    try:
+        w, h = img.size
+        exif = None
+        if hasattr(img, '_getexif'):
+            try:
+                exifinfo = img._getexif()
+            except Exception as e:
+                exifinfo = None
+                logger.warn('Could not obtain exif info for image: %s', e)
+            if exifinfo is not None:
+                wanted = set(IFD0_TAGS.values()) | set(EXIF_TAGS.values())
+                exif = {}
+                for tag, value in exifinfo.items():
+                    name = TAGS.get(tag, tag)
+                    if name in wanted:
+                        value = _pil_value(name, value)
+                        if value is not None:
+                            exif[name] = value
+        return {'width': w, 'height': h, 'exif': exif}
+    finally:
+        img.close()
+
+
+def read_metadata(path):
+    """
+    Read the dimensions and exif tags of an image file, from its header if it's a JPEG or a PNG,
+    with PIL otherwise
+    Returns a dictionary with width, height and exif keys
+    """
+    res = read_header_metadata(path)
+    if res is None:
+        res = read_pil_metadata(path)
+    return res
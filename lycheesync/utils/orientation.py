@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import os
+import shutil
+import struct
+import subprocess
+from PIL import Image
+
+try:
+    from shutil import which
+except ImportError:
+    # python 2
+    from distutils.spawn import find_executable as which
+
+logger = logging.getLogger(__name__)
+
+ORIENTATION_TAG = 0x0112
+
+# exif orientation -> PIL transposition displaying the photo upright
+TRANSPOSE = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
+
+# exif orientation -> jpegtran arguments doing the same transposition on the DCT blocks
+JPEGTRAN_ARGS = {
+    2: ['-flip', 'horizontal'],
+    3: ['-rotate', '180'],
+    4: ['-flip', 'vertical'],
+    5: ['-transpose'],
+    6: ['-rotate', '90'],
+    7: ['-transverse'],
+    8: ['-rotate', '270'],
+}
+
+
+def transpose_image(img, orientation):
+    """
+    Returns img displayed upright according to the exif orientation (img itself if nothing to do)
+    """
+    if orientation in TRANSPOSE:
+        return img.transpose(TRANSPOSE[orientation])
+    return img
+
+
+def orientation_offset(f):
+    """
+    Find the orientation tag value in a JPEG file exif header, without decoding anything
+    Parameters:
+    - f: the file opened in binary mode
+    Returns an (offset, byte order) tuple, offset is None if the file has no orientation tag
+    """
+    f.seek(0)
+    if f.read(2) != b'\xff\xd8':
+        return None, None
+    while True:
+        marker = f.read(2)
+        if len(marker) != 2 or marker[0:1] != b'\xff' or marker[1:2] in (b'\xd9', b'\xda'):
+            # end of image or start of scan: no more header
+            return None, None
+        length = struct.unpack('>H', f.read(2))[0]
+        start = f.tell()
+        if marker[1:2] == b'\xe1' and f.read(6) == b'Exif\x00\x00':
+            tiff = f.tell()
+            order = f.read(2)
+            endian = {b'II': '<', b'MM': '>'}.get(order)
+            if endian is None:
+                return None, None
+            f.read(2)
+            ifd = struct.unpack(endian + 'I', f.read(4))[0]
+            f.seek(tiff + ifd)
+            count = struct.unpack(endian + 'H', f.read(2))[0]
+            for i in range(count):
+                entry = f.read(12)
+                if len(entry) != 12:
+                    break
+                tag, kind = struct.unpack(endian + 'HH', entry[:4])
+                if tag == ORIENTATION_TAG and kind == 3:
+                    # SHORT value stored in the first 2 bytes of the value field
+                    return tiff + ifd + 2 + i * 12 + 8, endian
+            return None, None
+        f.seek(start + length - 2)
+
+
+def write_orientation(path, orientation):
+    """
+    Overwrite the exif orientation tag of a JPEG file in place, every other byte is left untouched
+    Returns True if the tag has been found and written
+    """
+    with open(path, 'r+b') as f:
+        offset, endian = orientation_offset(f)
+        if offset is None:
+            return False
+        f.seek(offset)
+        f.write(struct.pack(endian + 'H', orientation))
+    return True
+
+
+def jpegtran_rotate(path, orientation):
+    """
+    Losslessly transpose the DCT blocks of a JPEG file with jpegtran (if installed) then reset its orientation tag
+    jpegtran is run with -perfect: photos whose size is not a multiple of the block size are left untouched
+    Returns True if the file has been rotated
+    """
+    jpegtran = which('jpegtran')
+    if not(jpegtran) or orientation not in JPEGTRAN_ARGS:
+        return False
+    tmp = path + ".rot"
+    cmd = [jpegtran, '-copy', 'all', '-perfect'] + JPEGTRAN_ARGS[orientation] + ['-outfile', tmp, path]
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            subprocess.check_call(cmd, stderr=devnull)
+        if not(write_orientation(tmp, 1)):
+            raise IOError("orientation tag not found after jpegtran: " + path)
+        shutil.copymode(path, tmp)
+        os.rename(tmp, path)
+        return True
+    except Exception as e:
+        logger.debug("lossless rotation failed for %s: %s", path, e)
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        return False
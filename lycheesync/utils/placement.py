@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import errno
+import logging
+import os
+import shutil
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# linux ioctl sharing the data blocks of two files (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# every placement mode, fastest first
+MODES = ['reflink', 'hardlink', 'copy_file_range', 'sendfile', 'copy']
+
+# errors meaning a mode is not supported for a filesystem pair (any other error is a real failure)
+UNSUPPORTED = set(getattr(errno, name) for name in
+                  ['EXDEV', 'EOPNOTSUPP', 'ENOTSUP', 'ENOTTY', 'EINVAL', 'ENOSYS', 'EPERM', 'EBADF']
+                  if hasattr(errno, name))
+
+
+class UnsupportedMode(Exception):
+    pass
+
+
+class FilePlacer:
+
+    """
+    Places files (photos) in a destination directory with the fastest mode supported
+    by the source / destination filesystem pair:
+    - reflink: the destination shares the source data blocks (copy on write)
+    - hardlink: the destination is the source inode (same device only)
+    - copy_file_range, sendfile: in kernel copy, no data goes through python
+    - copy: plain copy
+    The first mode working for a pair of devices is remembered and used for the next files
+    """
+
+    def __init__(self, modes=None):
+        """
+        Parameters:
+        - modes: the modes to try in this order (default: every mode)
+        """
+        self.modes = [m for m in (modes or MODES) if m in MODES]
+        if 'copy' not in self.modes:
+            self.modes.append('copy')
+        # (source device, destination device) -> index of the mode to use in self.modes
+        self.chosen = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _pair(src, dest):
+        return (os.stat(src).st_dev, os.stat(os.path.dirname(dest) or '.').st_dev)
+
+    def modeFor(self, src, dest):
+        """
+        Returns the mode that will be used to place src at dest
+        (the first one to try if the filesystem pair has not been probed yet)
+        """
+        with self.lock:
+            return self.modes[self.chosen.get(self._pair(src, dest), 0)]
+
+    def place(self, src, dest):
+        """
+        Place src at dest, the destination gets the permission bits of the source (as shutil.copy)
+        Parameters:
+        - src: the source file full path
+        - dest: the destination file full path, must not exist
+        Returns the mode used
+        """
+        pair = self._pair(src, dest)
+        with self.lock:
+            index = self.chosen.get(pair, 0)
+        while True:
+            mode = self.modes[index]
+            try:
+                getattr(self, '_' + mode)(src, dest)
+                break
+            except UnsupportedMode as e:
+                if os.path.lexists(dest):
+                    os.remove(dest)
+                index += 1
+                with self.lock:
+                    if self.chosen.get(pair, 0) < index:
+                        logger.debug("placement mode %s not supported for devices %s: %s", mode, pair, e)
+                        self.chosen[pair] = index
+            except Exception:
+                if os.path.lexists(dest):
+                    os.remove(dest)
+                raise
+        if mode != 'hardlink':
+            shutil.copymode(src, dest)
+        return mode
+
+    @staticmethod
+    def _unsupported(e):
+        if isinstance(e, (OSError, IOError)) and e.errno in UNSUPPORTED:
+            return UnsupportedMode(e)
+        return e
+
+    def _reflink(self, src, dest):
+        if fcntl is None:
+            raise UnsupportedMode("no fcntl")
+        with open(src, 'rb') as fsrc:
+            with open(dest, 'wb') as fdest:
+                try:
+                    fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+                except Exception as e:
+                    raise self._unsupported(e)
+
+    def _hardlink(self, src, dest):
+        try:
+            os.link(src, dest)
+        except Exception as e:
+            raise self._unsupported(e)
+
+    def _kernelCopy(self, src, dest, func):
+        with open(src, 'rb') as fsrc:
+            with open(dest, 'wb') as fdest:
+                size = os.fstat(fsrc.fileno()).st_size
+                copied = 0
+                while copied < size:
+                    try:
+                        n = func(fsrc.fileno(), fdest.fileno(), size - copied, copied)
+                    except Exception as e:
+                        raise self._unsupported(e)
+                    if n == 0:
+                        break
+                    copied += n
+                if copied != size:
+                    # the source shrank during the copy (the partial destination is removed by place)
+                    raise IOError(errno.EIO, "short copy of %s: %s of %s bytes" % (src, copied, size))
+
+    def _copy_file_range(self, src, dest):
+        if not(hasattr(os, 'copy_file_range')):
+            raise UnsupportedMode("no os.copy_file_range")
+        self._kernelCopy(
+            src, dest, lambda fin, fout, count, offset: os.copy_file_range(fin, fout, count, offset, offset))
+
+    def _sendfile(self, src, dest):
+        if not(hasattr(os, 'sendfile')):
+            raise UnsupportedMode("no os.sendfile")
+        self._kernelCopy(src, dest, lambda fin, fout, count, offset: os.sendfile(fout, fin, offset, count))
+
+    def _copy(self, src, dest):
+        shutil.copyfile(src, dest)
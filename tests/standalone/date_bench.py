@@ -0,0 +1,39 @@
+import random
+import time
+from dateutil.parser import parse
+from lycheesync.utils.dates import parse_date, to_timestamp
+
+
+def exif_dates(n):
+    random.seed(42)
+    res = []
+    for i in range(n):
+        res.append("%04d:%02d:%02d %02d:%02d:%02d" % (
+            random.randint(1990, 2020), random.randint(1, 12), random.randint(1, 28),
+            random.randint(0, 23), random.randint(0, 59), random.randint(0, 59)))
+    return res
+
+
+def bench(name, func, values):
+    start = time.time()
+    for v in values:
+        func(v)
+    elapsed = time.time() - start
+    print("%-30s %8.3fs  %10.0f dates/s" % (name, elapsed, len(values) / elapsed))
+    return elapsed
+
+
+def main():
+    n = 100000
+    values = exif_dates(n)
+    # lycheesync used to parse the takedate with ':' replaced by '-'
+    dashed = [v.replace(':', '-', 2) for v in values]
+    print("parsing %s exif dates" % n)
+    ref = bench("dateutil parse", parse, dashed)
+    fast = bench("parse_date", parse_date, values)
+    bench("parse_date + to_timestamp", lambda v: to_timestamp(parse_date(v)), values)
+    print("speedup: x%.1f" % (ref / fast))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,12 +6,28 @@ import subprocess
 import os
 import shutil
 import time
+import filecmp
+import hashlib
+import glob
+import tempfile
 import datetime
 from tests.testutils import TestUtils
 from click.testing import CliRunner
 from lycheesync.sync import main
+from lycheesync.lycheesyncer import LycheeSyncer
+from lycheesync.lycheedao import LycheeDAO
+from lycheesync.utils.placement import FilePlacer, UnsupportedMode
+from lycheesync.utils.filehash import sha1_file
+from lycheesync.utils.imagemeta import read_header_metadata, read_pil_metadata
+from lycheesync.update_scripts.inf_to_lychee_2_6_2 import ChecksumMigration, checkpoint_path_for
+from lycheesync.lycheeschema import INDEXES as SCHEMA_INDEXES
+from lycheesync.lycheepool import LycheeConnectionPool, RetryDictCursor
 from PIL import Image
 import piexif
+import sqlite3
+import threading
+import pymysql
+import json
 
 logger = logging.getLogger(__name__)
 
@@ -143,6 +159,52 @@ class TestClass:
 
         assert (real_date == theorical_date), "album date is 2011/11/11 11:11:11"
 
+    def test_album_date_mode(self):
+        # album date recomputed in db from the photos of previous runs
+        tu = TestUtils()
+        assert tu.is_env_clean(tu.conf['lycheepath']), "env not clean"
+        tu.load_photoset("real_date")
+        src = tu.conf['testphotopath']
+        lych = tu.conf['lycheepath']
+
+        runner = CliRunner()
+        result = runner.invoke(main, [src, lych, tu.conf['conf'], '-v'])
+        assert result.exit_code == 0, "process result is ok"
+
+        db = tu._connect_db()
+        try:
+            tu._exec_sql(db, "update lychee_albums set sysstamp=0 where title='real_date'")
+        finally:
+            db.close()
+
+        # nothing imported: the default mode leaves the album date unchanged
+        result = runner.invoke(main, [src, lych, tu.conf['conf'], '-v'])
+        assert result.exit_code == 0, "process result is ok"
+        assert tu.get_album_creation_date('real_date') == 0
+
+        for mode in ["touched", "all"]:
+            result = runner.invoke(main, [src, lych, tu.make_conf(albumDateMode=mode), '-v'])
+            assert result.exit_code == 0, "process result is ok"
+            real_date = datetime.datetime.fromtimestamp(tu.get_album_creation_date('real_date'))
+            assert real_date == datetime.datetime(2011, 11, 11, 11, 11, 11), "album date is 2011/11/11 11:11:11"
+
+        # a photo without exif date has no takestamp: it is ignored even if its id is ahead of the clock
+        shutil.copy(os.path.join(os.path.dirname(__file__), "pics", "album1", "large.1.jpg"),
+                    os.path.join(src, "real_date"))
+        result = runner.invoke(main, [src, lych, tu.conf['conf'], '-v'])
+        assert result.exit_code == 0, "process result is ok"
+        photos = [p for p in tu.get_photos(tu.get_album_id('real_date')) if p['title'] == 'large.1.jpg']
+        assert photos[0]['takestamp'] is None, "a photo without exif date should have no takestamp"
+        db = tu._connect_db()
+        try:
+            tu._exec_sql(db, "update lychee_photos set id=id+36000000 where title='large.1.jpg'")
+        finally:
+            db.close()
+        result = runner.invoke(main, [src, lych, tu.make_conf(albumDateMode="touched"), '-v'])
+        assert result.exit_code == 0, "process result is ok"
+        real_date = datetime.datetime.fromtimestamp(tu.get_album_creation_date('real_date'))
+        assert real_date == datetime.datetime(2011, 11, 11, 11, 11, 11), "album date is 2011/11/11 11:11:11"
+
     def test_dash_r(self):
         try:
             tu = TestUtils()
@@ -347,6 +409,43 @@ class TestClass:
         for x in ordered_list:
             assert (tu.get_album_id(x[1]) == x[0]), "element not ordered " + x[1]
 
+    def test_dash_s_incremental(self):
+        # -s only changes the ids of the albums out of order
+        tu = TestUtils()
+        assert tu.is_env_clean(tu.conf['lycheepath']), "env not clean"
+        tu.load_photoset("aaa")
+        tu.load_photoset("zzzz")
+        src = tu.conf['testphotopath']
+        lych = tu.conf['lycheepath']
+        conf = tu.conf['conf']
+
+        runner = CliRunner()
+        result = runner.invoke(main, [src, lych, conf, '-v', '-s'])
+        assert result.exit_code == 0, "process result is ok"
+        first = dict((x['title'], x['id']) for x in tu.get_album_ids_titles())
+
+        # already sorted: nothing changes
+        result = runner.invoke(main, [src, lych, conf, '-v', '-s'])
+        assert result.exit_code == 0, "process result is ok"
+        assert dict((x['title'], x['id']) for x in tu.get_album_ids_titles()) == first
+
+        # a new album sorted in the middle: the first album keeps its id
+        tu.load_photoset("mini")
+        result = runner.invoke(main, [src, lych, conf, '-v', '-s'])
+        assert result.exit_code == 0, "process result is ok"
+        ids = dict((x['title'], x['id']) for x in tu.get_album_ids_titles())
+        assert ids['aaa'] == first['aaa']
+        assert ids['aaa'] < ids['mini'] < ids['zzzz']
+        assert tu.check_album_size('mini')
+
+        # ids are spread: the next album sorted in the middle moves alone
+        tu.load_photoset("album1")
+        result = runner.invoke(main, [src, lych, conf, '-v', '-s'])
+        assert result.exit_code == 0, "process result is ok"
+        second = dict((x['title'], x['id']) for x in tu.get_album_ids_titles())
+        assert dict((k, second[k]) for k in ids) == ids, "sorted albums should keep their id"
+        assert second['aaa'] < second['album1'] < second['mini']
+
     def test_dash_l(self):
         # load album y
         tu = TestUtils()
@@ -844,6 +943,39 @@ class TestClass:
         assert not(os.path.exists(a_photo_3)), "{} should have been deleted as an orphan".format(a_photo_3)
         assert not(os.path.exists(a_photo_4)), "{} should have been deleted as an orphan".format(a_photo_4)
 
+    def test_sanity_thumbnail(self):
+        # a photo without thumbnail is removed by the sanity check and imported again by the next run
+        tu = TestUtils()
+        assert tu.is_env_clean(tu.conf['lycheepath']), "env not clean"
+        tu.load_photoset("album3")
+        src = tu.conf['testphotopath']
+        lych = tu.conf['lycheepath']
+        conf = tu.conf['conf']
+
+        runner = CliRunner()
+        result = runner.invoke(main, [src, lych, conf, '-v'])
+        assert result.exit_code == 0, "process result is ok"
+        self.check_grand_total(1, 4)
+
+        photo = tu.get_photos(tu.get_album_id('album3'))[0]
+        os.remove(os.path.join(lych, "uploads", "thumb", photo['url']))
+        result = runner.invoke(main, [src, lych, conf, '-v', '-c'])
+        assert result.exit_code == 0, "process result is ok"
+        assert not tu.photo_exists_in_db(photo['id']), "photo without thumbnail should have been deleted"
+        assert not os.path.lexists(os.path.join(lych, "uploads", "big", photo['url']))
+
+        result = runner.invoke(main, [src, lych, conf, '-v'])
+        assert result.exit_code == 0, "process result is ok"
+        self.check_grand_total(1, 4)
+
+        # a missing @2x thumbnail (older lychee versions) is only reported
+        photo = tu.get_photos(tu.get_album_id('album3'))[0]
+        os.remove(os.path.join(lych, "uploads", "thumb", LycheeSyncer.thumbnailNames(photo['url'])[1]))
+        result = runner.invoke(main, [src, lych, conf, '-v', '-c'])
+        assert result.exit_code == 0, "process result is ok"
+        assert tu.photo_exists_in_db(photo['id']), "photo without @2x thumbnail should be kept"
+        assert os.path.lexists(os.path.join(lych, "uploads", "big", photo['url']))
+
     def test_visually_check_logs(self):
         # load "bad taketime"  album name
         tu = TestUtils()
@@ -869,3 +1001,730 @@ class TestClass:
         assert tu.count_fs_photos() == 10, "there are duplicate photos in fs"
         assert tu.count_db_photos() == 10, "there are duplicate photos in db"
         assert tu.count_fs_thumb() == 10, "there are duplicate photos in thumb"
+
+    @staticmethod
+    def count_hashed(monkeypatch):
+        """ count the photos hashed by the sync (names of the photos reaching the fingerprint stage) """
+        hashed = []
+        fingerprint_stage = LycheeSyncer.fingerprintStage
+
+        def counting_stage(syncer, task):
+            if not(task.get('end')):
+                hashed.append(task['name'])
+            return fingerprint_stage(syncer, task)
+        monkeypatch.setattr(LycheeSyncer, 'fingerprintStage', counting_stage)
+        return hashed
+
+    def test_manifest(self, monkeypatch):
+        tu = TestUtils()
+        assert tu.is_env_clean(tu.conf['lycheepath']), "env not clean"
+        tu.load_photoset("album3")
+        # launch lycheesync
+        src = tu.conf['testphotopath']
+        lych = tu.conf['lycheepath']
+        manifest_path = tu.tmp_path('tmp_manifest.sqlite')
+        tu.remove_tmp_files()
+        conf = tu.make_conf(manifestPath=manifest_path)
+        hashed = self.count_hashed(monkeypatch)
+        try:
+            # run twice, second run should skip unchanged files
+            runner = CliRunner()
+            result = runner.invoke(main, [src, lych, conf, '-v'])
+            assert result.exit_code == 0, "process result is ok"
+            assert len(hashed) == 4
+            del hashed[:]
+            result = runner.invoke(main, [src, lych, conf, '-v'])
+            assert result.exit_code == 0, "process result is ok"
+            assert hashed == [], "unchanged files should not be hashed"
+
+            self.check_grand_total(1, 4)
+            db = sqlite3.connect(manifest_path)
+            try:
+                nb_entries = db.execute("select count(1) from manifest").fetchone()[0]
+            finally:
+                db.close()
+            assert nb_entries == 4, "every imported photo should be in the manifest"
+
+            # a photo removed from lychee is re-imported even if unchanged
+            photos = tu.get_photos(tu.get_album_id('album3'))
+            db = tu._connect_db()
+            try:
+                tu._exec_sql(db, "delete from lychee_photos where id={}".format(photos[0]['id']))
+            finally:
+                db.close()
+            result = runner.invoke(main, [src, lych, conf, '-v', '-c'])
+            assert result.exit_code == 0, "process result is ok"
+            self.check_grand_total(1, 4)
+        finally:
+            tu.remove_tmp_files()
+
+    def test_manifest_existing_library(self, monkeypatch):
+        # photos imported before the manifest existed are recorded once, then no longer hashed
+        tu = TestUtils()
+        assert tu.is_env_clean(tu.conf['lycheepath']), "env not clean"
+        tu.load_photoset("album3")
+        src = tu.conf['testphotopath']
+        lych = tu.conf['lycheepath']
+        manifest_path = tu.tmp_path('tmp_manifest.sqlite')
+        tu.remove_tmp_files()
+        try:
+            runner = CliRunner()
+            result = runner.invoke(main, [src, lych, tu.conf['conf'], '-v'])
+            assert result.exit_code == 0, "process result is ok"
+            # titles changed in lychee: the photos are only found by checksum
+            db = tu._connect_db()
+            try:
+                tu._exec_sql(db, "update lychee_photos set title=concat('renamed ', title)")
+            finally:
+                db.close()
+
+            conf = tu.make_conf(manifestPath=manifest_path)
+            hashed = self.count_hashed(monkeypatch)
+            result = runner.invoke(main, [src, lych, conf, '-v'])
+            assert result.exit_code == 0, "process result is ok"
+            assert len(hashed) == 4, "the existing photos are hashed once"
+            del hashed[:]
+            result = runner.invoke(main, [src, lych, conf, '-v'])
+            assert result.exit_code == 0, "process result is ok"
+            assert hashed == [], "existing photos should be recorded in the manifest"
+            self.check_grand_total(1, 4)
+        finally:
+            tu.remove_tmp_files()
+
+    def test_duplicates_not_copied(self, monkeypatch):
+        # photos of an existing album are hashed in place: a duplicate is never written to lychee
+        tu = TestUtils()
+        assert tu.is_env_clean(tu.conf['lycheepath']), "env not clean"
+        tu.load_photoset("album3")
+        src = tu.conf['testphotopath']
+        lych = tu.conf['lycheepath']
+        runner = CliRunner()
+        result = runner.invoke(main, [src, lych, tu.conf['conf'], '-v'])
+        assert result.exit_code == 0, "process result is ok"
+
+        # titles changed in lychee: the photos are only found as duplicates by checksum
+        db = tu._connect_db()
+        try:
+            tu._exec_sql(db, "update lychee_photos set title=concat('renamed ', title)")
+        finally:
+            db.close()
+        removed = []
+        monkeypatch.setattr('lycheesync.lycheesyncer.remove_file', removed.append)
+        result = runner.invoke(main, [src, lych, tu.conf['conf'], '-v'])
+        assert result.exit_code == 0, "process result is ok"
+        assert removed == [], "duplicates should not be copied then removed"
+        self.check_grand_total(1, 4)
+
+    def test_hardlink_source_unchanged(self):
+        # rotated and permission fixed photos: the hardlinked sources must not be modified
+        tu = TestUtils()
+        assert tu.is_env_clean(tu.conf['lycheepath']), "env not clean"
+        tu.load_photoset("rotation")
+        src = tu.conf['testphotopath']
+        lych = tu.conf['lycheepath']
+
+        def snapshot():
+            res = {}
+            for root, dirs, files in os.walk(src):
+                for f in files:
+                    path = os.path.join(root, f)
+                    with open(path, 'rb') as fd:
+                        res[path] = (fd.read(), os.stat(path).st_mode, os.stat(path).st_gid)
+            return res
+        before = snapshot()
+
+        runner = CliRunner()
+        # hardlink is ignored without losslessRotation
+        result = runner.invoke(main, [src, lych, tu.make_conf(placement=["hardlink"]), '-v'])
+        assert result.exit_code == 0, "process result is ok"
+        assert snapshot() == before, "source photos should not be modified"
+
+        # drop mode: the photos are placed again
+        result = runner.invoke(main, [src, lych, tu.make_conf(placement=["hardlink"], losslessRotation=True), '-v', '-d'])
+        assert result.exit_code == 0, "process result is ok"
+        assert snapshot() == before, "source photos should not be modified"
+
+    def test_sha1_mmap(self, tmpdir):
+        # mapped and read files have the same digest, whatever the chunk boundaries
+        path = str(tmpdir.join('photo.jpg'))
+        data = os.urandom(3 * 1024 + 7)
+        with open(path, 'wb') as f:
+            f.write(data)
+        expected = hashlib.sha1(data).hexdigest()
+        assert sha1_file(path, chunk_size=1024, mmap_threshold=None) == expected
+        assert sha1_file(path, chunk_size=1024, mmap_threshold=0) == expected
+
+    def test_placement_copy(self, tmpdir):
+        src = str(tmpdir.join('src.jpg'))
+        dest = str(tmpdir.join('dest.jpg'))
+        with open(src, 'wb') as f:
+            f.write(b'photo')
+        placer = FilePlacer(['copy'])
+        assert placer.modeFor(src, dest) == 'copy'
+        assert placer.place(src, dest) == 'copy'
+        assert filecmp.cmp(src, dest, shallow=False)
+        assert not(os.path.samefile(src, dest)), "a copy is a new file"
+
+    def test_placement_short_copy(self, tmpdir):
+        # a copy ending before the end of the source is a failure, not a truncated photo
+        class ShortPlacer(FilePlacer):
+            def _sendfile(self, src, dest):
+                self._kernelCopy(src, dest, lambda fin, fout, count, offset: 0)
+
+        src = str(tmpdir.join('src.jpg'))
+        dest = str(tmpdir.join('dest.jpg'))
+        with open(src, 'wb') as f:
+            f.write(b'photo')
+        with pytest.raises(IOError):
+            ShortPlacer(['sendfile']).place(src, dest)
+        assert not(os.path.lexists(dest)), "the partial copy should be removed"
+
+    def test_placement_fallback(self, tmpdir):
+        # an unsupported mode is tried once per device pair, then the next mode is used
+        tried = []
+
+        class NoReflinkPlacer(FilePlacer):
+            def _reflink(self, src, dest):
+                tried.append(dest)
+                raise UnsupportedMode("no reflink here")
+
+        placer = NoReflinkPlacer(['reflink', 'copy'])
+        for name in ['a.jpg', 'b.jpg']:
+            src = str(tmpdir.join(name))
+            with open(src, 'wb') as f:
+                f.write(name.encode('ascii'))
+            dest = str(tmpdir.join('dest_' + name))
+            assert placer.place(src, dest) == 'copy'
+            assert filecmp.cmp(src, dest, shallow=False)
+        assert len(tried) == 1, "the unsupported mode is remembered"
+        assert placer.modeFor(src, dest) == 'copy'
+
+    def test_plan_apply(self):
+        tu = TestUtils()
+        assert tu.is_env_clean(tu.conf['lycheepath']), "env not clean"
+        tu.load_photoset("album1")
+        tu.load_photoset("album3")
+        src = tu.conf['testphotopath']
+        lych = tu.conf['lycheepath']
+        plan_path = tu.tmp_path('tmp_plan.jsonl')
+        tu.remove_tmp_files()
+        try:
+            # dry run: the plan is written, nothing is imported
+            runner = CliRunner()
+            result = runner.invoke(main, [src, lych, tu.conf['conf'], '-v', '--plan', plan_path])
+            assert result.exit_code == 0, "process result is ok"
+            assert tu.count_db_albums() == 0, "dry run should not create albums"
+            assert tu.count_fs_photos() == 0, "dry run should not import photos"
+            with open(plan_path) as f:
+                ops = [json.loads(line)['op'] for line in f]
+            assert ops.count('create_album') == 2
+            assert ops.count('add_photo') == 5
+
+            # apply the reviewed plan
+            result = runner.invoke(main, [src, lych, tu.conf['conf'], '-v', '--apply', plan_path])
+            assert result.exit_code == 0, "process result is ok"
+            self.check_grand_total(2, 5)
+
+            # a plan is either written or applied
+            result = runner.invoke(main, [src, lych, tu.conf['conf'], '--plan', plan_path, '--apply', plan_path])
+            assert result.exit_code == 2, "--plan and --apply together should be rejected"
+        finally:
+            tu.remove_tmp_files()
+
+    def test_plan_failure_cleanup(self, monkeypatch):
+        # the temporary plan is removed even if the planning fails
+        tu = TestUtils()
+        assert tu.is_env_clean(tu.conf['lycheepath']), "env not clean"
+        tu.load_photoset("album3")
+
+        def failing_plan(syncer, plan):
+            raise IOError("planning failed")
+        monkeypatch.setattr(LycheeSyncer, 'planSync', failing_plan)
+
+        def tmp_plans():
+            return set(glob.glob(os.path.join(tempfile.gettempdir(), "lycheesync-*.plan")))
+        before = tmp_plans()
+        runner = CliRunner()
+        runner.invoke(main, [tu.conf['testphotopath'], tu.conf['lycheepath'], tu.conf['conf'], '-v'])
+        assert tmp_plans() == before, "temporary plan left behind"
+        assert tu.count_db_photos() == 0
+
+    def test_directory_digest(self):
+        tu = TestUtils()
+        assert tu.is_env_clean(tu.conf['lycheepath']), "env not clean"
+        tu.load_photoset("album3")
+        src = tu.conf['testphotopath']
+        lych = tu.conf['lycheepath']
+        manifest_path = tu.tmp_path('tmp_manifest.sqlite')
+        plan_path = tu.tmp_path('tmp_plan.jsonl')
+        tu.remove_tmp_files()
+        conf = tu.make_conf(manifestPath=manifest_path)
+
+        def plan_ops():
+            result = runner.invoke(main, [src, lych, conf, '-v', '--plan', plan_path])
+            assert result.exit_code == 0, "process result is ok"
+            with open(plan_path) as f:
+                entries = [json.loads(line) for line in f]
+            os.remove(plan_path)
+            return entries
+
+        def directories():
+            db = sqlite3.connect(manifest_path)
+            try:
+                return db.execute("select path, mtime_ns, digest from directory order by path").fetchall()
+            finally:
+                db.close()
+
+        try:
+            runner = CliRunner()
+            result = runner.invoke(main, [src, lych, conf, '-v'])
+            assert result.exit_code == 0, "process result is ok"
+
+            # nothing changed: the whole source tree is skipped at once
+            entries = plan_ops()
+            assert [e['op'] for e in entries] == ['skip_album'], "unchanged tree should be pruned"
+
+            # a new directory is planned, the unchanged one is still pruned
+            tu.load_photoset("album1")
+            recorded = directories()
+            entries = plan_ops()
+            assert directories() == recorded, "a dry run should not record directories"
+            assert [e['path'] for e in entries if e['op'] == 'add_photo'] == [os.path.join(src, 'album1', 'large.1.jpg')]
+            assert os.path.join(src, 'album3') in [e['path'] for e in entries if e['op'] == 'skip_album']
+
+            # a photo removed from lychee is imported again even if its directory is unchanged
+            result = runner.invoke(main, [src, lych, conf, '-v'])
+            assert result.exit_code == 0, "process result is ok"
+            photos = tu.get_photos(tu.get_album_id('album3'))
+            db = tu._connect_db()
+            try:
+                tu._exec_sql(db, "delete from lychee_photos where id={}".format(photos[0]['id']))
+            finally:
+                db.close()
+            entries = plan_ops()
+            assert [e['album'] for e in entries if e['op'] == 'add_photo'] == ['album3']
+        finally:
+            tu.remove_tmp_files()
+
+    def test_commit_batches(self, monkeypatch):
+        # photos of a big album are committed every insertBatchSize photos, not once at the end of the album
+        tu = TestUtils()
+        assert tu.is_env_clean(tu.conf['lycheepath']), "env not clean"
+        tu.load_photoset("album3")
+        conf = tu.make_conf(insertBatchSize=2)
+        batches = []
+        commitPhotos = LycheeSyncer.commitPhotos
+
+        def counting_commit(syncer, album):
+            batches.append(len(album['queued']))
+            return commitPhotos(syncer, album)
+        monkeypatch.setattr(LycheeSyncer, 'commitPhotos', counting_commit)
+
+        runner = CliRunner()
+        result = runner.invoke(main, [tu.conf['testphotopath'], tu.conf['lycheepath'], conf, '-v'])
+        assert result.exit_code == 0, "process result is ok"
+        assert max(batches) <= 2, "queued photos should be bounded by insertBatchSize"
+        assert sum(batches) == 4
+        self.check_grand_total(1, 4)
+
+    def test_directory_digest_sort(self):
+        # -s sorts a new album among the unchanged albums skipped by the directory digest
+        tu = TestUtils()
+        assert tu.is_env_clean(tu.conf['lycheepath']), "env not clean"
+        tu.load_photoset("aaa")
+        tu.load_photoset("zzzz")
+        src = tu.conf['testphotopath']
+        lych = tu.conf['lycheepath']
+        tu.remove_tmp_files()
+        conf = tu.make_conf(manifestPath=tu.tmp_path('tmp_manifest.sqlite'))
+        try:
+            runner = CliRunner()
+            result = runner.invoke(main, [src, lych, conf, '-v', '-s'])
+            assert result.exit_code == 0, "process result is ok"
+
+            tu.load_photoset("mini")
+            result = runner.invoke(main, [src, lych, conf, '-v', '-s'])
+            assert result.exit_code == 0, "process result is ok"
+            ids = dict((x['title'], x['id']) for x in tu.get_album_ids_titles())
+            assert ids['aaa'] < ids['mini'] < ids['zzzz']
+            assert tu.count_db_albums() == 3
+            assert tu.check_album_size('mini')
+        finally:
+            tu.remove_tmp_files()
+
+    def test_insert_failure(self, monkeypatch):
+        # the batch insert and the check of the rows written both fail: the photos are not reported as failed
+        tu = TestUtils()
+        assert tu.is_env_clean(tu.conf['lycheepath']), "env not clean"
+        tu.load_photoset("album3")
+        src = tu.conf['testphotopath']
+        lych = tu.conf['lycheepath']
+
+        def failing_executemany(cursor, query, args):
+            raise pymysql.err.OperationalError(2013, "Lost connection to MySQL server during query")
+        execute = RetryDictCursor.execute
+
+        checks = []
+
+        def failing_execute(cursor, query, args=None):
+            if query.startswith("select id from lychee_photos where id in"):
+                checks.append(query)
+                raise pymysql.err.OperationalError(2013, "Lost connection to MySQL server during query")
+            return execute(cursor, query, args)
+        monkeypatch.setattr(RetryDictCursor, 'executemany', failing_executemany)
+        monkeypatch.setattr(RetryDictCursor, 'execute', failing_execute)
+
+        runner = CliRunner()
+        result = runner.invoke(main, [src, lych, tu.conf['conf'], '-v'])
+        assert result.exit_code == 0, "process result is ok"
+        assert len(checks) == LycheeDAO.check_attempts, "the check of the rows written should be retried"
+        assert tu.count_db_photos() == 0
+        # some rows may have been written: their files are kept
+        assert tu.count_fs_photos() == 4, "files of the photos in doubt should be kept"
+
+    def test_workers(self):
+        tu = TestUtils()
+        assert tu.is_env_clean(tu.conf['lycheepath']), "env not clean"
+        # same photosets as test_visually_check_logs: duplicates and corrupted files
+        tu.load_photoset("invalid_takedate")
+        tu.load_photoset("album2")
+        tu.load_photoset("album3")
+        tu.load_photoset("corrupted_file")
+        tu.load_photoset("duplicates")
+        # launch lycheesync
+        src = tu.conf['testphotopath']
+        lych = tu.conf['lycheepath']
+        conf = tu.conf['conf']
+
+        # run
+        runner = CliRunner()
+        result = runner.invoke(main, [src, lych, conf, '-v', '-w', '4'])
+        # no crash
+        assert result.exit_code == 0, "process result is ok"
+
+        # same result as a sequential run
+        assert tu.count_db_albums() == 7, "too much albums created"
+        assert tu.count_fs_photos() == 10, "there are duplicate photos in fs"
+        assert tu.count_db_photos() == 10, "there are duplicate photos in db"
+        assert tu.count_fs_thumb() == 10, "there are duplicate photos in thumb"
+
+    def test_lossless_rotation(self):
+        tu = TestUtils()
+        assert tu.is_env_clean(tu.conf['lycheepath']), "env not clean"
+        tu.load_photoset("rotation")
+        # launch lycheesync
+        src = tu.conf['testphotopath']
+        lych = tu.conf['lycheepath']
+        conf = tu.make_conf(losslessRotation=True)
+
+        # run
+        runner = CliRunner()
+        result = runner.invoke(main, [src, lych, conf, '-v'])
+        # no crash
+        assert result.exit_code == 0, "process result is ok"
+
+        photos = tu.get_photos(tu.get_album_id('rotation'))
+        for p in photos:
+            pfullpath = os.path.join(lych, "uploads", "big", p['url'])
+            srcfullpath = os.path.join(src, "rotation", p['title'])
+            exif_dict = piexif.load(pfullpath)
+            orientation = piexif.load(srcfullpath)["0th"][piexif.ImageIFD.Orientation]
+            # big file never re-encoded: untouched or losslessly transposed by jpegtran
+            if filecmp.cmp(pfullpath, srcfullpath, shallow=False):
+                assert exif_dict["0th"][piexif.ImageIFD.Orientation] == orientation
+            else:
+                assert exif_dict["0th"][piexif.ImageIFD.Orientation] == 1, "Exif rotation should be 1"
+            # dimensions are the displayed ones
+            if orientation in [5, 6, 7, 8]:
+                assert int(p['width']) < int(p['height']), "width and height should be inverted"
+
+    def test_content_addressed(self):
+        tu = TestUtils()
+        assert tu.is_env_clean(tu.conf['lycheepath']), "env not clean"
+        # same photo in 2 albums
+        tu.load_photoset("album1")
+        tu.load_photoset("duplicates")
+        # launch lycheesync
+        src = tu.conf['testphotopath']
+        lych = tu.conf['lycheepath']
+        conf = tu.make_conf(contentAddressed=True)
+
+        # run
+        runner = CliRunner()
+        result = runner.invoke(main, [src, lych, conf, '-v'])
+        # no crash
+        assert result.exit_code == 0, "process result is ok"
+        self.check_grand_total(2, 2)
+
+        # both photos share the same files
+        inodes = set()
+        for album in ['album1', 'duplicates']:
+            for p in tu.get_photos(tu.get_album_id(album)):
+                inodes.add(os.stat(os.path.join(lych, "uploads", "big", p['url'])).st_ino)
+        assert len(inodes) == 1, "photo stored more than once"
+
+        # blobs are removed with the last photo using them
+        shutil.rmtree(os.path.join(src, "album1"))
+        shutil.rmtree(os.path.join(src, "duplicates"))
+        result = runner.invoke(main, [src, lych, conf, '-v', '-d'])
+        assert result.exit_code == 0, "process result is ok"
+        blobs = os.path.join(lych, "uploads", "blobs")
+        nb_blobs = sum(len(files) for root, dirs, files in os.walk(blobs))
+        assert nb_blobs == 0, "unused blobs should be removed"
+
+    def test_content_addressed_first_failure(self, monkeypatch):
+        # the first photo of a content fails: its duplicates are imported on their own
+        tu = TestUtils()
+        assert tu.is_env_clean(tu.conf['lycheepath']), "env not clean"
+        tu.load_photoset("album1")
+        tu.load_photoset("duplicates")
+        src = tu.conf['testphotopath']
+        lych = tu.conf['lycheepath']
+        conf = tu.make_conf(contentAddressed=True)
+
+        placed = []
+        copy_file = LycheeSyncer.copyFileToLychee
+
+        def failing_first_copy(syncer, photo):
+            placed.append(photo.srcfullpath)
+            if len(placed) == 1:
+                return False
+            return copy_file(syncer, photo)
+        monkeypatch.setattr(LycheeSyncer, 'copyFileToLychee', failing_first_copy)
+
+        runner = CliRunner()
+        result = runner.invoke(main, [src, lych, conf, '-v'])
+        assert result.exit_code == 0, "process result is ok"
+        assert tu.count_db_photos() == 1, "the duplicate should replace the failed photo"
+        photo = tu.get_photos(tu.get_album_id('duplicates'))[0]
+        assert os.path.exists(os.path.join(lych, "uploads", "big", photo['url']))
+
+    def test_header_metadata(self):
+        # header only reader gives the same metadata as PIL
+        pics = os.path.join(os.path.dirname(__file__), "pics")
+        for album in ["rotation", "real_date", "album3", "invalid_taketime"]:
+            for f in os.listdir(os.path.join(pics, album)):
+                path = os.path.join(pics, album, f)
+                assert read_header_metadata(path) == read_pil_metadata(path), "metadata differ for " + path
+
+        meta = read_header_metadata(os.path.join(pics, "rotation", "P1010336.JPG"))
+        assert (meta['width'], meta['height']) == (2560, 1920)
+        assert meta['exif']['Orientation'] == 6
+        assert meta['exif']['Model'] == 'DMC-FT5'
+        assert meta['exif']['DateTimeOriginal'] == '2016:01:09 21:53:18'
+        assert meta['exif']['FocalLength'] == 4.9
+        # not a JPEG / PNG: PIL fallback
+        assert read_header_metadata(os.path.join(pics, "corrupted_file", "Lychees---Nature_s-Pride.jpg")) is None
+
+    def test_optimize_schema(self):
+        # schema optimization adds the lookup indexes once and does not sync anything
+        tu = TestUtils()
+        assert tu.is_env_clean(tu.conf['lycheepath']), "env not clean"
+        tu.load_photoset("album1")
+
+        src = tu.conf['testphotopath']
+        lych = tu.conf['lycheepath']
+        conf = tu.conf['conf']
+
+        runner = CliRunner()
+        try:
+            for i in range(2):
+                result = runner.invoke(main, [src, lych, conf, '-v', '--optimize-schema'])
+                assert result.exit_code == 0
+
+            db = tu._connect_db()
+            try:
+                with db.cursor() as cursor:
+                    cursor.execute("show index from lychee_photos")
+                    keys = set(r['Key_name'] for r in cursor.fetchall())
+            finally:
+                db.close()
+            assert set(['lycheesync_album', 'lycheesync_checksum', 'lycheesync_title']) <= keys
+            assert tu.count_db_photos() == 0, "optimize-schema must not import photos"
+
+            result = runner.invoke(main, [src, lych, conf, '-v'])
+            assert result.exit_code == 0
+            assert tu.count_db_photos() == 1
+        finally:
+            # the next tests run on the original schema
+            db = tu._connect_db()
+            try:
+                for name, table, columns in SCHEMA_INDEXES:
+                    try:
+                        tu._exec_sql(db, "alter table {} drop index {}".format(table, name))
+                    except pymysql.err.MySQLError:
+                        # not created
+                        pass
+            finally:
+                db.close()
+
+    def test_checksum_migration_resume(self):
+        # a migration interrupted after a batch resumes after the last saved id
+        tu = TestUtils()
+        assert tu.is_env_clean(tu.conf['lycheepath']), "env not clean"
+        tu.load_photoset("album3")
+        src = tu.conf['testphotopath']
+        lych = tu.conf['lycheepath']
+        runner = CliRunner()
+        result = runner.invoke(main, [src, lych, tu.conf['conf'], '-v'])
+        assert result.exit_code == 0, "process result is ok"
+
+        def get_checksums():
+            db = tu._connect_db()
+            try:
+                with db.cursor() as cursor:
+                    cursor.execute("select id, checksum from lychee_photos")
+                    return dict((int(r['id']), r['checksum']) for r in cursor.fetchall())
+            finally:
+                db.close()
+        checksums = get_checksums()
+        db = tu._connect_db()
+        try:
+            tu._exec_sql(db, "update lychee_photos set checksum=''")
+        finally:
+            db.close()
+
+        conf = dict(tu.conf, confpath=tu.conf['conf'], insertBatchSize=1, workers=1)
+        checkpoint = checkpoint_path_for(conf)
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+        class Interrupted(Exception):
+            pass
+
+        class InterruptedMigration(ChecksumMigration):
+            def photos(self, readdb):
+                for n, task in enumerate(ChecksumMigration.photos(self, readdb)):
+                    if n == 2:
+                        raise Interrupted()
+                    yield task
+
+        hashed = []
+
+        class CountingMigration(ChecksumMigration):
+            def hashStage(self, task):
+                hashed.append(task['id'])
+                return ChecksumMigration.hashStage(self, task)
+
+        try:
+            with pytest.raises(Interrupted):
+                InterruptedMigration(conf).run()
+            ids = sorted(checksums)
+            assert os.path.exists(checkpoint)
+            with open(checkpoint) as f:
+                assert int(f.read()) == ids[1], "the checkpoint is the last written id"
+
+            assert CountingMigration(conf).run()
+            assert sorted(hashed) == ids[2:], "the migration resumes after the checkpoint"
+            assert not(os.path.exists(checkpoint)), "the checkpoint is removed once complete"
+            assert get_checksums() == checksums
+        finally:
+            if os.path.exists(checkpoint):
+                os.remove(checkpoint)
+
+    def test_checksum_migration_retry(self):
+        # a photo whose file could not be hashed is kept in the checkpoint and retried by the next run
+        tu = TestUtils()
+        assert tu.is_env_clean(tu.conf['lycheepath']), "env not clean"
+        tu.load_photoset("album3")
+        runner = CliRunner()
+        result = runner.invoke(main, [tu.conf['testphotopath'], tu.conf['lycheepath'], tu.conf['conf'], '-v'])
+        assert result.exit_code == 0, "process result is ok"
+
+        conf = dict(tu.conf, confpath=tu.conf['conf'], insertBatchSize=1, workers=1)
+        checkpoint = checkpoint_path_for(conf)
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        ids = sorted(int(p['id']) for p in tu.get_photos())
+        hashed = []
+
+        class FailingMigration(ChecksumMigration):
+            def hashStage(self, task):
+                if task['id'] == ids[0]:
+                    self.failed += 1
+                    task['newchecksum'] = None
+                    return task
+                return ChecksumMigration.hashStage(self, task)
+
+        class CountingMigration(ChecksumMigration):
+            def hashStage(self, task):
+                hashed.append(task['id'])
+                return ChecksumMigration.hashStage(self, task)
+
+        try:
+            assert not(FailingMigration(conf).run()), "a photo could not be hashed"
+            with open(checkpoint) as f:
+                assert [int(i) for i in f.read().split()] == [ids[-1], ids[0]]
+
+            assert CountingMigration(conf).run()
+            assert hashed == [ids[0]], "only the failed photo is hashed again"
+            assert not(os.path.exists(checkpoint)), "the checkpoint is removed once complete"
+        finally:
+            if os.path.exists(checkpoint):
+                os.remove(checkpoint)
+
+    def test_connection_pool(self):
+        # each thread gets its own connection, a killed connection is reopened transparently
+        tu = TestUtils()
+        pool = LycheeConnectionPool(tu.conf, pingafter=0)
+        try:
+            conn = pool.get()
+            assert pool.get() is conn, "a thread keeps its connection"
+            others = []
+            t = threading.Thread(target=lambda: others.append(pool.get()))
+            t.start()
+            t.join()
+            assert others[0] is not conn, "each thread has its own connection"
+
+            # reopened by the ping before reuse
+            self.kill_connection(tu, conn)
+            with pool.get().cursor() as cursor:
+                cursor.execute("select count(1) as nb from lychee_albums")
+                assert cursor.fetchone()['nb'] == 0
+        finally:
+            pool.closeAll()
+
+    @staticmethod
+    def kill_connection(tu, conn):
+        """ kill a db connection from another one, as the server wait_timeout would """
+        with conn.cursor() as cursor:
+            cursor.execute("select connection_id() as cid")
+            cid = cursor.fetchone()['cid']
+        db = tu._connect_db()
+        try:
+            tu._exec_sql(db, "kill {}".format(cid))
+        finally:
+            db.close()
+        return cid
+
+    def test_connection_retry(self):
+        # no ping before reuse: the lost connection is found by the select, reopened and the select run again
+        tu = TestUtils()
+        pool = LycheeConnectionPool(tu.conf, pingafter=3600)
+        try:
+            conn = pool.get()
+            cid = self.kill_connection(tu, conn)
+            conn = pool.get()
+            with conn.cursor() as cursor:
+                cursor.execute("select connection_id() as cid")
+                assert cursor.fetchone()['cid'] != cid, "the select should run on a new connection"
+        finally:
+            pool.closeAll()
+
+    def test_connection_no_retry_in_transaction(self):
+        # a statement of a transaction is not replayed: the previous statements are lost with the connection
+        tu = TestUtils()
+        pool = LycheeConnectionPool(tu.conf, pingafter=3600)
+        try:
+            conn = pool.get()
+            conn.begin()
+            self.kill_connection(tu, conn)
+            with pytest.raises(pymysql.err.OperationalError):
+                with conn.cursor() as cursor:
+                    cursor.execute("insert into lychee_albums (id, title, sysstamp, public, password) "
+                                   "values (%s, %s, %s, %s, NULL)", (1, 'lost', 0, '0'))
+            conn.rollback()
+            assert not(conn.intransaction)
+            assert tu.count_db_albums() == 0, "the insert should not be retried"
+        finally:
+            pool.closeAll()
@@ -8,6 +8,7 @@ import re
 import subprocess
 import pymysql
 import base64
+import json
 from tests.configuration import TestBorg
 from lycheesync.utils.configuration import ConfBorg
 # from datetime import datetime
@@ -223,6 +224,27 @@ class TestUtils:
         dest = os.path.join(self.cb.conf['testphotopath'], dest_name)
         shutil.copytree(testalbum, dest)  # , copy_function=shutil.copy)
 
+    tmp_files = ['tmp_conf.json', 'tmp_manifest.sqlite', 'tmp_plan.jsonl']
+
+    def tmp_path(self, name):
+        """ path of a temporary test file (see tmp_files), next to the test photo directory """
+        return os.path.join(os.path.dirname(self.cb.conf['testphotopath'].rstrip(os.sep)) or '.', name)
+
+    def remove_tmp_files(self):
+        for name in self.tmp_files:
+            if os.path.exists(self.tmp_path(name)):
+                os.remove(self.tmp_path(name))
+
+    def make_conf(self, **extra):
+        """ write a copy of the test configuration file with extra keys, returns its path """
+        with open(self.cb.conf['conf'], 'rt') as f:
+            conf = json.load(f)
+        conf.update(extra)
+        conf_path = self.tmp_path('tmp_conf.json')
+        with open(conf_path, 'wt') as f:
+            json.dump(conf, f)
+        return conf_path
+
     def clean_db(self):
         logger.info("Clean Database")
         # connect to db
@@ -279,11 +301,14 @@ class TestUtils:
         big = os.path.join(lycheepath, "uploads", "big")
         med = os.path.join(lycheepath, "uploads", "medium")
         thumb = os.path.join(lycheepath, "uploads", "thumb")
+        blobs = os.path.join(lycheepath, "uploads", "blobs")
 
         # empty images
         self._empty_or_create_dir(big)
         self._empty_or_create_dir(med)
         self._empty_or_create_dir(thumb)
+        if os.path.isdir(blobs):
+            shutil.rmtree(blobs)
 
     def delete_dir_content(self, dir):
         self._empty_or_create_dir(dir)
@@ -408,11 +433,11 @@ class TestUtils:
         try:
             # check if exists in db
             if a_id:
-                sql = "select id, title, url, iso, aperture, shutter, focal  from lychee_photos where album='{}'".format(a_id)
+                sql = "select id, title, url, iso, aperture, shutter, focal, takestamp from lychee_photos where album='{}'".format(a_id)
             elif p_id:
-                sql = "select id, title, url, iso, aperture, shutter, focal  from lychee_photos where id='{}'".format(p_id)
+                sql = "select id, title, url, iso, aperture, shutter, focal, takestamp from lychee_photos where id='{}'".format(p_id)
             else:
-                sql = "select id, title, url, iso, aperture, shutter, focal  from lychee_photos"
+                sql = "select id, title, url, iso, aperture, shutter, focal, takestamp from lychee_photos"
 
             with db.cursor() as cursor:
                 cursor.execute(sql)
@@ -427,6 +452,7 @@ class TestUtils:
                     photo['shutter'] = r['shutter']
                     photo['focal'] = r['focal']
                     photo['title'] = r['title']
+                    photo['takestamp'] = r['takestamp']
                     res.append(photo)
         except Exception as e:
             logger.exception(e)